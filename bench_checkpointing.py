@@ -0,0 +1,82 @@
+import time
+import argparse
+import resource
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from datasets import NuScenesDataset, AutoregressivePreprocessor, DiffusionModelPreprocessor, collate_fn
+from networks.autoregressive_transformer import AutoregressiveTransformer
+from networks.diffusion_models import DiffusionBasedModel
+
+settings = {
+    'ar': [(), ('extractor',), ('decoder',), ('extractor', 'decoder')],
+    'diffusion': [(), ('extractor',), ('encoder_layer',), ('extractor', 'encoder_layer')]
+}
+
+
+def run(args, checkpoint, results):
+    # one setting per process, so the peak RSS on CPU belongs to this setting alone
+    device = torch.device(0) if torch.cuda.is_available() else torch.device('cpu')
+    dataset = NuScenesDataset(args.dataroot)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=0, collate_fn=collate_fn)
+    if args.model == 'ar':
+        preprocessor = AutoregressivePreprocessor(device).train()
+        model = AutoregressiveTransformer(checkpoint=checkpoint)
+    else:
+        preprocessor = DiffusionModelPreprocessor(device).train()
+        model = DiffusionBasedModel(time_steps=1000, checkpoint=checkpoint)
+    model = model.to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    n_samples = 0
+    elapsed = 0.
+    for i, batch in enumerate(dataloader):
+        if i > args.iters:
+            break
+        if args.model == 'ar':
+            batch, lengths, gt = preprocessor(batch)
+        else:
+            batch = preprocessor(batch)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.time()
+        if args.model == 'ar':
+            loss = model(batch, lengths, gt)['all'].mean()
+        else:
+            loss = model(batch)['all'].mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i > 0:  # warm-up
+            elapsed += time.time() - start
+            n_samples += args.batch_size
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    results[checkpoint] = (peak, n_samples / elapsed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', default='/shared/perception/datasets/nuScenesProcessed/train')
+    parser.add_argument('--model', choices=['ar', 'diffusion'], default='ar')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--iters', type=int, default=10)
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    results = ctx.Manager().dict()
+    for checkpoint in settings[args.model]:
+        p = ctx.Process(target=run, args=(args, checkpoint, results))
+        p.start()
+        p.join()
+
+    base_peak, base_speed = results[()]
+    for checkpoint in settings[args.model]:
+        peak, speed = results[checkpoint]
+        name = '+'.join(checkpoint) if checkpoint else 'none'
+        print(f'{name:>24}: peak memory {peak / 2 ** 30:.2f} GiB ({peak / base_peak:.2f}x), '
+              f'{speed:.2f} samples/s ({speed / base_speed:.2f}x)')
@@ -0,0 +1,109 @@
+import time
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from datasets import NuScenesDataset, AutoregressivePreprocessor, collate_fn
+from networks.autoregressive_transformer import AutoregressiveTransformer
+from networks.utils import SyncCounter, get_length_mask
+
+
+def valid_placements(model, maps, scenes, lengths, new_lengths):
+    # placed objects whose center is on drivable area (vehicles) or walkway / crossing (others)
+    L = scenes['category'].size(1)
+    placed = ~get_length_mask(new_lengths, L) & get_length_mask(lengths, L)  # (B, L)
+    loc = model._discrete_loc(scenes['location']).clamp(0, 320 * 320 - 1)
+    maps = maps.flatten(2)
+    drivable = maps[:, 0].gather(1, loc) > 0
+    walkable = (maps[:, 1].gather(1, loc) + maps[:, 2].gather(1, loc)) > 0
+    valid = torch.where(scenes['category'] == 3, drivable, walkable)
+    return (valid & placed).sum().item()
+
+
+def benchmark(generate, model, dataloader, preprocessor, n_batches, device):
+    n_objects = 0
+    n_valid = 0
+    n_syncs = 0
+    elapsed = 0.
+    for i, batch in enumerate(dataloader):
+        if i >= n_batches:
+            break
+        batch, lengths, _ = preprocessor(batch, n_keep=0)
+        batch = {k: v.to(device) for k, v in batch.items()}
+        lengths = lengths.to(device)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.time()
+        with SyncCounter() as syncs:
+            scenes, new_lengths = generate(batch, lengths)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        elapsed += time.time() - start
+        n_objects += (new_lengths - lengths).sum().item()
+        n_valid += valid_placements(model, batch['map'], scenes, lengths, new_lengths)
+        n_syncs += syncs.count
+    return n_objects / elapsed, n_syncs / max(n_objects, 1), n_valid / max(n_objects, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', default='/projects/perception/datasets/nuScenesProcessed/test')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--n-batches', type=int, default=5)
+    parser.add_argument('--n-sample', type=int, default=5,
+                        help='draws per attribute, the most likely is kept; 1 samples every attribute once')
+    parser.add_argument('--max-steps', type=int, default=100)
+    parser.add_argument('--causal', action='store_true', help='causal encoder, also benchmarks the KV cache')
+    parser.add_argument('--sparse-location', action='store_true',
+                        help='location logits on the candidate pixels only, syncs once per decode')
+    parser.add_argument('--mode-decoding', action='store_true', help='analytic modes instead of n-sample draws')
+    parser.add_argument('--speculative', type=int, nargs='*', default=[2, 4, 8],
+                        help='objects proposed per step in speculative generation')
+    args = parser.parse_args()
+
+    device = torch.device(0) if torch.cuda.is_available() else torch.device('cpu')
+    dataset = NuScenesDataset(args.dataroot)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, collate_fn=collate_fn)
+    preprocessor = AutoregressivePreprocessor('cpu').test()
+    model = AutoregressiveTransformer(causal=args.causal, sparse_location=args.sparse_location)
+    if args.ckpt is not None:
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    model = model.to(device)
+    model.mode_decoding = args.mode_decoding
+
+    def compacted(batch, lengths):
+        return model.generate_scenes(batch, lengths, n_sample=args.n_sample, max_steps=args.max_steps)
+
+    def resident(batch, lengths):
+        return model.generate_resident(batch, lengths, n_sample=args.n_sample, max_steps=args.max_steps)
+
+    def cached(batch, lengths):
+        return model.generate_cached(batch, lengths, n_sample=args.n_sample, max_steps=args.max_steps)
+
+    def speculative(k, stats):
+        def generate(batch, lengths):
+            scenes, new_lengths, batch_stats = model.generate_speculative(batch, lengths, n_sample=args.n_sample,
+                                                                          max_steps=args.max_steps, k=k)
+            for key, value in batch_stats.items():
+                stats[key] = stats.get(key, 0) + value
+            return scenes, new_lengths
+
+        return generate
+
+    modes = [('compacted batch', compacted, None), ('device resident', resident, None)]
+    if args.causal:
+        modes.append(('kv cached', cached, None))
+    for k in args.speculative:
+        stats = {}
+        modes.append((f'speculative k={k}', speculative(k, stats), stats))
+    for name, generate, stats in modes:
+        speed, syncs, valid = benchmark(generate, model, dataloader, preprocessor, args.n_batches, device)
+        report = f'{name}: {speed:.2f} objects/s, {syncs:.2f} host syncs per object, {valid:.3f} valid placements'
+        if args.sparse_location:
+            # the candidate pixel lists of sparse location decoding are sized on the host
+            report += ' (sparse location: includes the syncs sizing the candidate lists at every decode)'
+        if stats:
+            # every iteration is one draft and one scoring pass, one step is one pass
+            report += f', {stats["accepted"] / max(stats["proposed"], 1):.3f} accepted, ' \
+                      f'{stats["iterations"] * 2 / args.n_batches:.1f} passes per batch'
+        print(report)
@@ -0,0 +1,45 @@
+import os
+import time
+import argparse
+from torch.utils.data import DataLoader
+from datasets import NuScenesDataset, NuScenesShardDataset, collate_fn
+
+
+def benchmark(dataloader, n_batches):
+    n_samples = 0
+    start = time.time()
+    for i, batch in enumerate(dataloader):
+        if i == 0:
+            # exclude worker start-up from the measurement
+            start = time.time()
+        else:
+            n_samples += batch['map'].size(0)
+        if i >= n_batches:
+            break
+    return n_samples / (time.time() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', required=True, help='per-file layout, e.g. a local copy of the mount')
+    parser.add_argument('--shards', required=True, help='shard directory, written from --dataroot if missing')
+    parser.add_argument('--shard-size', type=int, default=256)
+    parser.add_argument('--shuffle-buffer', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=32, help='reader threads per worker for the per-file layout')
+    parser.add_argument('--n-batches', type=int, default=100)
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.shards, NuScenesShardDataset.index_name)):
+        NuScenesShardDataset.write_shards(args.dataroot, args.shards, shard_size=args.shard_size)
+
+    for n_threads in [1, args.threads]:
+        dataset = NuScenesDataset(args.dataroot, n_threads=n_threads)
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.workers,
+                                collate_fn=collate_fn)
+        print(f'random access, {n_threads} reader threads: {benchmark(dataloader, args.n_batches):.1f} samples/s')
+
+    dataset = NuScenesShardDataset(args.shards, shuffle_buffer=args.shuffle_buffer)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers, collate_fn=collate_fn)
+    print(f'sharded stream: {benchmark(dataloader, args.n_batches):.1f} samples/s')
@@ -0,0 +1,51 @@
+import time
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from datasets import NuScenesDataset, AutoregressivePreprocessor, collate_fn
+from networks.autoregressive_transformer import AutoregressiveTransformer
+
+
+def benchmark(model, dataloader, preprocessor, window_size, n_iters, device):
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    n_objects = 0
+    elapsed = 0.
+    for i, batch in enumerate(dataloader):
+        if i > n_iters:
+            break
+        batch, lengths, gt = preprocessor(batch, window_size=window_size)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.time()
+        loss = model(batch, lengths, gt)
+        optimizer.zero_grad()
+        loss['all'].mean().backward()
+        optimizer.step()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i > 0:  # warm-up
+            elapsed += time.time() - start
+            n_objects += loss['all'].numel()
+    return n_objects / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', default='/shared/perception/datasets/nuScenesProcessed/train')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--max-steps', type=int, default=None, help='cap on supervised steps per batch')
+    parser.add_argument('--route', action='store_true', help='decode each step with its gt category decoder only')
+    args = parser.parse_args()
+
+    device = torch.device(0) if torch.cuda.is_available() else torch.device('cpu')
+    dataset = NuScenesDataset(args.dataroot)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=4, collate_fn=collate_fn)
+    preprocessor = AutoregressivePreprocessor(device).train()
+    model = AutoregressiveTransformer(max_supervised_steps=args.max_steps,
+                                      route_decoders=args.route).to(device)
+
+    single = benchmark(model, dataloader, preprocessor, 1, args.iters, device)
+    print(f'one random prefix per scene: {single:.2f} supervised objects/s')
+    sequence = benchmark(model, dataloader, preprocessor, 'all', args.iters, device)
+    print(f'whole scenes, teacher forced: {sequence:.2f} supervised objects/s ({sequence / single:.1f}x)')
@@ -0,0 +1,118 @@
+import math
+import time
+import argparse
+import torch
+from torch.distributions import Categorical, LogNormal, VonMises, Independent, MixtureSameFamily
+from networks.mixtures import MixtureLogNormal, MixtureVonMises
+
+
+def reference_lognormal(logits, mu, sigma):
+    prob = Independent(LogNormal(mu, sigma), reinterpreted_batch_ndims=1)
+    return MixtureSameFamily(Categorical(logits=logits), prob)
+
+
+def reference_vonmises(logits, cos, sin, kappa):
+    prob = Independent(VonMises(torch.atan2(sin, cos), kappa), reinterpreted_batch_ndims=1)
+    return MixtureSameFamily(Categorical(logits=logits), prob)
+
+
+def circular_moments(x):
+    # mean direction and resultant length of (N, B, 1) angles
+    c, s = torch.cos(x).mean(dim=0), torch.sin(x).mean(dim=0)
+    return torch.atan2(s, c), torch.sqrt(c ** 2 + s ** 2)
+
+
+def max_prob_sample(prob, n_sample):
+    # the sampled mode estimate of AutoregressiveTransformer._max_prob_sample
+    sample = prob.sample(torch.Size([n_sample]))  # (n_sample, B, E)
+    best = prob.log_prob(sample).argmax(dim=0)
+    return sample[best, torch.arange(sample.size(1), device=sample.device)]
+
+
+def check_mode(name, prob, n_sample, n_samples):
+    # density at the analytic mode against the best of n_sample and of n_samples samples, per batch entry
+    at_mode = prob.log_prob(prob.mode())
+    at_sampled = prob.log_prob(max_prob_sample(prob, n_sample))
+    at_many = prob.log_prob(max_prob_sample(prob, n_samples))
+    print(f'{name} mode: log_prob {at_mode.mean().item():.3f}, best of {n_sample} samples '
+          f'{at_sampled.mean().item():.3f}, best of {n_samples} samples {at_many.mean().item():.3f}, '
+          f'mode below best of {n_samples} for {(at_mode < at_many - 1e-4).float().mean().item():.3f} of entries')
+
+
+def timed(fn, n_iters, device):
+    fn()  # warm-up
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.time()
+    for _ in range(n_iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.time() - start) / n_iters * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--n-mixture', type=int, default=8)
+    parser.add_argument('--n-samples', type=int, default=20000)
+    parser.add_argument('--iters', type=int, default=100)
+    parser.add_argument('--n-sample', type=int, default=5, help='samples per mode estimate in generation')
+    args = parser.parse_args()
+
+    device = torch.device(0) if torch.cuda.is_available() else torch.device('cpu')
+    B, K = args.batch_size, args.n_mixture
+    torch.manual_seed(0)
+    logits = torch.randn(B, K, device=device)
+
+    # log-normal, event of two as for wl
+    mu = torch.randn(B, K, 2, device=device)
+    sigma = torch.rand(B, K, 2, device=device) * 0.5 + 0.01
+    fused, reference = MixtureLogNormal(logits, mu, sigma), reference_lognormal(logits, mu, sigma)
+    x = reference.sample(torch.Size([16]))
+    diff = (fused.log_prob(x) - reference.log_prob(x)).abs().max().item()
+    print(f'log-normal log_prob: max abs diff {diff:.2e}')
+    mean_fused = fused.sample(torch.Size([args.n_samples])).log().mean(dim=0)
+    mean_reference = reference.sample(torch.Size([args.n_samples])).log().mean(dim=0)
+    print(f'log-normal samples: max abs diff of E[log x] {(mean_fused - mean_reference).abs().max().item():.2e}')
+
+    # von Mises on unit mean directions, event of one as for theta and omega
+    angle = (torch.rand(B, K, 1, device=device) * 2 - 1) * math.pi
+    kappa = 15 + torch.rand(B, K, 1, device=device) * 100
+    fused = MixtureVonMises(logits, torch.cos(angle), torch.sin(angle), kappa)
+    reference = reference_vonmises(logits, torch.cos(angle), torch.sin(angle), kappa)
+    x = reference.sample(torch.Size([16]))
+    diff = (fused.log_prob(x) - reference.log_prob(x)).abs().max().item()
+    print(f'von Mises log_prob: max abs diff {diff:.2e}')
+    loc_fused, r_fused = circular_moments(fused.sample(torch.Size([args.n_samples])))
+    loc_reference, r_reference = circular_moments(reference.sample(torch.Size([args.n_samples])))
+    loc_diff = torch.remainder(loc_fused - loc_reference + math.pi, 2 * math.pi) - math.pi
+    print(f'von Mises samples: max abs diff of mean direction {loc_diff.abs().max().item():.2e}, '
+          f'of resultant length {(r_fused - r_reference).abs().max().item():.2e}')
+
+    # analytic modes against the sampled estimates used in generation
+    check_mode('log-normal', MixtureLogNormal(logits, mu, sigma), args.n_sample, 1000)
+    check_mode('von Mises', fused, args.n_sample, 1000)
+    prob = MixtureLogNormal(logits, mu, sigma)
+    print(f'{"sampled":>20}: {timed(lambda: max_prob_sample(prob, args.n_sample), args.iters, device):.2f} ms, '
+          f'{"analytic":>10}: {timed(prob.mode, args.iters, device):.2f} ms per log-normal mode')
+    print(f'{"sampled":>20}: {timed(lambda: max_prob_sample(fused, args.n_sample), args.iters, device):.2f} ms, '
+          f'{"analytic":>10}: {timed(fused.mode, args.iters, device):.2f} ms per von Mises mode')
+
+    # construction, log_prob and sampling of one head, as done once per decoded step
+    x = reference.sample()
+    for name, build in [('torch.distributions', reference_vonmises), ('fused', MixtureVonMises)]:
+        def step():
+            prob = build(logits, torch.cos(angle), torch.sin(angle), kappa)
+            prob.log_prob(x)
+            prob.sample()
+
+        print(f'{name:>20}: {timed(step, args.iters, device):.2f} ms per von Mises head')
+    x = torch.rand(B, 2, device=device) + 0.5
+    for name, build in [('torch.distributions', reference_lognormal), ('fused', MixtureLogNormal)]:
+        def step():
+            prob = build(logits, mu, sigma)
+            prob.log_prob(x)
+            prob.sample()
+
+        print(f'{name:>20}: {timed(step, args.iters, device):.2f} ms per log-normal head')
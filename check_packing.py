@@ -0,0 +1,59 @@
+import argparse
+import torch
+from torch import nn
+from networks.packing import PackedSequences, packed_encoder
+
+
+def padded_reference(encoder, x, valid, attn_mask):
+    # the padded encoder the packed path replaces, as in AutoregressiveTransformer._encode
+    return encoder(x, mask=attn_mask, src_key_padding_mask=~valid)
+
+
+def random_batch(B, S, d_model, device, contiguous):
+    lengths = torch.randint(0, S + 1, (B, ), device=device)
+    lengths[0] = S  # one full sequence so the padded layout keeps its width
+    valid = torch.arange(S, device=device) < lengths[:, None]
+    if not contiguous:
+        # real tokens with gaps, as the prefix padding between prefix and targets in sequence training
+        valid = valid & (torch.rand(B, S, device=device) < 0.7)
+        valid[:, 0] = True
+    return torch.randn(B, S, d_model, device=device), valid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--length', type=int, default=97)
+    parser.add_argument('--n-trials', type=int, default=4)
+    args = parser.parse_args()
+
+    device = torch.device(0) if torch.cuda.is_available() else torch.device('cpu')
+    torch.manual_seed(0)
+    S = args.length
+    idx = torch.arange(S, device=device)
+    masks = {
+        'no mask': None,
+        'causal': idx[None, :] > idx[:, None],
+        'prefix / targets': (idx[None, :] > idx[:, None]) & (idx[None, :] >= S // 2),
+    }
+    for norm_first in [False, True]:
+        layer = nn.TransformerEncoderLayer(d_model=64, nhead=4, dim_feedforward=128, activation='gelu',
+                                           batch_first=True, norm_first=norm_first)
+        # no nested tensors, so the reference keeps the padded layout
+        encoder = nn.TransformerEncoder(layer, num_layers=3, enable_nested_tensor=False).to(device).eval()
+        for name, attn_mask in masks.items():
+            for trial in range(args.n_trials):
+                x, valid = random_batch(args.batch_size, S, 64, device, contiguous=trial % 2 == 0)
+                x_packed = x.clone().requires_grad_()
+                x_padded = x.clone().requires_grad_()
+                packing = PackedSequences(valid)
+                packed = packed_encoder(encoder, packing.pack(x_packed), packing, attn_mask)
+                padded = padded_reference(encoder, x_padded, valid, attn_mask)[valid]
+                torch.testing.assert_close(packed, padded, rtol=1e-4, atol=1e-5)
+                packed.sum().backward()
+                padded.sum().backward()
+                torch.testing.assert_close(x_packed.grad[valid], x_padded.grad[valid], rtol=1e-4, atol=1e-5)
+            n_buckets = len(packing.buckets)
+            attended = sum(token.numel() * token.size(1) for token, _ in packing.buckets)
+            print(f'norm_first={norm_first}, {name}: packed matches padded, {n_buckets} buckets, '
+                  f'{attended / (valid.size(0) * S * S):.2f} of the padded attention scores')
@@ -1,3 +1,3 @@
-from .nuScenes import NuScenesDataset
+from .nuScenes import NuScenesDataset, NuScenesShardDataset
 from .preprocessing import AutoregressivePreprocessor, DiffusionModelPreprocessor
 from .utils import collate_fn
@@ -1,14 +1,51 @@
+import ast
+import io
+import json
+import operator
 import math
+import struct
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+import torch.distributed as dist
 import numpy as np
 import os
 import cv2
 from pyquaternion import Quaternion
 from nuscenes.utils.geometry_utils import BoxVisibility
-from .utils import get_homogeneous_matrix, cartesian_to_polar
+from .utils import get_homogeneous_matrix, cartesian_to_polar, scenario_dtype, scenario_record
 from tqdm import tqdm
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+
+_query_operators = {
+    ast.BitAnd: operator.and_, ast.BitOr: operator.or_, ast.Invert: operator.invert,
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+
+
+def _evaluate_query(node, columns):
+    # only column names, literals, comparisons and & | ~ are allowed, nothing is executed
+    if isinstance(node, ast.Expression):
+        return _evaluate_query(node.body, columns)
+    if isinstance(node, ast.Name) and node.id in columns:
+        return columns[node.id]
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, str)):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _query_operators:
+        return _query_operators[type(node.op)](_evaluate_query(node.operand, columns))
+    if isinstance(node, ast.BinOp) and type(node.op) in _query_operators:
+        return _query_operators[type(node.op)](_evaluate_query(node.left, columns),
+                                               _evaluate_query(node.right, columns))
+    if isinstance(node, ast.Compare) and all(type(op) in _query_operators for op in node.ops):
+        left, mask = _evaluate_query(node.left, columns), True
+        for op, comparator in zip(node.ops, node.comparators):
+            right = _evaluate_query(comparator, columns)
+            mask = mask & _query_operators[type(op)](left, right)
+            left = right
+        return mask
+    raise ValueError(f'unsupported query expression: {ast.dump(node)}')
 
 
 class NuScenesDataset(Dataset):
@@ -41,6 +78,8 @@ class NuScenesDataset(Dataset):
                         'vehicle.emergency.ambulance': VEHICLE,
                         'vehicle.emergency.police': VEHICLE,
                         'vehicle.trailer': VEHICLE}
+    fields = ['map', 'category', 'location', 'bbox', 'velocity']
+    index_name = 'index.npy'
 
     @classmethod
     def preprocess(cls, dataroot: str,
@@ -60,14 +99,13 @@ class NuScenesDataset(Dataset):
         os.makedirs('test', exist_ok=True)
         train_scenes = 5
         i = 0
+        records = {'train': [], 'test': []}
         for scene in nusc.scene:
             if scene['token'] in ['325cef682f064c55a255f2625c533b75', 'bebf5f5b2a674631ab5c88fd1aa9e87a',
                                   'fcbccedd61424f1b85dcbf8f897f9754']:
                 continue
-            if i < train_scenes:
-                os.chdir('train')
-            else:
-                os.chdir('test')
+            folder = 'train' if i < train_scenes else 'test'
+            os.chdir(folder)
             sample_token = scene['first_sample_token']
             while sample_token:
                 sample = nusc.get('sample', sample_token)
@@ -237,25 +275,210 @@ class NuScenesDataset(Dataset):
                 torch.save(torch.tensor(np.array(location), dtype=torch.float32), 'location')
                 torch.save(torch.tensor(np.array(bbox), dtype=torch.float32), 'bbox')
                 torch.save(torch.tensor(np.array(velocity), dtype=torch.float32), 'velocity')
+                records[folder].append(scenario_record(sample_data['token'], category, velocity,
+                                                       drivable_area, ped_crossing,
+                                                       location=map_name,
+                                                       ego_pose=(pose['translation'][0], pose['translation'][1],
+                                                                 Quaternion(pose['rotation']).yaw_pitch_roll[0])))
 
                 os.chdir('..')
                 sample_token = sample['next']
             os.chdir('..')
             i += 1
+        for folder in records:
+            np.save(os.path.join(folder, cls.index_name), np.array(records[folder], dtype=scenario_dtype))
+
+    @classmethod
+    def build_index(cls, dataroot: str):
+        # index an already processed split; map name and ego pose are not stored per sample and stay empty
+        records = []
+        for token in tqdm([name for name in os.listdir(dataroot) if name != cls.index_name]):
+            path = os.path.join(dataroot, token)
+            maps = torch.load(os.path.join(path, 'map'))
+            category = torch.load(os.path.join(path, 'category')).numpy()
+            velocity = torch.load(os.path.join(path, 'velocity')).numpy()
+            records.append(scenario_record(token, category, velocity, maps[0].numpy(), maps[1].numpy()))
+        np.save(os.path.join(dataroot, cls.index_name), np.array(records, dtype=scenario_dtype))
 
-    def __init__(self, dataroot: str):
+    def __init__(self, dataroot: str, n_threads: int = 32, query=None):
         self.dataroot = dataroot
-        self.samples = os.listdir(dataroot)
+        index_path = os.path.join(dataroot, self.index_name)
+        if os.path.exists(index_path):
+            self.index = np.load(index_path)
+            self.samples = list(self.index['token'])
+        else:
+            self.index = None
+            self.samples = os.listdir(dataroot)
         # self.samples = ['07963799cc9d4a19bd0d9076e4a00da4']
+        self.n_threads = n_threads
+        self._executor = None
+        self._executor_pid = None
+        if query is not None:
+            self.select(query)
+
+    def select(self, query):
+        """
+        Keep the samples whose index rows satisfy `query`, either a callable mapping the columns to a boolean
+        mask or an expression over the column names, e.g.
+            "(n_pedestrian >= 5) & (location == 'boston-seaport') & (ped_crossing_fraction > 0.05)"
+        Expressions may only use column names, literals, comparisons and & | ~, they are parsed, not eval'ed.
+        """
+        if self.index is None:
+            raise FileNotFoundError(f'{self.index_name} not found in {self.dataroot}, run build_index first')
+        columns = {name: self.index[name] for name in self.index.dtype.names}
+        if callable(query):
+            mask = query(columns)
+        else:
+            mask = _evaluate_query(ast.parse(query, mode='eval'), columns)
+        self.index = self.index[np.asarray(mask, dtype=bool)]
+        self.samples = list(self.index['token'])
+        return self
+
+    def __getstate__(self):
+        # thread pools cannot be sent to dataloader workers
+        state = dict(self.__dict__)
+        state['_executor'] = None
+        state['_executor_pid'] = None
+        return state
+
+    @property
+    def executor(self):
+        # a pool inherited through fork has no threads, so every process creates its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.n_threads)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as f:
+            return f.read()
 
     def __len__(self):
         return len(self.samples)
         # return 1
 
     def __getitem__(self, idx):
-        path = os.path.join(self.dataroot, self.samples[idx])
-        data = {}
-        for filename in os.listdir(path):
-            datapath = os.path.join(path, filename)
-            data[filename] = torch.load(datapath)
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, indices):
+        # issue the file reads of the whole batch at once, so their round trips overlap on slow mounts
+        paths = [os.path.join(self.dataroot, self.samples[idx], field) for idx in indices for field in self.fields]
+        raw = list(self.executor.map(self._read, paths))
+        n_fields = len(self.fields)
+        data = []
+        for i in range(len(indices)):
+            data.append({field: torch.load(io.BytesIO(raw[i * n_fields + j]))
+                         for j, field in enumerate(self.fields)})
         return data
+
+
+class NuScenesShardDataset(IterableDataset):
+    """
+    Streams samples from a few large shard files instead of five small files per sample.
+
+    Each shard is a sequence of records (8-byte little-endian size + torch.save'd sample dict) that is read
+    front to back. Shards are dealt out per rank and per dataloader worker in an order seeded by the epoch, and
+    samples go through an in-memory shuffle buffer before they are yielded.
+    """
+    index_name = 'shards.json'
+
+    @classmethod
+    def write_shards(cls, dataroot: str,
+                     output_path: str,
+                     shard_size: int = 256,
+                     seed: int = 0):
+        # convert the per-file layout of NuScenesDataset into shards
+        dataset = NuScenesDataset(dataroot)
+        order = np.random.RandomState(seed).permutation(len(dataset))  # mix scenes across shards
+        os.makedirs(output_path, exist_ok=True)
+        shards = []
+        for start in tqdm(range(0, len(order), shard_size)):
+            name = 'shard-%05d' % len(shards)
+            idx = order[start:start + shard_size]
+            with open(os.path.join(output_path, name), 'wb') as f:
+                for i in idx:
+                    buffer = io.BytesIO()
+                    torch.save(dataset[i], buffer)
+                    data = buffer.getvalue()
+                    f.write(struct.pack('<Q', len(data)))
+                    f.write(data)
+            shards.append({'name': name, 'length': len(idx)})
+        with open(os.path.join(output_path, cls.index_name), 'w') as f:
+            json.dump(shards, f)
+
+    def __init__(self, dataroot: str,
+                 shuffle_buffer: int = 256,
+                 seed: int = 0,
+                 rank: int = None,
+                 world_size: int = None,
+                 read_buffer: int = 16 << 20):
+        self.dataroot = dataroot
+        with open(os.path.join(dataroot, self.index_name)) as f:
+            self.shards = json.load(f)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.read_buffer = read_buffer
+        if rank is None or world_size is None:
+            if dist.is_available() and dist.is_initialized():
+                rank, world_size = dist.get_rank(), dist.get_world_size()
+            else:
+                rank, world_size = 0, 1
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # samples seen by this rank in one epoch
+        return self._assign_shards()[1]
+
+    def _assign_shards(self):
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.shards))
+        shards = [self.shards[i] for i in order]
+        per_rank = [shards[r::self.world_size] for r in range(self.world_size)]
+        # every rank stops after the same number of samples, otherwise DDP ranks fall out of step
+        quota = min(sum(shard['length'] for shard in rank_shards) for rank_shards in per_rank)
+        return per_rank[self.rank], quota
+
+    def _read_shard(self, name):
+        with open(os.path.join(self.dataroot, name), 'rb', buffering=self.read_buffer) as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                size, = struct.unpack('<Q', header)
+                yield torch.load(io.BytesIO(f.read(size)))
+
+    def __iter__(self):
+        shards, quota = self._assign_shards()
+        worker_info = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        # hand this rank's quota out to its workers in worker order
+        worker_shards = [shards[w::n_workers] for w in range(n_workers)]
+        for w in range(worker_id):
+            quota -= min(quota, sum(shard['length'] for shard in worker_shards[w]))
+        shards = worker_shards[worker_id]
+        quota = min(quota, sum(shard['length'] for shard in shards))
+
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank, worker_id])
+        buffer = []
+        n_yielded = 0
+        for shard in shards:
+            if n_yielded + len(buffer) >= quota:
+                break
+            for sample in self._read_shard(shard['name']):
+                if n_yielded + len(buffer) >= quota:
+                    break
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = rng.randint(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                n_yielded += 1
+                yield sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
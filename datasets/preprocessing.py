@@ -1,8 +1,77 @@
-import cv2
 import numpy as np
 import torch
-from torch.nn.utils.rnn import pad_sequence
-from torchvision.transforms import functional as F
+from torch.nn import functional as F
+from geometry import rasterize_boxes
+
+
+# Batches stay padded from collate_fn to the model: every object field is a (B, L, ...) tensor whose entries
+# at or past batch['length'] are zero.
+object_fields = ['category', 'location', 'bbox', 'velocity']
+
+
+def _valid_mask(length, L):
+    # length: (B, ), returns (B, L) with True for real entries
+    return torch.arange(L, device=length.device)[None] < length[:, None]
+
+
+def _gather_objects(batch, order, length):
+    # reorder the object fields along dim 1 and zero every entry past the new length
+    valid = _valid_mask(length, order.size(1))
+    for field in object_fields:
+        x = batch[field]
+        extra = x.shape[2:]
+        idx = order.reshape(*order.shape, *([1] * len(extra))).expand(*order.shape, *extra)
+        x = x.gather(1, idx)
+        batch[field] = x * valid.reshape(*valid.shape, *([1] * len(extra)))
+    batch['length'] = length
+    return batch
+
+
+def _rotate_batch(batch, axes_limit, orientation_layer):
+    # rotate every sample by its own random angle
+    maps = batch['map']
+    B = maps.size(0)
+    device = maps.device
+    rad = torch.rand(B, device=device) * 2 * np.pi
+    cos, sin = torch.cos(rad), torch.sin(rad)
+    zeros = torch.zeros_like(rad)
+    # the same nearest-neighbour resampling grid as torchvision's F.rotate, batched over angles
+    theta = torch.stack([torch.stack([cos, -sin, zeros], dim=-1),
+                         torch.stack([sin, cos, zeros], dim=-1)], dim=1)  # (B, 2, 3)
+    grid = F.affine_grid(theta, list(maps.shape), align_corners=False)
+    maps = F.grid_sample(maps, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+    maps[:, orientation_layer] += rad[:, None, None]
+    batch['map'] = maps
+
+    rotation_mat = torch.stack([torch.stack([cos, sin], dim=-1),
+                                torch.stack([-sin, cos], dim=-1)], dim=1)  # (B, 2, 2)
+    batch['location'] = torch.bmm(batch['location'], rotation_mat)
+    batch['bbox'][..., -1] += rad[:, None]
+    batch['velocity'][..., -1] += rad[:, None]
+    # filter out objects fallen outside the image
+    location = batch['location']
+    keep = (location[..., 0] > -axes_limit) & \
+           (location[..., 0] < axes_limit) & \
+           (location[..., 1] > -axes_limit) & \
+           (location[..., 1] < axes_limit)
+    keep = keep & _valid_mask(batch['length'], keep.size(1))
+    # stable sort moves the kept objects to the front without changing their order
+    order = torch.sort((~keep).long(), dim=1, stable=True)[1]
+    return _gather_objects(batch, order, keep.sum(dim=1))
+
+
+def _sort_batch(batch):
+    # sort objects by (-y, x), keeping the end token after the last object
+    location = batch['location']
+    L = location.size(1)
+    is_object = _valid_mask(batch['length'] - 1, L)
+    inf = torch.tensor(float('inf'), device=location.device)
+    x = torch.where(is_object, location[..., 0], inf)
+    y = torch.where(is_object, -location[..., 1], inf)
+    # two stable passes give the lexicographic order: secondary key first, then primary key
+    order = torch.sort(x, dim=1, stable=True)[1]
+    order = order.gather(1, torch.sort(y.gather(1, order), dim=1, stable=True)[1])
+    return _gather_objects(batch, order, batch['length'])
 
 
 class AutoregressivePreprocessor:
@@ -35,31 +104,17 @@ class AutoregressivePreprocessor:
         return self
 
     def __call__(self, batch, *args, **kwargs):
-        B = len(batch['length'])
-        batch['map'] = batch['map'].to(self.device)
         for field in batch:
-            batch[field] = list(batch[field])
-        batch['length'] = [each.item() for each in batch['length']]
-        for field in ['category', 'location', 'bbox', 'velocity']:
-            for i in range(B):
-                batch[field][i] = batch[field][i][:batch['length'][i]]
+            batch[field] = batch[field].to(self.device)
 
         if self.state == 'train':
             batch, gt = self.train_process(batch, *args, **kwargs)
         else:
             batch, gt = self.test_process(batch, *args, **kwargs)
 
-        for field in ['category', 'location', 'bbox', 'velocity']:
-            batch[field] = pad_sequence(batch[field], batch_first=True)
-            batch[field] = batch[field].to(self.device)
-        lengths = torch.tensor(batch['length']).to(self.device)
-        del batch['length']
-        batch['map'] = torch.stack(batch['map'], dim=0)
-        for field in ['category', 'location', 'bbox', 'velocity']:
-            gt[field] = torch.stack(gt[field], dim=0)
-            gt[field] = gt[field].to(self.device)
+        lengths = batch.pop('length')
         return batch, lengths, gt
-    
+
     def train_process(self, batch, window_size=1):
         if self.scheduler is not None:
             window_size = self.scheduler(self.train_iters)
@@ -78,125 +133,91 @@ class AutoregressivePreprocessor:
         return batch, gt
 
     def _random_rotate(self, batch, rotate=True):
-        B = len(batch['length'])
-        for i in range(B):
-            deg = rad = rotation_mat = None
-            if rotate:
-                deg = np.random.rand() * 360
-                rad = deg / 180 * np.pi
-                rotation_mat = torch.tensor([[np.cos(rad), np.sin(rad)],
-                                             [-np.sin(rad), np.cos(rad)]],
-                                            dtype=torch.float32)
-                batch['map'][i] = F.rotate(batch['map'][i], deg)
-                batch['map'][i][6] += rad
-            # drivable_area, ped_crossing, walkway, carpark_area, lane, lane_divider, orientation
-            drivable_area = batch['map'][i][0]
-            ped_crossing = batch['map'][i][1]
-            walkway = batch['map'][i][2]
-            carpark_area = batch['map'][i][3]
-            lane = batch['map'][i][4]
-            lane_divider = batch['map'][i][5]
-            orientation = batch['map'][i][6]
-            batch['map'][i] = torch.stack([
-                drivable_area,
-                ped_crossing,
-                walkway,
-                carpark_area,
-                lane,
-                lane_divider,
-                torch.sin(orientation) * lane,
-                torch.cos(orientation) * lane
-            ], dim=0)
-            if rotate:
-                batch['location'][i] = batch['location'][i] @ rotation_mat
-                batch['bbox'][i][:, -1] += rad
-                batch['velocity'][i][:, -1] += rad
-                # filter out objects fallen outside the image
-                mask = (batch['location'][i][:, 0] > -self.axes_limit) & \
-                       (batch['location'][i][:, 0] < self.axes_limit) & \
-                       (batch['location'][i][:, 1] > -self.axes_limit) & \
-                       (batch['location'][i][:, 1] < self.axes_limit)
-                for field in ['category', 'location', 'bbox', 'velocity']:
-                    batch[field][i] = batch[field][i][mask]
-                batch['length'][i] = len(batch['category'][i])
+        if rotate:
+            batch = _rotate_batch(batch, self.axes_limit, orientation_layer=6)
+        # drivable_area, ped_crossing, walkway, carpark_area, lane, lane_divider, orientation
+        maps = batch['map']
+        lane = maps[:, 4]
+        orientation = maps[:, 6]
+        batch['map'] = torch.cat([
+            maps[:, :6],
+            (torch.sin(orientation) * lane)[:, None],
+            (torch.cos(orientation) * lane)[:, None]
+        ], dim=1)
         return batch
 
     def _sort_obj(self, batch):
-        B = len(batch['length'])
-        for i in range(B):
-            L = len(batch['category'][i])
-            idx = list(range(L - 1))
-            idx.sort(key=lambda x: (-batch['location'][i][x, 1], batch['location'][i][x, 0]))
-            idx.append(L - 1)  # append index for end token
-            for field in ['category', 'location', 'bbox', 'velocity']:
-                batch[field][i] = batch[field][i][idx]
-        return batch
+        return _sort_batch(batch)
 
     def _random_masking(self, batch, window_size=1, n_keep='random'):
-        B = len(batch['length'])
-        window_size = min(window_size, min(batch['length']))
+        length = batch['length']
+        B = length.size(0)
+        if window_size == 'all':
+            # teacher forcing over whole scenes: empty prefix, every object and the end token is a target
+            gt = {field: batch[field] for field in object_fields}
+            gt['length'] = length
+            order = torch.zeros((B, 0), dtype=torch.long, device=length.device)
+            batch = _gather_objects(batch, order, torch.zeros_like(length))
+            return batch, gt
+        window_size = min(window_size, length.min().item()) if B > 0 else window_size
         if n_keep == 'random':
-            keep_lengths = [np.random.randint(0, length - window_size + 1) for length in batch['length']]
+            keep_lengths = (torch.rand(B, device=length.device) * (length - window_size + 1)).long()
         elif n_keep == -1:
-            keep_lengths = [length - 1 for length in batch['length']]
+            keep_lengths = length - 1
         else:
-            keep_lengths = [min(n_keep, length) for length in batch['length']]
-        fields = ['category', 'location', 'bbox', 'velocity']
-        gt = {field: [] for field in fields}
-        for i in range(B):
-            length = keep_lengths[i]
-            batch['length'][i] = length
-            for field in fields:
-                all = batch[field][i]
-                batch[field][i] = all[:length]
-                gt[field].append(all[length:length + window_size])
+            # the end token never enters the prefix, so a scene shorter than n_keep keeps all its objects
+            keep_lengths = torch.minimum(length - 1, torch.full_like(length, n_keep)).clamp(min=0)
+        idx = keep_lengths[:, None] + torch.arange(window_size, device=length.device)  # (B, window_size)
+        # slots past a scene's length read an appended zero entry: padding with category 0, like the end token
+        L = batch['category'].size(1)
+        idx = torch.where(idx < length[:, None], idx, L)
+        gt = {}
+        for field in object_fields:
+            x = batch[field]
+            extra = x.shape[2:]
+            x = torch.cat([x, x.new_zeros(B, 1, *extra)], dim=1)
+            gt[field] = x.gather(1, idx.reshape(*idx.shape, *([1] * len(extra))).expand(*idx.shape, *extra))
+        L_keep = keep_lengths.max().item() if B > 0 else 0
+        order = torch.arange(L_keep, device=length.device).expand(B, -1)
+        batch = _gather_objects(batch, order, keep_lengths)
         return batch, gt
 
-    def _rasterize_object(self, batch):
-        B = len(batch['length'])
-        for i in range(B):
-            category = batch['category'][i].numpy()
-            location = batch['location'][i].numpy()
-            bbox = batch['bbox'][i].numpy()
-            velocity = batch['velocity'][i].numpy()
-            L = category.shape[0]
-            object_layers = {k: None for k in [1, 2, 3]}
-            for type_id in [1, 2, 3]:
-                object_layers[type_id] = {k: np.zeros((self.wl, self.wl), dtype=np.float32)
-                                          for k in ['occupancy', 'orientation', 'speed', 'heading']}
-            for j in range(L):
-                working_layers = object_layers[category[j]]
-                w, l, theta = bbox[j]
-                speed, heading = velocity[j]
-                corners = np.array([[l / 2, w / 2],
-                                    [-l / 2, w / 2],
-                                    [-l / 2, -w / 2],
-                                    [l / 2, -w / 2]])
-                rotation = np.array([[np.cos(theta), np.sin(theta)],
-                                     [-np.sin(theta), np.cos(theta)]])
-                corners = np.dot(corners, rotation) + location[j]
-                corners[:, 0] = corners[:, 0] + self.axes_limit
-                corners[:, 1] = self.axes_limit - corners[:, 1]
-                corners = np.floor(corners / self.resolution).astype(int)
-                cv2.fillConvexPoly(working_layers['occupancy'], corners, 1)
-                row = int((self.axes_limit - location[j, 1]) / self.resolution)
-                col = int((location[j, 0] + self.axes_limit) / self.resolution)
-                working_layers['orientation'][row, col] = theta
-                working_layers['speed'][row, col] = speed
-                working_layers['heading'][row, col] = heading
-            for type_id in [1, 2, 3]:
-                tmp = object_layers[type_id]
-                object_layers[type_id] = np.stack([
-                    tmp['occupancy'],
-                    np.sin(tmp['orientation']) * tmp['occupancy'],
-                    np.cos(tmp['orientation']) * tmp['occupancy'],
-                    tmp['speed'],
-                    np.sin(tmp['heading']) * tmp['occupancy'],
-                    np.cos(tmp['heading']) * tmp['occupancy']
-                ], axis=0)
-            object_layers = np.concatenate([object_layers[1], object_layers[2], object_layers[3]], axis=0)
-            object_layers = torch.tensor(object_layers, dtype=torch.float32).to(self.device)
-            batch['map'][i] = torch.cat([batch['map'][i], object_layers], dim=0)
+    def _rasterize_object(self, batch, chunk_size=16):
+        # object layers of the whole padded batch on the device, chunk_size object slots at a time
+        category, location, bbox, velocity = (batch[field] for field in object_fields)
+        B, L = category.shape
+        device = category.device
+        HW = self.wl * self.wl
+        real = _valid_mask(batch['length'], L) & (category > 0)  # (B, L)
+        occupancy = torch.zeros(B, 3, HW, dtype=torch.bool, device=device)
+        for start in range(0, L, chunk_size):
+            s = slice(start, start + chunk_size)
+            boxes = rasterize_boxes(location[:, s], bbox[:, s], self.wl, self.resolution).flatten(2)  # (B, l, HW)
+            for c in range(3):
+                of_c = real[:, s] & (category[:, s] == c + 1)
+                occupancy[:, c] |= (boxes & of_c[..., None]).any(dim=1)
+        # theta, speed and heading are written at the center pixel, the last object of a category winning
+        row = ((self.axes_limit - location[..., 1]) / self.resolution).long().clamp(0, self.wl - 1)
+        col = ((location[..., 0] + self.axes_limit) / self.resolution).long().clamp(0, self.wl - 1)
+        pixel = (category - 1).clamp(min=0) * HW + row * self.wl + col  # (B, L) in the (3, HW) layers
+        slot = torch.arange(L, device=device).expand(B, -1)
+        winner = torch.full((B, 3 * HW), -1, dtype=torch.long, device=device)
+        winner.scatter_reduce_(1, pixel, torch.where(real, slot, -1), reduce='amax')
+        written = winner >= 0
+        winner = winner.clamp(min=0)
+        values = torch.stack([bbox[..., 2], velocity[..., 0], velocity[..., 1]], dim=-1)  # (B, L, 3)
+        values = values.gather(1, winner[..., None].expand(-1, -1, 3)) * written[..., None]
+        orientation, speed, heading = values.reshape(B, 3, HW, 3).unbind(-1)
+        occupancy = occupancy.float()
+        object_layers = torch.stack([
+            occupancy,
+            torch.sin(orientation) * occupancy,
+            torch.cos(orientation) * occupancy,
+            speed,
+            torch.sin(heading) * occupancy,
+            torch.cos(heading) * occupancy
+        ], dim=2).reshape(B, 18, self.wl, self.wl)
+        batch['map'] = torch.cat([batch['map'], object_layers], dim=1)
         return batch
 
 
@@ -228,22 +249,8 @@ class DiffusionModelPreprocessor:
         return self
 
     def __call__(self, batch):
-        B = len(batch['length'])
-        batch['map'] = batch['map'].to(self.device)
         for field in batch:
-            batch[field] = list(batch[field])
-        # remove padding
-        batch['length'] = [each.item() for each in batch['length']]
-        for field in ['category', 'location', 'bbox', 'velocity']:
-            for i in range(B):
-                batch[field][i] = batch[field][i][:batch['length'][i]]
-        for name in ['pedestrian', 'bicyclist', 'vehicle']:
-            batch[name] = {
-                'length': [],
-                'location': [],
-                'bbox': [],
-                'velocity': []
-            }
+            batch[field] = batch[field].to(self.device)
 
         if self.state == 'train':
             batch = self.train_process(batch)
@@ -251,12 +258,7 @@ class DiffusionModelPreprocessor:
             batch = self.test_process(batch)
 
         for name in ['pedestrian', 'bicyclist', 'vehicle']:
-            for field in ['location', 'bbox', 'velocity']:
-                batch[name][field] = pad_sequence(batch[name][field], batch_first=True)
-                batch[name][field] = batch[name][field].to(self.device)
-            batch[name]['length'] = torch.tensor(batch[name]['length']).to(self.device)
             batch[name]['location'] = batch[name]['location'] / self.axes_limit
-        batch['map'] = torch.stack(batch['map'], dim=0)
         return batch
 
     def train_process(self, batch):
@@ -273,73 +275,50 @@ class DiffusionModelPreprocessor:
         return batch
 
     def _random_rotate(self, batch, rotate=True):
-        B = len(batch['length'])
-        for i in range(B):
-            deg = rad = rotation_mat = None
-            if rotate:
-                deg = np.random.rand() * 360
-                rad = deg / 180 * np.pi
-                rotation_mat = torch.tensor([[np.cos(rad), np.sin(rad)],
-                                             [-np.sin(rad), np.cos(rad)]],
-                                            dtype=torch.float32)
-                batch['map'][i] = F.rotate(batch['map'][i], deg)
-                batch['map'][i][6] += rad
-            # drivable_area, ped_crossing, walkway, dist_map, carpark_area, lane, lane_divider, orientation
-            drivable_area = batch['map'][i][0]
-            ped_crossing = batch['map'][i][1]
-            walkway = batch['map'][i][2]
-            dist_map = batch['map'][i][3]
-            carpark_area = batch['map'][i][4]
-            lane = batch['map'][i][5]
-            lane_divider = batch['map'][i][6]
-            orientation = batch['map'][i][7]
-            batch['map'][i] = torch.stack([
-                drivable_area,
-                ped_crossing,
-                walkway,
-                dist_map,
-                lane_divider,
-            ], dim=0)
-            if rotate:
-                batch['location'][i] = batch['location'][i] @ rotation_mat
-                batch['bbox'][i][:, -1] += rad
-                batch['velocity'][i][:, -1] += rad
-                # filter out objects fallen outside the image
-                mask = (batch['location'][i][:, 0] > -self.axes_limit) & \
-                       (batch['location'][i][:, 0] < self.axes_limit) & \
-                       (batch['location'][i][:, 1] > -self.axes_limit) & \
-                       (batch['location'][i][:, 1] < self.axes_limit)
-                for field in ['category', 'location', 'bbox', 'velocity']:
-                    batch[field][i] = batch[field][i][mask]
-                batch['length'][i] = len(batch['category'][i])
+        if rotate:
+            batch = _rotate_batch(batch, self.axes_limit, orientation_layer=7)
+        # drivable_area, ped_crossing, walkway, dist_map, carpark_area, lane, lane_divider, orientation
+        maps = batch['map']
+        batch['map'] = torch.stack([
+            maps[:, 0],  # drivable_area
+            maps[:, 1],  # ped_crossing
+            maps[:, 2],  # walkway
+            maps[:, 3],  # dist_map
+            maps[:, 6],  # lane_divider
+        ], dim=1)
         return batch
 
     def _sort_obj(self, batch):
-        B = len(batch['length'])
-        for i in range(B):
-            L = len(batch['category'][i])
-            idx = list(range(L - 1))
-            idx.sort(key=lambda x: (-batch['location'][i][x, 1], batch['location'][i][x, 0]))
-            idx.append(L - 1)  # append index for end token
-            for field in ['category', 'location', 'bbox', 'velocity']:
-                batch[field][i] = batch[field][i][idx]
-        return batch
+        return _sort_batch(batch)
 
     def _split_obj(self, batch):
-        B = len(batch['length'])
         mapping = {
             1: 'pedestrian',
             2: 'bicyclist',
             3: 'vehicle'
         }
-        for i in range(B):
-            for category in [1, 2, 3]:
-                mask = (batch['category'][i] == category)
-                name = mapping[category]
-                batch[name]['length'].append(sum(mask).item())
-                batch[name]['location'].append(batch['location'][i][mask])
-                batch[name]['bbox'].append(batch['bbox'][i][mask])
-                batch[name]['velocity'].append(batch['velocity'][i][mask])
+        # padding and end tokens both fall into category 0 and are never selected
+        category = batch['category']  # (B, L)
+        B, L = category.shape
+        # a stable sort groups the objects by category and keeps their spatial order within each group
+        category, order = torch.sort(category, dim=1, stable=True)
+        fields = {}
+        for field in ['location', 'bbox', 'velocity']:
+            padded = batch[field]  # (B, L, C)
+            fields[field] = padded.gather(1, order[..., None].expand_as(padded))
+        offset = torch.arange(B, device=category.device)[:, None] * 4
+        counts = torch.bincount((category + offset).flatten(), minlength=B * 4).reshape(B, 4)  # (B, 4)
+        starts = counts.cumsum(dim=1) - counts  # first sorted index of each category
+        max_counts = counts.max(dim=0)[0].tolist()  # single host sync for all output shapes
+        for category_id, name in mapping.items():
+            length = counts[:, category_id]
+            idx = torch.arange(max_counts[category_id], device=category.device).expand(B, -1)
+            valid = idx < length[:, None]  # (B, L_c)
+            idx = (idx + starts[:, category_id:category_id + 1]).clamp(max=max(L - 1, 0))
+            batch[name] = {'length': length}
+            for field, padded in fields.items():
+                split = padded.gather(1, idx[..., None].expand(-1, -1, padded.size(-1)))
+                batch[name][field] = split * valid[..., None]
         del batch['length']
         del batch['category']
         del batch['location']
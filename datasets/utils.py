@@ -34,6 +34,50 @@ def cartesian_to_polar(vector: np.array) -> np.array:
     return np.array([rho, theta])
 
 
+# one row per processed sample, used to select training and evaluation subsets without loading samples
+scenario_dtype = np.dtype([
+    ('token', 'U32'),
+    ('location', 'U32'),  # map name, empty if unknown
+    ('ego_x', 'f8'),
+    ('ego_y', 'f8'),
+    ('ego_yaw', 'f8'),
+    ('n_pedestrian', 'i4'),
+    ('n_bicyclist', 'i4'),
+    ('n_vehicle', 'i4'),
+    ('n_moving', 'i4'),
+    ('n_moving_vehicle', 'i4'),
+    ('mean_speed', 'f4'),
+    ('max_speed', 'f4'),
+    ('drivable_fraction', 'f4'),
+    ('ped_crossing_fraction', 'f4'),
+])
+
+
+def scenario_record(token: str,
+                    category: np.array,
+                    velocity: np.array,
+                    drivable_area: np.array,
+                    ped_crossing: np.array,
+                    location: str = '',
+                    ego_pose: tuple = (np.nan, np.nan, np.nan),
+                    moving_threshold: float = 0.5) -> tuple:
+    category = np.asarray(category)
+    speed = np.asarray(velocity, dtype=np.float64).reshape(-1, 2)[category > 0, 0]
+    moving = speed > moving_threshold
+    return (token,
+            location,
+            *ego_pose,
+            (category == 1).sum(),
+            (category == 2).sum(),
+            (category == 3).sum(),
+            moving.sum(),
+            (moving & (category[category > 0] == 3)).sum(),
+            speed.mean() if len(speed) else 0.,
+            speed.max() if len(speed) else 0.,
+            (np.asarray(drivable_area) > 0).mean(),
+            (np.asarray(ped_crossing) > 0).mean())
+
+
 def collate_fn(samples):
     batch = {}
     batch['map'] = torch.stack([sample['map'] for sample in samples], dim=0)
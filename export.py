@@ -0,0 +1,83 @@
+import time
+import argparse
+import torch
+from networks.autoregressive_transformer import AutoregressiveTransformer
+from networks.diffusion_models import DiffusionBasedModel
+from networks.export import (export_autoregressive, export_diffusion, load_exported, ARMapEncoder, ARStepEncoder,
+                             ARLocationHead, DiffusionMapEncoder, DiffusionDenoiser)
+
+
+def latency(fn, inputs, n_iters):
+    with torch.no_grad():
+        fn(*inputs)  # warm-up
+        start = time.time()
+        for _ in range(n_iters):
+            fn(*inputs)
+    return (time.time() - start) / n_iters * 1000
+
+
+def compare(name, eager, exported, inputs, n_iters):
+    # the exported graph has to give the eager outputs before its latency means anything
+    with torch.no_grad():
+        torch.testing.assert_close(exported(*inputs), eager(*inputs), rtol=1e-4, atol=1e-4,
+                                   msg=lambda m: f'{name}: exported graph differs from eager\n{m}')
+    t_eager = latency(eager, inputs, n_iters)
+    t_exported = latency(exported, inputs, n_iters)
+    print(f'{name:>24}: eager {t_eager:.1f} ms, exported {t_exported:.1f} ms ({t_eager / t_exported:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', choices=['ar', 'diffusion'], default='ar')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--output', default='exported')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--buckets', type=int, nargs='+', default=None)
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    B = args.batch_size
+    if args.model == 'ar':
+        model = AutoregressiveTransformer()
+    else:
+        model = DiffusionBasedModel(time_steps=1000)
+    if args.ckpt is not None:
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+    model = model.eval()
+
+    # CPU latency of the training modules run as they are against the exported graphs
+    if args.model == 'ar':
+        buckets = args.buckets or [8, 16, 32, 64, 128]
+        export_autoregressive(model, args.output, batch_size=B, buckets=buckets)
+        exported = load_exported(args.output, 'ar')
+        maps = torch.rand(B, 26, 320, 320)
+        compare('map encoder', ARMapEncoder(model), exported['map_encoder'], (maps, ), args.iters)
+        with torch.no_grad():
+            map_f = ARMapEncoder(model)(maps)
+        for L in buckets:
+            inputs = (map_f,
+                      torch.randint(1, 4, (B, L)),
+                      torch.randint(0, 320 * 320, (B, L)),
+                      torch.rand(B, L, 3) * 4,
+                      torch.rand(B, L, 2),
+                      torch.full((B, ), L, dtype=torch.long))
+            compare(f'step encoder L={L}', ARStepEncoder(model), exported['step'][L], inputs, args.iters)
+        output_f = torch.randn(B, model.d_model)
+        compare('location head', ARLocationHead(model.decoder_vehicle), exported['vehicle_location'],
+                (output_f, map_f), args.iters)
+    else:
+        buckets = args.buckets or [32, 64, 128, 256, 384]
+        export_diffusion(model, args.output, batch_size=B, buckets=buckets)
+        exported = load_exported(args.output, 'diffusion')
+        maps = torch.rand(B, 9, 320, 320)
+        compare('map encoder', DiffusionMapEncoder(model), exported['map_encoder'], (maps, ), args.iters)
+        with torch.no_grad():
+            fmap = DiffusionMapEncoder(model)(maps)[0]
+        for L in buckets:
+            pos = torch.rand(B, L, 2) * 2 - 1
+            category = torch.arange(L).expand(B, L) * 3 // L
+            inputs = (pos, pos.clone(), category, fmap, torch.rand(B), torch.zeros(B, L, dtype=torch.bool))
+            compare(f'denoiser L={L}', DiffusionDenoiser(model), exported['denoiser'][L], inputs, args.iters)
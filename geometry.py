@@ -0,0 +1,18 @@
+import torch
+
+
+def rasterize_boxes(location, bbox, size=320, resolution=0.25):
+    # location: (..., 2) box centers in meters, bbox: (..., 3) as (w, l, theta)
+    # returns the (..., size, size) occupancy in the frame of the map layers, row 0 at the top (y = +axes_limit)
+    # a pixel is occupied if its center is within half a pixel of the box, like filling the floored corners
+    axes_limit = size * resolution / 2
+    centers = (torch.arange(size, device=location.device, dtype=location.dtype) + 0.5) * resolution
+    dx = (centers - axes_limit) - location[..., 0:1]  # (..., size) along the columns
+    dy = (axes_limit - centers) - location[..., 1:2]  # (..., size) along the rows
+    cos = torch.cos(bbox[..., 2:3])[..., None]
+    sin = torch.sin(bbox[..., 2:3])[..., None]
+    # coordinates of every pixel center along the length and the width of the box
+    a = dx[..., None, :] * cos + dy[..., :, None] * sin  # (..., size, size)
+    b = dy[..., :, None] * cos - dx[..., None, :] * sin
+    margin = resolution / 2
+    return (a.abs() <= bbox[..., 1:2, None] / 2 + margin) & (b.abs() <= bbox[..., 0:1, None] / 2 + margin)
@@ -22,6 +22,8 @@ os.environ['MASTER_PORT'] = '5678'
 n_gpus = torch.cuda.device_count()
 n_epochs = 30
 batch_size = 12
+# opt-in: send each sample only through the decoder of its gt category
+route_decoders = False
 
 
 def main(rank, world_size):
@@ -36,9 +38,10 @@ def main(rank, world_size):
     dataloader = DataLoader(dataset, batch_size=batch_size // world_size, shuffle=False, collate_fn=collate_fn, sampler=sampler)
     preprocessor = AutoregressivePreprocessor('cpu').train()
 
-    model = AutoregressiveTransformer()
+    model = AutoregressiveTransformer(route_decoders=route_decoders)
     model = model.to(device)
-    model = DistributedDataParallel(model, device_ids=[rank])
+    # a routed batch may not contain every category, leaving a decoder without gradients
+    model = DistributedDataParallel(model, device_ids=[rank], find_unused_parameters=route_decoders)
     optimizer = Adam(model.parameters(), lr=1e-3)
     scheduler = LambdaLR(optimizer, lr_func(4000))
 
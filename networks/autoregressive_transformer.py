@@ -6,24 +6,174 @@
 #          Andreas Geiger, Sanja Fidler
 # 
 
-import math
 import torch
 import torch.nn as nn
-from torch.distributions import Categorical, Bernoulli, LogNormal, VonMises, Independent, MixtureSameFamily
-from .utils import get_mlp, get_length_mask
+from torch.nn import functional as F
+from torch.distributions import Categorical, Bernoulli
+from geometry import rasterize_boxes
+from .utils import get_mlp, get_length_mask, checkpointed, set_checkpointing
 from .embeddings import FixedPositionalEncoding, TrainablePE
-from .feature_extractors import Extractor
+from .feature_extractors import Extractor, SplitExtractor
 from .losses import WeightedNLL
-from torch.nn.utils.rnn import pad_sequence
-import numpy as np
-import cv2
+from .mixtures import MixtureLogNormal, MixtureVonMises
+from .packing import PackedSequences, packed_encoder
+from .kv_cache import KVCache, cached_encoder
+from .collision import CollisionIndex, clamp_box_size
+
+
+class CoarseToFineLocation:
+    """
+    Distribution over the size x size location pixels as a categorical over coarse cells of cell x cell pixels
+    times a categorical over the pixels of the coarse cell. fine_fn(coarse) gives the (..., N, cell * cell)
+    logits of the coarse cells asked for, so fine logits are only computed where they are needed.
+    blocked: (N, size * size) pixels excluded from sampling, ignored where it would exclude everything.
+    """
+
+    def __init__(self, coarse_logits, fine_fn, cell=8, size=320, blocked=None):
+        # coarse_logits: (N, (size // cell) ** 2)
+        self.fine_fn = fine_fn
+        self.cell = cell
+        self.size = size
+        self.n_cells = size // cell
+        self.blocked_fine = None
+        if blocked is not None:
+            N = blocked.size(0)
+            blocked = blocked.reshape(N, self.n_cells, cell, self.n_cells, cell).permute(0, 1, 3, 2, 4)
+            self.blocked_fine = blocked.reshape(N, self.n_cells ** 2, cell * cell)
+            blocked_coarse = self.blocked_fine.all(dim=-1)  # (N, n_cells ** 2)
+            coarse_logits = torch.where(blocked_coarse.all(dim=-1, keepdim=True),
+                                        coarse_logits,
+                                        coarse_logits.masked_fill(blocked_coarse, float('-inf')))
+        self.coarse_logits = coarse_logits
+        self.batch_shape = coarse_logits.shape[:-1]
+
+    def _fine_logits(self, coarse):
+        # coarse: (..., N)
+        logits = self.fine_fn(coarse)  # (..., N, cell * cell)
+        if self.blocked_fine is not None:
+            blocked = self.blocked_fine.expand(*coarse.shape[:-1], *self.blocked_fine.shape)
+            blocked = blocked.gather(-2, coarse[..., None, None].expand(*coarse.shape, 1, logits.size(-1)))
+            blocked = blocked.squeeze(-2)
+            logits = torch.where(blocked.all(dim=-1, keepdim=True), logits, logits.masked_fill(blocked, float('-inf')))
+        return logits
+
+    def _split(self, location):
+        row = torch.div(location, self.size, rounding_mode='trunc')
+        col = location - row * self.size
+        coarse = torch.div(row, self.cell, rounding_mode='trunc') * self.n_cells + \
+            torch.div(col, self.cell, rounding_mode='trunc')
+        fine = (row % self.cell) * self.cell + col % self.cell
+        return coarse, fine
+
+    def _join(self, coarse, fine):
+        row = torch.div(coarse, self.n_cells, rounding_mode='trunc') * self.cell + \
+            torch.div(fine, self.cell, rounding_mode='trunc')
+        col = (coarse % self.n_cells) * self.cell + fine % self.cell
+        return row * self.size + col
+
+    def log_prob(self, location):
+        # location: (..., N), exact log p(coarse) + log p(fine | coarse)
+        coarse, fine = self._split(location)
+        log_coarse = torch.log_softmax(self.coarse_logits, dim=-1)
+        log_coarse = log_coarse.expand(*coarse.shape, log_coarse.size(-1)).gather(-1, coarse[..., None])
+        log_fine = torch.log_softmax(self._fine_logits(coarse), dim=-1).gather(-1, fine[..., None])
+        return (log_coarse + log_fine).squeeze(-1)
+
+    def sample(self, sample_shape=torch.Size()):
+        coarse = Categorical(logits=self.coarse_logits, validate_args=False).sample(sample_shape)  # (..., N)
+        fine = Categorical(logits=self._fine_logits(coarse), validate_args=False).sample()
+        return self._join(coarse, fine)
+
+    def mode(self):
+        # most likely cell, then the most likely pixel within it
+        coarse = self.coarse_logits.argmax(dim=-1)
+        return self._join(coarse, self._fine_logits(coarse).argmax(dim=-1))
+
+
+class SparseLocation:
+    """
+    Categorical distribution over a candidate set of location pixels per row, normalized over the candidates
+    only. Samples and log_prob arguments are pixel indices; pixels outside the candidates have log_prob -inf.
+    """
+
+    def __init__(self, logits, pixels, rank):
+        # logits: (N, M), -inf at the padding, pixels: (N, M) candidate pixels,
+        # rank: (N, size * size) position of every pixel in pixels, -1 for the other pixels
+        self.categorical = Categorical(logits=logits, validate_args=False)
+        self.pixels = pixels
+        self.rank = rank
+        self.batch_shape = logits.shape[:1]
+
+    def log_prob(self, location):
+        # location: (..., N)
+        rows = torch.arange(location.size(-1), device=location.device)
+        rank = self.rank[rows, location]
+        log_prob = self.categorical.log_prob(rank.clamp(min=0))
+        return torch.where(rank >= 0, log_prob, torch.full_like(log_prob, float('-inf')))
+
+    def sample(self, sample_shape=torch.Size()):
+        rank = self.categorical.sample(sample_shape)  # (..., N)
+        rows = torch.arange(rank.size(-1), device=rank.device)
+        return self.pixels[rows, rank]
+
+    def mode(self):
+        return self.pixels.gather(1, self.categorical.logits.argmax(dim=-1, keepdim=True)).squeeze(1)
+
+
+class LocationLogits:
+    """
+    log p(location) of full resolution location logits for the loss only, as one fused cross entropy instead of
+    normalizing all logits into a Categorical first.
+    """
+
+    def __init__(self, logits):
+        # logits: (N, 320 * 320)
+        self.logits = logits
+        self.batch_shape = logits.shape[:1]
+
+    def log_prob(self, location):
+        # location: (N, )
+        return -F.cross_entropy(self.logits, location, reduction='none')
+
+
+def _pixel_list(mask):
+    # mask: (N, P) -> (N, M) indices of the True entries of every row in increasing order, padded with 0,
+    # (N, M) which of them are real and (N, P) rank of every entry among them, -1 where mask is False
+    # M is the largest row count, read back to the host: one sync per call, so sparse location decoding
+    # syncs twice per decode
+    N, P = mask.shape
+    rank = mask.long().cumsum(dim=1) - 1
+    count = rank[:, -1] + 1
+    M = max(count.max().item(), 1)
+    pixels = torch.zeros(N, M + 1, dtype=torch.long, device=mask.device)
+    # entries that are not in the list all go to the extra column M
+    pixels.scatter_(1, torch.where(mask, rank, M), torch.arange(P, device=mask.device).expand(N, P))
+    valid = torch.arange(M, device=mask.device) < count[:, None]
+    return pixels[:, :M], valid, torch.where(mask, rank, -1)
+
+
+def _masked_batch_norm(bn, x, valid):
+    # bn: nn.BatchNorm2d applied to the (N, M, C) feature vectors where valid: (N, M), statistics over those only
+    out = torch.zeros_like(x)
+    out[valid] = bn(x[valid][..., None, None])[..., 0, 0].to(x.dtype)
+    return out
 
 
 class Decoder(nn.Module):
-    def __init__(self, d_model=768, n_mixture=8):
+    checkpoint_group = 'decoder'
+
+    def __init__(self, d_model=768, n_mixture=8, hierarchical=False, cell=8, roi_layers=()):
         super(Decoder, self).__init__()
+        # recompute the location stack in backward instead of keeping its full resolution activations
+        self.checkpoint = False
         self.d_model = d_model
         self.n_mixture = n_mixture
+        # map layers where objects of this decoder's category can be placed, used by sparse location decoding
+        self.roi_layers = roi_layers
+        # hierarchical: self.location scores cells of cell x cell pixels on average pooled map features,
+        # self.location_fine the pixels of one cell
+        self.hierarchical = hierarchical
+        self.cell = cell
         self.location = nn.Sequential(
             nn.Conv2d(in_channels=self.d_model + 128, out_channels=128, kernel_size=(3, 3), padding=(1, 1)),
             nn.BatchNorm2d(128),
@@ -33,20 +183,125 @@ class Decoder(nn.Module):
             nn.ReLU(inplace=True),
             nn.Conv2d(in_channels=64, out_channels=1, kernel_size=(1, 1))
         )
+        if hierarchical:
+            self.location_fine = nn.Sequential(
+                # on the cell and a one pixel border around it
+                nn.Conv2d(in_channels=self.d_model + 128, out_channels=64, kernel_size=(3, 3)),
+                nn.BatchNorm2d(64),
+                nn.ReLU(inplace=True),
+                nn.Conv2d(in_channels=64, out_channels=64, kernel_size=(1, 1)),
+                nn.BatchNorm2d(64),
+                nn.ReLU(inplace=True),
+                nn.Conv2d(in_channels=64, out_channels=1, kernel_size=(1, 1))
+            )
         self.wl = get_mlp(128, (1 + 2 + 2) * self.n_mixture)
         self.theta = get_mlp(128, (1 + 2 + 1) * self.n_mixture)
         self.moving = get_mlp(128 + 192, 1)
         self.s = get_mlp(128 + 192, (1 + 1 + 1) * self.n_mixture)
         self.omega = get_mlp(128 + 192, (1 + 2 + 1) * self.n_mixture)
 
-    def forward(self, f, field):
+    def _location(self, f, map_f, index=None):
+        # f: (N, d_model), map_f: (B, 128, H, W), index: (N, ) map of each row of f, None if N == B
+        # The first conv sees [f broadcast over the image, map_f]. Since f is spatially constant its part of
+        # the conv is a per-tap projection of f, summed over the taps that fall inside the image; only the
+        # map part needs a real convolution, once per map.
+        conv = self.location[0]
+        w_scene, w_map = conv.weight.split([self.d_model, conv.in_channels - self.d_model], dim=1)
+        if index is not None and index.size(0) < map_f.size(0):
+            # a sub-batch of the maps, e.g. one category in routed decoding
+            h = F.conv2d(map_f[index], w_map, conv.bias, padding=conv.padding)  # (N, 128, 320, 320)
+        else:
+            h = F.conv2d(map_f, w_map, conv.bias, padding=conv.padding)  # (B, 128, 320, 320)
+            if index is not None:
+                h = h[index]
+        taps = torch.einsum('odkl,nd->nokl', w_scene, f)  # (N, 128, k, k)
+        H, W = h.shape[-2:]
+        rows = torch.arange(H, device=f.device)[:, None] + torch.arange(conv.kernel_size[0], device=f.device)
+        rows = rows - conv.padding[0]
+        cols = torch.arange(W, device=f.device)[:, None] + torch.arange(conv.kernel_size[1], device=f.device)
+        cols = cols - conv.padding[1]
+        valid_rows = ((rows >= 0) & (rows < H)).to(f.dtype)  # (H, k)
+        valid_cols = ((cols >= 0) & (cols < W)).to(f.dtype)  # (W, k)
+        h = h + torch.einsum('nokl,rk,cl->norc', taps, valid_rows, valid_cols)
+        out = self.location[1:](h)  # (N, 1, H, W)
+        return out.flatten(1)  # (N, H * W)
+
+    def _location_fine(self, f, map_f, index, coarse):
+        # f: (M, d_model), map_f: (B, 128, 320, 320), index: (M, ), coarse: (M, ) cell of every row
+        # f is constant over the patch and the conv has no padding, so its part is the sum of all taps
+        conv = self.location_fine[0]
+        w_scene, w_map = conv.weight.split([self.d_model, conv.in_channels - self.d_model], dim=1)
+        n_cells = map_f.size(-1) // self.cell
+        offset = torch.arange(self.cell + 2, device=f.device)
+        rows = torch.div(coarse, n_cells, rounding_mode='trunc')[:, None] * self.cell + offset  # (M, cell + 2)
+        cols = (coarse % n_cells)[:, None] * self.cell + offset
+        padded = F.pad(map_f, (1, 1, 1, 1))
+        patch = padded[index[:, None, None], :, rows[:, :, None], cols[:, None, :]]  # (M, cell + 2, cell + 2, 128)
+        h = F.conv2d(patch.permute(0, 3, 1, 2), w_map, conv.bias)  # (M, 64, cell, cell)
+        h = h + (f @ w_scene.sum(dim=(2, 3)).t())[..., None, None]
+        out = self.location_fine[1:](h)  # (M, 1, cell, cell)
+        return out.flatten(1)  # (M, cell * cell)
+
+    def _location_sparse(self, f, map_f, index, roi):
+        # f: (N, d_model), map_f: (B, 128, H, W), index: (N, ), roi: (N, H * W) candidate pixels of every row
+        # The location stack evaluated at the candidates only. The second conv needs the first one at the
+        # candidates and their neighbours; its map part is still one dense conv per map, the per row part
+        # (scene taps, batch norms, second and third conv) only runs on those pixels.
+        # Returns (N, M) logits, -inf at the padding, (N, M) candidate pixels and (N, H * W) their rank.
+        N = f.size(0)
+        B, C, H, W = map_f.shape
+        conv1, bn1, _, conv2, bn2, _, conv3 = self.location
+        w_scene, w_map = conv1.weight.split([self.d_model, C], dim=1)
+        # kernel taps in row major order
+        dr = torch.arange(-1, 2, device=f.device).repeat_interleave(3)
+        dc = torch.arange(-1, 2, device=f.device).repeat(3)
+
+        def neighbours(p):
+            # p: (N, P) pixels -> (N, P, 9) pixels under the kernel taps and whether they are inside the map
+            r = torch.div(p, W, rounding_mode='trunc')[..., None] + dr
+            c = (p % W)[..., None] + dc
+            inside = (r >= 0) & (r < H) & (c >= 0) & (c < W)
+            return r.clamp(0, H - 1) * W + c.clamp(0, W - 1), inside
+
+        pixels, valid, rank = _pixel_list(roi)
+        near = F.max_pool2d(roi.reshape(N, 1, H, W).to(f.dtype), 3, stride=1, padding=1).flatten(1) > 0
+        near_pixels, near_valid, near_rank = _pixel_list(near)
+
+        # first conv on the candidates and their neighbours
+        if index.size(0) < B:
+            h = F.conv2d(map_f[index], w_map, conv1.bias, padding=conv1.padding).flatten(2)  # (N, 128, H * W)
+            h = h[torch.arange(N, device=f.device)[:, None], :, near_pixels]
+        else:
+            h = F.conv2d(map_f, w_map, conv1.bias, padding=conv1.padding).flatten(2)  # (B, 128, H * W)
+            h = h[index[:, None], :, near_pixels]  # (N, P, 128)
+        taps = torch.einsum('odk,nd->nko', w_scene.flatten(2), f)  # (N, 9, 128)
+        _, inside = neighbours(near_pixels)
+        h = h + torch.einsum('npk,nko->npo', inside.to(f.dtype), taps)
+        h = F.relu(_masked_batch_norm(bn1, h, near_valid))
+
+        # second conv on the candidates: project every near pixel by each tap, then gather the taps
+        P = h.size(1)
+        w2 = conv2.weight.permute(1, 2, 3, 0).reshape(conv2.in_channels, 9 * conv2.out_channels)
+        h = (h @ w2).reshape(N, P * 9, conv2.out_channels)
+        pos, inside = neighbours(pixels)  # (N, M, 9)
+        pos = near_rank.gather(1, pos.flatten(1)).reshape(pos.shape).clamp(min=0) * 9 + torch.arange(9, device=f.device)
+        h = h.gather(1, pos.flatten(1)[..., None].expand(-1, -1, h.size(-1))).reshape(*pos.shape, -1)
+        h = torch.where(inside[..., None], h, torch.zeros_like(h)).sum(dim=2) + conv2.bias  # (N, M, 64)
+        h = F.relu(_masked_batch_norm(bn2, h, valid))
+        out = h @ conv3.weight.flatten(1).t() + conv3.bias  # (N, M, 1)
+        return out.squeeze(-1).masked_fill(~valid, float('-inf')), pixels, rank
+
+    def forward(self, f, field, map_f=None, index=None, coarse=None, roi=None):
         if field == 'location':
-            # f: (B, 320 * 320, d_model + 128)
-            B, _, n_feature = f.shape
-            f = f.permute([0, 2, 1]).reshape(B, n_feature, 320, 320).contiguous()  # (B, n_feature, 320, 320)
-            out = self.location(f)  # (B, 1, 320, 320)
-            out = out.flatten(1)  # (B, 320 * 320)
-            return out
+            # f: (N, d_model), map_f: (B, 128, 320, 320)
+            if self.hierarchical:
+                map_f = F.avg_pool2d(map_f, self.cell)
+            return checkpointed(self, self._location, f, map_f, index)  # (N, 320 * 320) or (N, (320 // cell) ** 2)
+        if field == 'location_fine':
+            return checkpointed(self, self._location_fine, f, map_f, index, coarse)
+        if field == 'location_sparse':
+            # roi: (N, 320 * 320) -> (N, M) logits, (N, M) pixels, (N, 320 * 320) rank
+            return checkpointed(self, self._location_sparse, f, map_f, index, roi)
         if field == 'wl':
             # f: (B, 128)
             out = self.wl(f)
@@ -66,7 +321,9 @@ class Decoder(nn.Module):
 
 
 class AutoregressiveTransformer(nn.Module):
-    def __init__(self):
+    def __init__(self, max_supervised_steps=None, route_decoders=False, split_extractor=False,
+                 hierarchical_location=False, packed_attention=False, checkpoint=(), causal=False,
+                 sparse_location=False):
         super().__init__()
         # Build a transformer encoder
         self.transformer_encoder = nn.Transformer(
@@ -81,7 +338,11 @@ class AutoregressiveTransformer(nn.Module):
         self.q = nn.Parameter(torch.randn(self.d_model))
 
         # extract features from maps
-        self.feature_extractor = Extractor(26)
+        if split_extractor:
+            # 8 static map channels encoded once per scene, 18 object channels re-encoded at every step
+            self.feature_extractor = SplitExtractor(8, 18, output_channels=128)
+        else:
+            self.feature_extractor = Extractor(26, output_channels=128)
 
         # Embedding matix for each category
         self.category_embedding = nn.Embedding(4, 64)
@@ -95,14 +356,27 @@ class AutoregressiveTransformer(nn.Module):
 
         # positional encoding for transformer input
         self.pe = TrainablePE(self.d_model)
+        # run the encoder on the real tokens only instead of the padded batch
+        self.packed_attention = packed_attention
+        # causal: every token attends to the query token and the objects before it, and objects are kept in the
+        # order they are placed in instead of being re-sorted, so generate_cached can reuse their keys and values;
+        # object tokens then read the features of the bare map, see _token_map_f
+        self.causal = causal
 
         # used for autoregressive decoding
         self.n_mixture = 8
         self.prob_category = get_mlp(self.d_model + 128, 4)  # categorical distribution
 
-        self.decoder_pedestrian = Decoder()
-        self.decoder_bicyclist = Decoder()
-        self.decoder_vehicle = Decoder()
+        # hierarchical_location: 40 x 40 cells of 8 x 8 pixels, then the pixel within the cell
+        self.hierarchical_location = hierarchical_location
+        # sparse_location: location logits only on the pixels of the map layers of each category, vehicles on
+        # drivable area, pedestrians and bicyclists on crossings and walkways, normalized over those pixels
+        if sparse_location and hierarchical_location:
+            raise ValueError('sparse_location does not support hierarchical_location')
+        self.sparse_location = sparse_location
+        self.decoder_pedestrian = Decoder(hierarchical=hierarchical_location, roi_layers=(1, 2))
+        self.decoder_bicyclist = Decoder(hierarchical=hierarchical_location, roi_layers=(1, 2))
+        self.decoder_vehicle = Decoder(hierarchical=hierarchical_location, roi_layers=(0, ))
 
         self.loss_fn = WeightedNLL(weights={
             'category': 0.1,
@@ -113,59 +387,57 @@ class AutoregressiveTransformer(nn.Module):
             's': 0.2,
             'omega': 0.2
         })
+        # caps the steps decoded per batch in teacher-forced sequence training, None supervises all of them
+        self.max_supervised_steps = max_supervised_steps
+        # in training, decode each step only with the decoder of its gt category instead of all three
+        self.route_decoders = route_decoders
+        # box proposals tested against the placed objects at once for every object in generation
+        self.n_box_candidates = 32
+        # with n_sample > 1, take the mode of every head directly instead of the most likely of n_sample samples;
+        # the box falls back to sampled candidates only if its mode overlaps a placed object
+        self.mode_decoding = False
+        # activation checkpointing, any of 'extractor' and 'decoder'
+        set_checkpointing(self, checkpoint)
 
     def _discrete_loc(self, loc):
         row = ((40 - loc[..., 1]) / 0.25).long()
         col = ((loc[..., 0] + 40) / 0.25).long()
         return row * 320 + col
 
-    def _smooth_loc(self, loc):
+    def _smooth_loc(self, loc, jitter=True):
+        # uniform within the pixel, or its center without jitter
         row = torch.div(loc, 320, rounding_mode='trunc')
         col = loc - row * 320
         x = col * 0.25 - 40
-        x = x + torch.rand(*x.shape).to(x.device) * 0.25
+        x = x + (torch.rand(x.shape, device=x.device) if jitter else 0.5) * 0.25
         y = 40 - row * 0.25
-        y = y + torch.rand(*y.shape).to(y.device) * 0.25
+        y = y + (torch.rand(y.shape, device=y.device) if jitter else 0.5) * 0.25
         return torch.stack([x, y], dim=-1)
 
     def _mix_lognormal(self, f, event_shape):
         # f: (B, (1 + event_shape * 2) * self.n_mixture)
         B = f.shape[0]
-        mixture = Categorical(logits=f[..., :self.n_mixture])
+        logits = f[..., :self.n_mixture]
         f = f[..., self.n_mixture:].reshape(B, self.n_mixture, 2 * event_shape)
         mu = f[..., :event_shape]
         sigma = torch.sigmoid(torch.clamp(f[..., event_shape:], min=-5)) * 0.5
-        prob = LogNormal(mu, sigma)  # batch_shape = (B, n_mixture, event_shape)
-        prob = Independent(prob, reinterpreted_batch_ndims=1)  # batch_shape = (B, n_mixture)
-        prob = MixtureSameFamily(mixture, prob)  # batch_shape = B, event_shape
-        return prob
+        return MixtureLogNormal(logits, mu, sigma)  # batch_shape = B, event_shape
 
     def _mix_vonmises(self, f):
         # f: (B, (1 + 2 + 1) * self.n_mixture)
         B = f.shape[0]
-        mixture = Categorical(logits=f[..., :self.n_mixture])
+        logits = f[..., :self.n_mixture]
         f = f[..., self.n_mixture:].reshape(B, self.n_mixture, 3)
         cos = f[..., 0:1]
         sin = f[..., 1:2]
         kappa = 15 + torch.exp(torch.clamp(f[..., 2:3], max=5))
         norm = torch.sqrt(cos ** 2 + sin ** 2) + 1e-3
-        cos = cos / norm
-        sin = sin / norm
-        mu = torch.arcsin(sin)
-        mu = torch.where(cos >= 0, mu, torch.sign(sin) * math.pi - mu)
-        prob = VonMises(mu, kappa)
-        prob = Independent(prob, reinterpreted_batch_ndims=1)
-        prob = MixtureSameFamily(mixture, prob)
-        prob.params = {'mixture': mixture.logits,
-                       'cos': cos,
-                       'sin': sin,
-                       'kappa': kappa}
-        return prob
-
-    def _mix_vonmises_delta(self, f, sin_theta, cos_theta):
-        # f: (B, (1 + 2 + 1) * self.n_mixture)
+        return MixtureVonMises(logits, cos / norm, sin / norm, kappa)
+
+    def _mix_vonmises_delta(self, f, theta):
+        # f: (B, (1 + 2 + 1) * self.n_mixture), the means are offsets from the component means of theta
         B = f.shape[0]
-        mixture = Categorical(logits=f[..., :self.n_mixture])
+        logits = f[..., :self.n_mixture]
         f = f[..., self.n_mixture:].reshape(B, self.n_mixture, 3)
         cos_delta = f[..., 0:1]
         sin_delta = f[..., 1:2]
@@ -173,111 +445,163 @@ class AutoregressiveTransformer(nn.Module):
         norm = torch.sqrt(cos_delta ** 2 + sin_delta ** 2) + 1e-3
         cos_delta = cos_delta / norm
         sin_delta = sin_delta / norm
-        sin = sin_theta * cos_delta + cos_theta * sin_delta
-        cos = cos_theta * cos_delta - sin_theta * sin_delta
-        mu = torch.arcsin(sin)
-        mu = torch.where(cos >= 0, mu, torch.sign(sin) * math.pi - mu)
-        prob = VonMises(mu, kappa)
-        prob = Independent(prob, reinterpreted_batch_ndims=1)
-        prob = MixtureSameFamily(mixture, prob)
-        prob.params = {'mixture': mixture.logits,
-                       'cos': cos,
-                       'sin': sin,
-                       'kappa': kappa}
-        return prob
+        sin = theta.sin * cos_delta + theta.cos * sin_delta
+        cos = theta.cos * cos_delta - theta.sin * sin_delta
+        return MixtureVonMises(logits, cos, sin, kappa)
+
+    def _mode(self, prob):
+        # most likely value of a head, (B, ...) as from prob.sample()
+        if isinstance(prob, Bernoulli):
+            return (prob.logits > 0).to(prob.logits.dtype)
+        if isinstance(prob, Categorical):
+            return prob.logits.argmax(dim=-1)
+        return prob.mode()
 
     def _max_prob_sample(self, prob, n_sample):
-        assert prob.batch_shape[0] == 1
-        sample = prob.sample(torch.tensor([n_sample]))
-        log_prob = prob.log_prob(sample)
-        max_prob = log_prob.argmax(dim=0).squeeze()
-        pred = sample[max_prob]
+        # draw n_sample samples for every batch entry and keep the most likely one of each
+        if self.mode_decoding:
+            return self._mode(prob)
+        B = prob.batch_shape[0]
+        sample = prob.sample(torch.Size([n_sample]))  # (n_sample, B, ...)
+        log_prob = prob.log_prob(sample).reshape(n_sample, B, -1).sum(dim=-1)  # (n_sample, B)
+        max_prob = log_prob.argmax(dim=0)  # (B, )
+        pred = sample[max_prob, torch.arange(B, device=sample.device)]
         return pred
 
+    def _location_distribution(self, decoder, f_out, output_f, map_f, index, blocked=None):
+        # f_out: location logits from decoder(output_f, 'location'), blocked: (N, 320 * 320) excluded pixels
+        if not self.hierarchical_location:
+            if blocked is not None:
+                f_out = torch.where(blocked.all(dim=1, keepdim=True), f_out, f_out.masked_fill(blocked, float('-inf')))
+            return Categorical(logits=f_out, validate_args=False)
+
+        def fine_fn(coarse):
+            # coarse: (..., N) -> (..., N, 64)
+            rows = torch.arange(coarse.size(-1), device=coarse.device).expand_as(coarse).reshape(-1)
+            out = decoder(output_f[rows], 'location_fine', map_f=map_f, index=index[rows], coarse=coarse.reshape(-1))
+            return out.reshape(*coarse.shape, -1)
+
+        return CoarseToFineLocation(f_out, fine_fn, cell=decoder.cell, blocked=blocked)
+
+    def _location_roi(self, decoder, maps, index, include=None, blocked=None):
+        # maps: (B, 26, 320, 320) -> (N, 320 * 320) candidate pixels of the decoder's category for every row
+        # include: (N, ) pixels that are always candidates, e.g. the gt location in training
+        # blocked: (N, 320 * 320) pixels removed from the candidates unless that leaves none
+        roi = maps[:, list(decoder.roi_layers)].amax(dim=1).flatten(1)[index] > 0
+        if blocked is not None:
+            free = roi & ~blocked
+            roi = torch.where(free.any(dim=1, keepdim=True), free, roi)
+        # rows without any candidate fall back to the whole map
+        roi = roi | ~roi.any(dim=1, keepdim=True)
+        if include is not None:
+            roi = roi.scatter(1, include[:, None], True)
+        return roi
+
     def _decode(self, decoder, output_f, map_f,
+                index=None,
                 gt=None,
                 n_sample=1,
-                prev_occupancy=None):
-        B = output_f.size(0)
-        f_in = torch.cat([output_f[:, None, :].expand(B, 320 * 320, self.d_model), map_f], dim=-1)
-        f_out = decoder(f_in, 'location')  # (B, 320 * 320)
-        location_f = []
-        if n_sample == 1:
-            prob_location = Categorical(logits=f_out)
-            pred_location = prob_location.sample()  # (B, )
-            pred_location_smoothed = self._smooth_loc(pred_location)
-            # teacher forcing
-            for location_one, map_f_one in zip(gt['location'], map_f):
-                location_f.append(map_f_one[location_one])
+                prev_occupancy=None,
+                collisions=None,
+                maps=None,
+                return_pred=True,
+                location_logits=None):
+        # output_f: (N, d_model), map_f: (B, 128, 320, 320), index: (N, ) map of each row, None if N == B
+        # collisions: CollisionIndex of the placed boxes, with one scene per map
+        # maps: (B, 26, 320, 320) the input maps, needed for sparse location decoding
+        # location_logits: (N, ...) output of decoder(output_f, 'location') if already computed
+        # with gt (teacher forcing) every head is conditioned on the gt attributes; return_pred=False then also
+        # skips all sampling and only returns the distributions for the loss. Without gt, n_sample == 1 draws
+        # every attribute once from its distribution, n_sample > 1 keeps the most likely of n_sample draws
+        N = output_f.size(0)
+        if index is None:
+            index = torch.arange(N, device=output_f.device)
+        map_flat = map_f.flatten(2)  # (B, 128, 320 * 320)
+        # prev_occupancy: (N, 320, 320)
+        # occupied pixels are masked out of the location logits, unless the whole map is occupied
+        blocked = None if gt is not None else prev_occupancy.flatten(1) > 0  # (N, 320 * 320)
+        if self.sparse_location:
+            roi = self._location_roi(decoder, maps, index,
+                                     include=gt['location'] if gt is not None else None,
+                                     blocked=blocked)
+            logits, pixels, rank = decoder(output_f, 'location_sparse', map_f=map_f, index=index, roi=roi)
+            prob_location = SparseLocation(logits, pixels, rank)
         else:
-            prob_location = Categorical(logits=f_out)
-            for _ in range(50):
-                pred_location = self._max_prob_sample(prob_location, n_sample)
+            f_out = location_logits
+            if f_out is None:
+                f_out = decoder(output_f, 'location', map_f=map_f, index=index)  # (N, 320 * 320), or (N, 40 * 40)
+            if not return_pred and not self.hierarchical_location:
+                prob_location = LocationLogits(f_out)
+            else:
+                prob_location = self._location_distribution(decoder, f_out, output_f, map_f, index, blocked=blocked)
+        if gt is not None:
+            # teacher forcing
+            location_f = map_flat[index, :, gt['location']]  # (N, 128)
+            if return_pred:
+                pred_location = prob_location.sample()  # (N, )
                 pred_location_smoothed = self._smooth_loc(pred_location)
-                # reject overlapping location
-                row = int((40 - pred_location_smoothed.squeeze().numpy()[1]) / 0.25)
-                col = int((pred_location_smoothed.squeeze().numpy()[0] + 40) / 0.25)
-                if prev_occupancy[row, col]:
-                    continue
-                break
-            for location_one, map_f_one in zip(pred_location, map_f):
-                location_f.append(map_f_one[location_one])
-        location_f = torch.stack(location_f, dim=0)  # (B, 128)
+        elif n_sample == 1:
+            pred_location = prob_location.sample()  # (N, )
+            pred_location_smoothed = self._smooth_loc(pred_location)
+            location_f = map_flat[index, :, pred_location]  # (N, 128)
+        else:
+            pred_location = self._max_prob_sample(prob_location, n_sample)
+            pred_location_smoothed = self._smooth_loc(pred_location, jitter=not self.mode_decoding)
+            location_f = map_flat[index, :, pred_location]  # (N, 128)
 
-        f_in = location_f  # (B, 128)
+        f_in = location_f  # (N, 128)
         f_out = decoder(f_in, 'wl')
         prob_wl = self._mix_lognormal(f=f_out, event_shape=2)
         f_out = decoder(f_in, 'theta')
         prob_theta = self._mix_vonmises(f=f_out)
-        if n_sample == 1:
+        if gt is not None:
+            if return_pred:
+                pred_wl = clamp_box_size(prob_wl.sample())
+                pred_theta = prob_theta.sample()
+        elif n_sample == 1:
+            # not clamped, so the box is exactly a draw of prob_wl; boxes past the reach of the collision index
+            # go to its spill list
             pred_wl = prob_wl.sample()
             pred_theta = prob_theta.sample()
         else:
-            for _ in range(50):
-                pred_wl = self._max_prob_sample(prob_wl, n_sample)
-                pred_theta = self._max_prob_sample(prob_theta, n_sample * 2)
-                # reject overlapping bounding box
-                location = pred_location_smoothed.squeeze().numpy()
-                w, l = pred_wl.squeeze().numpy()
-                theta = pred_theta.item()
-                corners = np.array([[l / 2, w / 2],
-                                    [-l / 2, w / 2],
-                                    [-l / 2, -w / 2],
-                                    [l / 2, -w / 2]])
-                rotation = np.array([[np.cos(theta), np.sin(theta)],
-                                     [-np.sin(theta), np.cos(theta)]])
-                corners = np.dot(corners, rotation) + location
-                corners[:, 0] = corners[:, 0] + 40
-                corners[:, 1] = 40 - corners[:, 1]
-                corners = np.floor(corners / 0.25).astype(int)
-                new_occupancy = np.zeros((320, 320), dtype=np.uint8)
-                cv2.fillConvexPoly(new_occupancy, corners, 1)
-                if (new_occupancy.astype(bool) & prev_occupancy.astype(bool)).sum() > 0:
-                    continue
-                break
+            # draw a batch of box candidates, keep the most likely one that does not overlap placed objects,
+            # or the most likely one overall if they all do
+            K = self.n_box_candidates
+            cand_wl = prob_wl.sample(torch.Size([K]))  # (K, N, 2)
+            cand_theta = prob_theta.sample(torch.Size([K]))  # (K, N, 1)
+            if self.mode_decoding:
+                cand_wl[0] = prob_wl.mode()
+                cand_theta[0] = prob_theta.mode()
+            # log-normal sizes are unbounded, placed boxes stay within the reach of the collision index
+            cand_wl = clamp_box_size(cand_wl)
+            log_prob = prob_wl.log_prob(cand_wl) + prob_theta.log_prob(cand_theta)  # (K, N)
+            candidates = torch.cat([pred_location_smoothed.expand(K, N, 2), cand_wl, cand_theta], dim=-1)
+            overlap = collisions.query(candidates, index)  # (K, N)
+            best = torch.where(overlap.all(dim=0),
+                               log_prob.argmax(dim=0),
+                               log_prob.masked_fill(overlap, float('-inf')).argmax(dim=0))  # (N, )
+            if self.mode_decoding:
+                best = torch.where(overlap[0], best, torch.zeros_like(best))
+            batch_idx = torch.arange(N, device=best.device)
+            pred_wl = cand_wl[best, batch_idx]
+            pred_theta = cand_theta[best, batch_idx]
 
-        pred_bbox = torch.cat([pred_wl, pred_theta], dim=-1)
-        bbox_f = self.pe_bbox(pred_bbox)
+        if gt is not None:
+            # teacher forcing, the sampled box is only returned
+            bbox_f = self.pe_bbox(gt['bbox'])
+        else:
+            bbox_f = self.pe_bbox(torch.cat([pred_wl, pred_theta], dim=-1))
 
         f_in = torch.cat([
             location_f,
             bbox_f
         ], dim=-1)  # (B, 128 + 192)
         f_out = decoder(f_in, 'moving')
-        prob_moving = Bernoulli(logits=f_out)
+        prob_moving = Bernoulli(logits=f_out, validate_args=False)
         f_out = decoder(f_in, 's')
         prob_s = self._mix_lognormal(f=f_out, event_shape=1)
         f_out = decoder(f_in, 'omega')
-        prob_omega = self._mix_vonmises_delta(f=f_out, sin_theta=prob_theta.params['sin'],
-                                              cos_theta=prob_theta.params['cos'])
-        if n_sample == 1:
-            pred_moving = prob_moving.sample()
-            pred_s = prob_s.sample()
-            pred_omega = prob_omega.sample()
-        else:
-            pred_moving = self._max_prob_sample(prob_moving, n_sample)
-            pred_s = self._max_prob_sample(prob_s, n_sample)
-            pred_omega = self._max_prob_sample(prob_omega, n_sample)
+        prob_omega = self._mix_vonmises_delta(f=f_out, theta=prob_theta)
 
         probs = {
             "location": prob_location,
@@ -287,6 +611,16 @@ class AutoregressiveTransformer(nn.Module):
             "s": prob_s,
             "omega": prob_omega
         }
+        if not return_pred:
+            return probs, None
+        if gt is not None or n_sample == 1:
+            pred_moving = prob_moving.sample()
+            pred_s = prob_s.sample()
+            pred_omega = prob_omega.sample()
+        else:
+            pred_moving = self._max_prob_sample(prob_moving, n_sample)
+            pred_s = self._max_prob_sample(prob_s, n_sample)
+            pred_omega = self._max_prob_sample(prob_omega, n_sample)
         preds = {
             "location": pred_location_smoothed,
             "wl": pred_wl,
@@ -298,87 +632,113 @@ class AutoregressiveTransformer(nn.Module):
         return probs, preds
 
     def _rasterize(self, object_layers, category, location, bbox, velocity):
+        # object_layers: (B, 18, 320, 320), category: (B, ), 0 leaves the scene unchanged
+        # location: (B, 2), bbox: (B, 3), velocity: (B, 2)
         B = object_layers.size(0)
-        device = object_layers.device
-        location = location.to('cpu').numpy()
-        bbox = bbox.to('cpu').numpy()
-        velocity = velocity.to('cpu').numpy()
-        object_layers = object_layers.to('cpu').numpy()
-        for i in range(B):
-            if category[i] == 0:
-                continue
-            working_layers = object_layers[i, (category[i] - 1) * 6:category[i] * 6]
-            w, l, theta = bbox[i]
-            speed, heading = velocity[i]
-            corners = np.array([[l / 2, w / 2],
-                                [-l / 2, w / 2],
-                                [-l / 2, -w / 2],
-                                [l / 2, -w / 2]])
-            rotation = np.array([[np.cos(theta), np.sin(theta)],
-                                 [-np.sin(theta), np.cos(theta)]])
-            corners = np.dot(corners, rotation) + location[i]
-            corners[:, 0] = corners[:, 0] + 40
-            corners[:, 1] = 40 - corners[:, 1]
-            corners = np.floor(corners / 0.25).astype(int)
-            occupancy = np.zeros((320, 320), dtype=np.uint8)
-            cv2.fillConvexPoly(occupancy, corners, 255)
-            working_layers[0] = np.where(occupancy > 0, 1., working_layers[0])
-
-            row = int((40 - location[i, 1]) / 0.25)
-            col = int((location[i, 0] + 40) / 0.25)
-            working_layers[1, row, col] = np.sin(theta)
-            working_layers[2, row, col] = np.cos(theta)
-            working_layers[3, row, col] = speed
-            working_layers[4, row, col] = np.sin(heading)
-            working_layers[5, row, col] = np.cos(heading)
-
-        return torch.tensor(object_layers, dtype=torch.float32, device=device)
-
-    def _forward_step(self, samples, lengths, gt):
-        B, L, *_ = samples["category"].shape
-        # Unpack the samples
-        category = samples["category"]  # (B, L)
-        location = samples['location']  # (B, L)
-        bbox = samples["bbox"]
-        velocity = samples["velocity"]
-        maps = samples["map"]
+        batch_idx = torch.arange(B, device=object_layers.device)
+        placed = category > 0
+        channel = (category.clamp(min=1) - 1) * 6  # (B, ) first layer of the category
+        object_layers = object_layers.clone()
 
-        # extract features from map
-        map_f = self.feature_extractor(maps)  # (B, 128, 320, 320)
-        map_f = map_f.flatten(2, 3).permute([0, 2, 1]).contiguous()  # (B, 320 * 320, 128)
+        occupancy = rasterize_boxes(location, bbox) & placed[:, None, None]  # (B, 320, 320)
+        object_layers[batch_idx, channel] = torch.where(occupancy, 1., object_layers[batch_idx, channel])
+
+        row = ((40 - location[:, 1]) / 0.25).long().clamp(0, 319)
+        col = ((location[:, 0] + 40) / 0.25).long().clamp(0, 319)
+        theta = bbox[:, 2]
+        speed, heading = velocity[:, 0], velocity[:, 1]
+        values = torch.stack([torch.sin(theta), torch.cos(theta), speed, torch.sin(heading), torch.cos(heading)],
+                             dim=1)  # (B, 5)
+        channels = channel[:, None] + torch.arange(1, 6, device=channel.device)  # (B, 5)
+        current = object_layers[batch_idx[:, None], channels, row[:, None], col[:, None]]
+        object_layers[batch_idx[:, None], channels, row[:, None], col[:, None]] = \
+            torch.where(placed[:, None], values, current)
+        return object_layers
+
+    def _encode(self, input_f, padding, attn_mask=None):
+        # input_f: (B, S, d_model), padding: (B, S) True for padding, attn_mask: (S, S) True where blocked
+        # outputs at the padding are undefined, zeros in the packed path
+        if not self.packed_attention:
+            return self.transformer_encoder(input_f, mask=attn_mask, src_key_padding_mask=padding)
+        packing = PackedSequences(~padding)
+        output_f = packed_encoder(self.transformer_encoder, packing.pack(input_f), packing, attn_mask)
+        return packing.unpack(output_f)
 
-        # embed category
-        category_f = self.category_embedding(category)
+    def _attn_mask(self, S, device):
+        # (S, S) True where blocked, None for full attention
+        if not self.causal:
+            return None
+        return torch.ones(S, S, dtype=torch.bool, device=device).triu(1)
+
+    def _extract_map(self, samples):
+        # with a split extractor, the static part is read from samples['static_f'] if given, the generation
+        # loops put it there once through _scene_constants; samples is never written to
+        if not isinstance(self.feature_extractor, SplitExtractor):
+            map_f, _ = self.feature_extractor(samples['map'])
+            return map_f
+        static_f = samples.get('static_f')
+        if static_f is None:
+            static_f = self.feature_extractor.encode_static(samples['map'])
+        map_f, _ = self.feature_extractor(samples['map'], static_f=static_f)
+        return map_f
+
+    def _embed_objects(self, objects, map_f):
+        # objects: category, location (discrete), bbox and velocity of shape (B, L, ...)
+        # map_f: (B, 128, 320, 320)
+        category_f = self.category_embedding(objects['category'])
         # positional encoding for location
-        location_f = []
-        for location_one, map_f_one in zip(location, map_f):
-            location_f.append(map_f_one[location_one])
-        location_f = torch.stack(location_f, dim=0)  # (B, L, 128)
+        map_flat = map_f.flatten(2)  # (B, 128, 320 * 320)
+        location = objects['location'][:, None, :].expand(-1, map_flat.size(1), -1)
+        location_f = map_flat.gather(2, location).transpose(1, 2)  # (B, L, 128)
         # positional encoding for bounding box
-        bbox_f = self.pe_bbox(bbox)
+        bbox_f = self.pe_bbox(objects['bbox'])
         # positional encoding for velocity
-        velocity_f = self.pe_velocity(velocity)
+        velocity_f = self.pe_velocity(objects['velocity'])
         object_f = torch.cat([category_f, location_f, bbox_f, velocity_f], dim=-1)  # (B, L, 512)
-        object_f = self.fc_object(object_f)  # (B, L, d_model)
-        input_f = torch.cat([self.q.expand(B, 1, self.d_model),
-                             self.pe(object_f)],
-                            dim=1)  # (B, L + 1, d_model)
+        return self.fc_object(object_f)  # (B, L, d_model)
 
-        # masking
-        mask = get_length_mask(lengths + 1)
-        output_f = self.transformer_encoder(input_f, src_key_padding_mask=mask)  # (B, L + 1, d_model)
+    def _token_map_f(self, samples, map_f=None):
+        # map features the object tokens read their location features from. A causal model reads them from the
+        # bare map, without the rasterized objects, which does not change while objects are added, so the keys
+        # and values cached by generate_cached stay valid; otherwise they are the map features map_f
+        if not self.causal:
+            return map_f
+        if 'token_f' in samples:
+            return samples['token_f']
+        maps = samples['map']
+        bare = {'map': torch.cat([maps[:, :8], torch.zeros_like(maps[:, 8:])], dim=1)}
+        if 'static_f' in samples:
+            bare['static_f'] = samples['static_f']
+        return self._extract_map(bare)
 
-        # mean pooling
-        output_f = output_f.mean(dim=1)  # (B, d_model)
+    def _scene_constants(self, samples):
+        # features that stay the same while objects are added to the scenes, computed once per generation:
+        # the static map features of a split extractor and the token map features of a causal model
+        constants = {k: samples[k] for k in ('static_f', 'token_f') if k in samples}
+        if 'static_f' not in constants and isinstance(self.feature_extractor, SplitExtractor):
+            constants['static_f'] = self.feature_extractor.encode_static(samples['map'])
+        if self.causal and 'token_f' not in constants:
+            constants['token_f'] = self._token_map_f(dict(samples, **constants))
+        return constants
 
+    def _step_losses(self, output_f, map_f, gt, index=None, return_pred=True, maps=None):
+        # output_f: (N, d_model), map_f: (B, 128, 320, 320), gt: fields of shape (N, ...)
+        # index: (N, ) map of each step, None if N == B, maps: (B, 26, 320, 320) input maps
+        N = output_f.size(0)
+        map_mean = map_f.mean(dim=(2, 3))  # (B, 128)
+        if index is not None:
+            map_mean = map_mean[index]
         # predict category
-        prob_category = self.prob_category(torch.cat([output_f, map_f.mean(dim=1)], dim=-1))  # (B, 4)
+        prob_category = self.prob_category(torch.cat([output_f, map_mean], dim=-1))  # (N, 4)
+        if self.route_decoders:
+            return self._routed_step_losses(output_f, map_f, gt, prob_category, index, return_pred, maps)
         prob_category = Categorical(logits=prob_category)
 
         loss_select = []
         pred_select = []
         for decoder in [self.decoder_pedestrian, self.decoder_bicyclist, self.decoder_vehicle]:
-            probs, preds = self._decode(decoder, output_f, map_f, gt=gt)
+            probs, preds = self._decode(decoder, output_f, map_f, index=index, gt=gt, maps=maps,
+                                        return_pred=return_pred)
             probs["category"] = prob_category
             loss_components = self.loss_fn(probs, gt)
             loss_select.append(loss_components)
@@ -389,20 +749,133 @@ class AutoregressiveTransformer(nn.Module):
             loss[k] = loss_select[0][k]
             loss[k] = torch.where(gt['category'] == 2, loss_select[1][k], loss[k])
             loss[k] = torch.where(gt['category'] == 3, loss_select[2][k], loss[k])
+        if not return_pred:
+            return loss, None
 
-        pred = {k: [] for k in ['location', 'wl', 'theta', 'moving', 's', 'omega']}
+        pred = {}
         for k in ['location', 'wl', 'theta', 'moving', 's', 'omega']:
-            for i in range(B):
-                if gt['category'][i] == 0:
-                    pred[k].append(torch.zeros_like(pred_select[0][k][0]))
-                else:
-                    choice = gt['category'][i].item() - 1
-                    pred[k].append(pred_select[choice][k][i])
-            pred[k] = torch.stack(pred[k], dim=0)
+            category = gt['category'].reshape(N, *([1] * (pred_select[0][k].dim() - 1)))
+            pred[k] = torch.zeros_like(pred_select[0][k])
+            for c in range(1, 4):
+                pred[k] = torch.where(category == c, pred_select[c - 1][k], pred[k])
         pred['category'] = gt['category']
 
         return loss, pred
 
+    def _routed_step_losses(self, output_f, map_f, gt, logits_category, index=None, return_pred=True, maps=None):
+        # logits_category: (N, 4)
+        # Each step goes through the decoder of its gt category only, end tokens only get the category loss.
+        # Batch norm statistics in the location decoder are per category sub-batch in this mode.
+        N = output_f.size(0)
+        device = output_f.device
+        if index is None:
+            index = torch.arange(N, device=device)
+        loss_category = -Categorical(logits=logits_category).log_prob(gt['category'])  # (N, )
+        loss = {k: torch.zeros(N, device=device) for k in ['location', 'wl', 'theta', 'moving', 's', 'omega']}
+        loss['category'] = loss_category
+        loss['all'] = loss_category * self.loss_fn.weights['category']
+        pred = {}
+        decoders = [self.decoder_pedestrian, self.decoder_bicyclist, self.decoder_vehicle]
+        for c, decoder in enumerate(decoders, start=1):
+            select = (gt['category'] == c).nonzero(as_tuple=True)[0]  # (n, )
+            if select.numel() == 0:
+                continue
+            gt_c = {k: v[select] for k, v in gt.items()}
+            probs, preds = self._decode(decoder, output_f[select], map_f, index=index[select], gt=gt_c, maps=maps,
+                                        return_pred=return_pred)
+            probs['category'] = Categorical(logits=logits_category[select])
+            loss_c = self.loss_fn(probs, gt_c)
+            for k in loss:
+                loss[k] = loss[k].index_copy(0, select, loss_c[k])
+            if return_pred:
+                for k in ['location', 'wl', 'theta', 'moving', 's', 'omega']:
+                    if k not in pred:
+                        pred[k] = preds[k].new_zeros((N, *preds[k].shape[1:]))
+                    pred[k] = pred[k].index_copy(0, select, preds[k])
+        if not return_pred:
+            return loss, None
+        pred['category'] = gt['category']
+        return loss, pred
+
+    def _forward_step(self, samples, lengths, gt, return_pred=True):
+        B, L, *_ = samples["category"].shape
+
+        # extract features from map
+        map_f = self._extract_map(samples)  # (B, 128, 320, 320)
+
+        object_f = self._embed_objects(samples, self._token_map_f(samples, map_f))  # (B, L, d_model)
+        input_f = torch.cat([self.q.expand(B, 1, self.d_model),
+                             self.pe(object_f)],
+                            dim=1)  # (B, L + 1, d_model)
+
+        # masking
+        mask = get_length_mask(lengths + 1, L + 1)
+        output_f = self._encode(input_f, mask, self._attn_mask(L + 1, mask.device))  # (B, L + 1, d_model)
+
+        # mean pooling over the real tokens
+        output_f = (output_f * ~mask[..., None]).sum(dim=1) / (lengths + 1)[:, None]  # (B, d_model)
+
+        return self._step_losses(output_f, map_f, gt, return_pred=return_pred, maps=samples['map'])
+
+    def _forward_sequence(self, samples, lengths, gt, map_f=None):
+        """
+        Teacher-forced training on a window of W next objects per scene in one pass.
+
+        The targets except the last are appended as tokens after the prefix. Target j attends to the query
+        token, the prefix and targets 0 ... j - 1; the prefix does not attend to the targets. Step j is
+        predicted from the masked mean over the outputs it can see. All steps share the map features of the
+        prefix, so with an empty prefix (window_size='all' in the preprocessor) every object of a scene is
+        supervised from a single extractor pass over the bare map. map_f are the map features of the prefix
+        if already computed.
+        """
+        B, L, *_ = samples["category"].shape
+        W = gt['category'].size(1)
+        device = lengths.device
+        gt_lengths = gt['length'] if 'length' in gt else torch.full_like(lengths, W)
+
+        # extract features from map
+        if map_f is None:
+            map_f = self._extract_map(samples)  # (B, 128, 320, 320)
+
+        fields = ['category', 'location', 'bbox', 'velocity']
+        objects = {field: torch.cat([samples[field], gt[field][:, :W - 1]], dim=1) for field in fields}
+        object_f = self._embed_objects(objects, self._token_map_f(samples, map_f))  # (B, L + W - 1, d_model)
+        # the targets continue the positions of each sample's own prefix
+        positions = torch.cat([torch.arange(L, device=device).expand(B, L),
+                               lengths[:, None] + torch.arange(W - 1, device=device)], dim=1)
+        input_f = torch.cat([self.q.expand(B, 1, self.d_model),
+                             self.pe(object_f, positions)],
+                            dim=1)  # (B, 1 + L + W - 1, d_model)
+
+        S = input_f.size(1)
+        idx = torch.arange(S, device=device)
+        attn_mask = (idx[None, :] > idx[:, None]) & (idx[None, :] >= 1 + L)  # (S, S), True is blocked
+        if self.causal:
+            attn_mask = idx[None, :] > idx[:, None]
+        padding = torch.cat([get_length_mask(lengths + 1, 1 + L),
+                             get_length_mask(gt_lengths - 1, W - 1)], dim=1)  # (B, S)
+        output_f = self._encode(input_f, padding, attn_mask)
+
+        # masked mean pooling for every step
+        prefix_sum = (output_f[:, :1 + L] * ~padding[:, :1 + L, None]).sum(dim=1)  # (B, d_model)
+        target_sum = torch.cat([torch.zeros_like(output_f[:, :1]),
+                                output_f[:, 1 + L:].cumsum(dim=1)], dim=1)  # (B, W, d_model)
+        count = lengths[:, None] + 1 + torch.arange(W, device=device)  # (B, W)
+        step_f = (prefix_sum[:, None] + target_sum) / count[..., None]  # (B, W, d_model)
+
+        # flatten the supervised steps
+        valid = ~get_length_mask(gt_lengths, W)  # (B, W)
+        index = valid.nonzero()[:, 0]  # (N, ) scene of every step
+        step_f = step_f[valid]
+        gt_steps = {field: gt[field][valid] for field in fields}
+        if self.training and self.max_supervised_steps is not None and index.size(0) > self.max_supervised_steps:
+            keep = torch.randperm(index.size(0), device=device)[:self.max_supervised_steps]
+            index, step_f = index[keep], step_f[keep]
+            gt_steps = {field: gt_steps[field][keep] for field in fields}
+        loss, _ = self._step_losses(step_f, map_f, gt_steps, index=index, return_pred=False,
+                                    maps=samples['map'])  # (N, )
+        return loss
+
     def forward(self, samples, lengths, gt):
         L = lengths.max().item()
         for field in ['category', 'location', 'bbox', 'velocity']:
@@ -410,118 +883,503 @@ class AutoregressiveTransformer(nn.Module):
         samples['location'] = self._discrete_loc(samples['location'])
         gt['location'] = self._discrete_loc(gt['location'])
 
+        if gt['category'].size(1) > 1 or 'length' in gt:
+            return self._forward_sequence(samples, lengths, gt)
+
         gt_step = {}
         for field in ['category', 'location', 'bbox', 'velocity']:
             gt_step[field] = gt[field][:, 0]
-        loss, pred = self._forward_step(samples, lengths, gt_step)  # (B, )
+        # only the loss is used, so nothing is sampled
+        loss, _ = self._forward_step(samples, lengths, gt_step, return_pred=False)  # (B, )
         return loss
 
+    def _insert_objects(self, samples, lengths, preds):
+        # insert the placed objects into the (-y, x) sorted, padded prefixes
+        # preds: fields of shape (B, ...), category 0 leaves the scene unchanged
+        B, L = samples['category'].shape
+        device = lengths.device
+        placed = preds['category'] > 0
+        # the new object goes after every object with a smaller or equal key, like a stable sort of the appended list
+        x, y = samples['location'][..., 0], samples['location'][..., 1]
+        x_new, y_new = preds['location'][:, 0:1], preds['location'][:, 1:2]
+        before = ~get_length_mask(lengths, L) & ((y > y_new) | ((y == y_new) & (x <= x_new)))  # (B, L)
+        position = before.sum(dim=1)  # (B, )
+        if self.causal:
+            # objects stay in the order they were placed in
+            position = lengths
+        idx = torch.arange(L + 1, device=device).expand(B, -1)
+        src = torch.where(placed[:, None] & (idx > position[:, None]), idx - 1, idx)  # (B, L + 1)
+        is_new = placed[:, None] & (idx == position[:, None])  # (B, L + 1)
+        new_samples = {}
+        for field in ['category', 'location', 'bbox', 'velocity']:
+            value = torch.cat([samples[field], torch.zeros_like(samples[field][:, :1])], dim=1)  # (B, L + 1, ...)
+            shape = (B, L + 1, *([1] * (value.dim() - 2)))
+            value = value.gather(1, src.reshape(shape).expand_as(value))
+            pred = preds[field].to(value.dtype).reshape(B, 1, *value.shape[2:])
+            new_samples[field] = torch.where(is_new.reshape(shape), pred, value)
+        return new_samples, lengths + placed.long()
+
+    def _generate_step(self, samples, lengths, category=None, n_sample=1, route=True, ended=None, collisions=None):
+        # samples: (B, L, ...) sorted prefixes with continuous locations, lengths: (B, )
+        # category: None, int or (B, ) tensor, ended: (B, ) scenes that only carry over unchanged
+        # collisions: CollisionIndex of the prefixes, which the placed objects are added to, None builds one
+        # route decodes each category as a sub-batch, which reads the categories back to the host; otherwise
+        # every decoder runs on every scene and the results are selected on the device
+        output_f, map_f = self._encode_scene(samples, lengths)
+        return self._place_objects(samples, lengths, output_f, map_f, category, n_sample, route, ended, collisions)
+
+    def _encode_scene(self, samples, lengths):
+        # samples: (B, L, ...) sorted prefixes with continuous locations
+        # returns the (B, d_model) pooled encoder output and the (B, 128, 320, 320) map features
+        category_prefix = samples["category"]  # (B, L)
+        location = self._discrete_loc(samples['location'])  # (B, L)
+        bbox = samples["bbox"]
+        velocity = samples["velocity"]
+        B, L, *_ = category_prefix.shape
+
+        # extract features from map
+        map_f = self._extract_map(samples)  # (B, 128, 320, 320)
+
+        objects = {'category': category_prefix, 'location': location, 'bbox': bbox, 'velocity': velocity}
+        object_f = self._embed_objects(objects, self._token_map_f(samples, map_f))  # (B, L, d_model)
+        input_f = torch.cat([self.q.expand(B, 1, self.d_model),
+                             self.pe(object_f)],
+                            dim=1)  # (B, L + 1, d_model)
+
+        mask = get_length_mask(lengths + 1, L + 1)
+        output_f = self._encode(input_f, mask, self._attn_mask(L + 1, mask.device))  # (B, L + 1, d_model)
+        if self.causal:
+            # mean pooling over the real tokens, as in training, which generate_cached keeps as a running sum
+            output_f = (output_f * ~mask[..., None]).sum(dim=1) / (lengths + 1)[:, None]  # (B, d_model)
+        else:
+            # max pooling over the real tokens
+            output_f = output_f.masked_fill(mask[..., None], float('-inf')).max(dim=1)[0]  # (B, d_model)
+        return output_f, map_f
+
+    def _place_objects(self, samples, lengths, output_f, map_f, category=None, n_sample=1, route=True, ended=None,
+                       collisions=None, location_logits=None):
+        # output_f: (B, d_model) pooled encoder output, map_f: (B, 128, 320, 320) features of samples['map']
+        # samples one object per scene from output_f and adds it to the scenes, see _generate_step
+        # location_logits: dict of the (B, ...) location logits of every category, filled on first use and
+        # reused as is in later calls with the same output_f and map_f; not used with sparse_location
+        maps = samples["map"]
+        B = output_f.size(0)
+        device = maps.device
+
+        # predict category
+        prob_category = self.prob_category(torch.cat([output_f, map_f.mean(dim=(2, 3))], dim=-1))  # (B, 4)
+        prob_category = Categorical(logits=prob_category, validate_args=False)
+        if category is None:
+            pred_category = prob_category.sample()  # (B, )
+        else:
+            pred_category = torch.as_tensor(category, device=device).expand(B)
+        if ended is not None:
+            pred_category = pred_category.masked_fill(ended, 0)
+
+        probs = {'category': prob_category}
+        preds = {
+            'category': pred_category,
+            'location': torch.zeros(B, 2, device=device),
+            'wl': torch.zeros(B, 2, device=device),
+            'theta': torch.zeros(B, 1, device=device),
+            'moving': torch.zeros(B, 1, device=device),
+            's': torch.zeros(B, 1, device=device),
+            'omega': torch.zeros(B, 1, device=device)
+        }
+        # pixels and boxes of the objects of every category
+        occupancy = maps[:, [8, 14, 20]].amax(dim=1)  # (B, 320, 320)
+        if collisions is None:
+            collisions = CollisionIndex.from_scenes(samples['location'], samples['bbox'], lengths)
+        decoders = [self.decoder_pedestrian, self.decoder_bicyclist, self.decoder_vehicle]
+        for c, decoder in enumerate(decoders, start=1):
+            logits = None
+            if location_logits is not None and not self.sparse_location:
+                if c not in location_logits:
+                    location_logits[c] = decoder(output_f, 'location', map_f=map_f)
+                logits = location_logits[c]
+            if route:
+                select = (pred_category == c).nonzero(as_tuple=True)[0]
+                if select.numel() == 0:
+                    continue
+                probs_c, preds_c = self._decode(decoder, output_f[select], map_f,
+                                                index=select,
+                                                n_sample=n_sample,
+                                                prev_occupancy=occupancy[select],
+                                                collisions=collisions,
+                                                maps=maps,
+                                                location_logits=None if logits is None else logits[select])
+                for k, v in preds_c.items():
+                    preds[k] = preds[k].index_copy(0, select, v.to(preds[k].dtype))
+            else:
+                probs_c, preds_c = self._decode(decoder, output_f, map_f,
+                                                n_sample=n_sample,
+                                                prev_occupancy=occupancy,
+                                                collisions=collisions,
+                                                maps=maps,
+                                                location_logits=logits)
+                for k, v in preds_c.items():
+                    choose = (pred_category == c).reshape(B, *([1] * (v.dim() - 1)))
+                    preds[k] = torch.where(choose, v.to(preds[k].dtype), preds[k])
+            probs[c] = probs_c
+
+        preds['bbox'] = torch.cat([preds['wl'], preds['theta']], dim=-1)
+        preds['velocity'] = torch.cat([preds['s'], preds['omega']], dim=-1) * preds['moving']
+        collisions.insert(torch.cat([preds['location'], preds['bbox']], dim=-1)[:, None],
+                          (preds['category'] > 0)[:, None])
+        new_samples, lengths = self._add_objects(samples, lengths, preds)
+        return preds, probs, new_samples, lengths
+
+    def _add_objects(self, samples, lengths, preds):
+        # rasterizes preds into the object layers of samples['map'] and inserts them into the prefixes
+        maps = samples['map']
+        object_layers = self._rasterize(maps[:, 8:],
+                                        preds['category'],
+                                        preds['location'],
+                                        preds['bbox'],
+                                        preds['velocity'])
+        new_samples, lengths = self._insert_objects(samples, lengths, preds)
+        new_samples['map'] = torch.cat([maps[:, :8], object_layers], dim=1)
+        for k in ('static_f', 'token_f'):
+            if k in samples:
+                new_samples[k] = samples[k]
+        return new_samples, lengths
+
     def generate(self, samples, lengths, condition, n_sample):
-        # Unpack the samples
-        # B = 1
+        """
+        Places one more object in each of the B scenes.
+
+        condition['category'] is None to sample the category of every scene, an int for all scenes or a (B, )
+        tensor. Each scene is decoded by the decoder of its own category and sampled against its own
+        occupancy; scenes that sample the end token (category 0) are returned unchanged. probs holds the
+        category distribution and, under the category id, the decoder distributions of that sub-batch.
+        """
         self.eval()
         with torch.no_grad():
-            category = samples["category"]  # (B, L)
-            location = self._discrete_loc(samples['location'])  # (B, L)
-            bbox = samples["bbox"]
-            velocity = samples["velocity"]
-            maps = samples["map"]
-            B, L, *_ = category.shape
-
-            # extract features from map
-            map_f = self.feature_extractor(maps)  # (B, 128, 320, 320)
-            map_f = map_f.flatten(2, 3).permute([0, 2, 1]).contiguous()  # (B, 320 * 320, 128)
-
-            # embed category
-            category_f = self.category_embedding(category)
-            # positional encoding for location
-            location_f = []
-            for location_one, map_f_one in zip(location, map_f):
-                location_f.append(map_f_one[location_one])
-            location_f = torch.stack(location_f, dim=0)  # (B, L, 128)
-            # positional encoding for bounding box
-            bbox_f = self.pe_bbox(bbox)
-            # positional encoding for velocity
-            velocity_f = self.pe_velocity(velocity)
-            object_f = torch.cat([category_f, location_f, bbox_f, velocity_f], dim=-1)  # (B, L, 512)
-            object_f = self.fc_object(object_f)  # (B, L, d_model)
-            input_f = torch.cat([self.q.expand(B, 1, self.d_model),
-                                 self.pe(object_f)],
-                                dim=1)  # (B, L + 1, d_model)
-
-            mask = get_length_mask(lengths + 1)
-            # Compute the features using causal masking
-            output_f = self.transformer_encoder(input_f, src_key_padding_mask=mask)  # (B, L + 1, d_model)
-            # max pooling
-            output_f = output_f.max(dim=1)[0]  # (B, d_model)
-
-            # predict category
-            if condition['category'] is not None:
-                prob_category = None
-                pred_category = condition['category']
-            else:
-                prob_category = self.prob_category(torch.cat([output_f, map_f.mean(dim=1)], dim=-1))  # (B, 4)
-                prob_category = Categorical(logits=prob_category)
-                pred_category = prob_category.sample().item()
-
-            if pred_category == 0:
-                probs = {
-                    "category": prob_category,
-                    "location": None,
-                    "wl": None,
-                    "theta": None,
-                    "moving": None,
-                    "s": None,
-                    "omega": None
-                }
-                preds = {
-                    "category": pred_category,
-                    "location": None,
-                    "wl": None,
-                    "theta": None,
-                    "moving": None,
-                    "s": None,
-                    "omega": None
-                }
-                return preds, probs, samples, lengths
-            elif pred_category == 1:
-                decoder = self.decoder_pedestrian
-            elif pred_category == 2:
-                decoder = self.decoder_bicyclist
-            else:
-                decoder = self.decoder_vehicle
-            prev_occupancy = maps[0, 8].numpy()
-
-            probs, preds = self._decode(decoder, output_f, map_f,
-                                        n_sample=n_sample,
-                                        prev_occupancy=prev_occupancy)
-            probs['category'] = prob_category
-            preds['category'] = torch.tensor([pred_category])
-
-            new_samples = {field: [] for field in ['category', 'location', 'bbox', 'velocity']}
-            preds['bbox'] = torch.cat([preds['wl'], preds['theta']], dim=-1)
-            preds['velocity'] = torch.cat([preds['s'], preds['omega']], dim=-1) * preds['moving']
-            object_layers = self._rasterize(samples['map'][:, 8:],
-                                            preds['category'],
-                                            preds['location'],
-                                            preds['bbox'],
-                                            preds['velocity'])
-            new_samples['map'] = torch.cat([samples['map'][:, :8], object_layers], dim=1)
-            for i in range(B):
-                length = lengths[i].item()
-                new_samples_one = {}
-                for field in ['category', 'location', 'bbox', 'velocity']:
-                    new_samples_one[field] = torch.cat([samples[field][i, :length], preds[field][i].unsqueeze(0)],
-                                                       dim=0)
-                idx = list(range(length + 1))
-                idx.sort(key=lambda x: (-new_samples_one['location'][x, 1], new_samples_one['location'][x, 0]))
-                for field in ['category', 'location', 'bbox', 'velocity']:
-                    new_samples_one[field] = new_samples_one[field][idx]
-                    new_samples[field].append(new_samples_one[field])
-            for field in ['category', 'location', 'bbox', 'velocity']:
-                new_samples[field] = pad_sequence(new_samples[field], batch_first=True)
-            lengths = lengths + 1
-            samples = new_samples
-
+            preds, probs, samples, lengths = self._generate_step(samples, lengths, condition['category'], n_sample)
         self.train()
         return preds, probs, samples, lengths
+
+    def generate_scenes(self, samples, lengths, condition=None, n_sample=1, max_steps=100):
+        """
+        Completes B scenes in lockstep, one object per scene and step, until each scene samples the end token
+        or max_steps objects were added. Finished scenes drop out of the batch that is decoded.
+        n_sample == 1 draws every attribute once from its distribution, n_sample > 1 keeps the most likely of
+        n_sample draws and the most likely box candidate that does not overlap the placed objects, see _decode.
+        condition['category'] may be a (B, ) tensor, which is followed by every scene at every step.
+        Returns the completed scenes, padded, and their lengths.
+        """
+        fields = ['category', 'location', 'bbox', 'velocity']
+        if condition is None:
+            condition = {'category': None}
+        B, L = samples['category'].shape
+        device = lengths.device
+        scenes = {}
+        for field in fields:
+            value = samples[field]
+            scenes[field] = torch.cat([value, value.new_zeros((B, max_steps, *value.shape[2:]))], dim=1)
+        scenes['map'] = samples['map'].clone()
+        lengths = lengths.clone()
+        self.eval()
+        with torch.no_grad():
+            constants = self._scene_constants(samples)
+        self.train()
+
+        active = torch.arange(B, device=device)
+        for step in range(max_steps):
+            if active.numel() == 0:
+                break
+            W = L + step
+            batch = {field: scenes[field][active, :W] for field in fields}
+            batch['map'] = scenes['map'][active]
+            batch.update({k: v[active] for k, v in constants.items()})
+            category = condition['category']
+            if isinstance(category, torch.Tensor) and category.dim() > 0:
+                category = category[active]
+            preds, _, batch, lengths_active = self.generate(batch, lengths[active], {'category': category}, n_sample)
+            for field in fields:
+                scenes[field][active, :W + 1] = batch[field]
+            scenes['map'][active] = batch['map']
+            lengths[active] = lengths_active
+            # compact the batch to the scenes that have not ended
+            active = active[preds['category'] > 0]
+
+        L = lengths.max().item()
+        for field in fields:
+            scenes[field] = scenes[field][:, :L]
+        return scenes, lengths
+
+    def generate_resident(self, samples, lengths, condition=None, n_sample=1, max_steps=100, check_every=8):
+        """
+        Same as generate_scenes, with the whole loop kept on the model device. The scenes live in preallocated
+        padded buffers, every decoder runs on every scene so categories are never read back, and ended scenes
+        stay in the batch unchanged instead of being compacted out. The only host syncs are the check whether
+        all scenes ended, every check_every steps, and trimming the result; with sparse_location every decode
+        also syncs to size its candidate pixel lists (see _pixel_list).
+        """
+        fields = ['category', 'location', 'bbox', 'velocity']
+        if condition is None:
+            condition = {'category': None}
+        B, L = samples['category'].shape
+        device = lengths.device
+        scenes = {}
+        for field in fields:
+            value = samples[field]
+            scenes[field] = torch.cat([value, value.new_zeros((B, max_steps, *value.shape[2:]))], dim=1)
+        scenes['map'] = samples['map']
+        lengths = lengths.clone()
+        ended = torch.zeros(B, dtype=torch.bool, device=device)
+        category = condition['category']
+        if category is not None:
+            category = torch.as_tensor(category, device=device).expand(B)
+
+        # building nested tensors from the padding mask reads the lengths back to the host
+        encoder = self.transformer_encoder
+        nested = getattr(encoder, 'enable_nested_tensor', None), getattr(encoder, 'use_nested_tensor', None)
+        encoder.enable_nested_tensor = encoder.use_nested_tensor = False
+        self.eval()
+        try:
+            with torch.no_grad():
+                constants = self._scene_constants(samples)
+                collisions = CollisionIndex.from_scenes(samples['location'], samples['bbox'], lengths)
+                for step in range(max_steps):
+                    W = L + step
+                    batch = {field: scenes[field][:, :W] for field in fields}
+                    batch['map'] = scenes['map']
+                    batch.update(constants)
+                    preds, _, batch, lengths = self._generate_step(batch, lengths, category, n_sample,
+                                                                   route=False, ended=ended, collisions=collisions)
+                    for field in fields:
+                        scenes[field][:, :W + 1] = batch[field]
+                    scenes['map'] = batch['map']
+                    ended = ended | (preds['category'] == 0)
+                    if (step + 1) % check_every == 0 and ended.all():
+                        break
+        finally:
+            encoder.enable_nested_tensor, encoder.use_nested_tensor = nested
+            self.train()
+
+        L = lengths.max().item()
+        for field in fields:
+            scenes[field] = scenes[field][:, :L]
+        return scenes, lengths
+
+    def _draft_log_prob(self, probs, preds):
+        # log likelihood of the objects placed by _place_objects(route=False) under the distributions they were
+        # drawn from, with the terms of the loss, (B, )
+        gt = {
+            'category': preds['category'],
+            'location': self._discrete_loc(preds['location']).clamp(0, 320 * 320 - 1),
+            'bbox': preds['bbox'],
+            'velocity': preds['velocity']
+        }
+        nll = []
+        for c in range(1, 4):
+            loss = self.loss_fn({'category': probs['category'], **probs[c]}, gt)
+            nll.append(sum(loss[k] for k in ['category', 'location', 'wl', 'theta', 'moving', 's', 'omega']))
+        choice = (preds['category'] - 1).clamp(min=0)
+        return -torch.stack(nll).gather(0, choice[None])[0]
+
+    def generate_speculative(self, samples, lengths, condition=None, n_sample=1, max_steps=100, k=4):
+        """
+        Same as generate_resident, with up to k objects placed per scene and iteration instead of one.
+
+        The draft places k objects one after the other from a single encoder pass over the scene: the location
+        logits of every decoder are computed once and re-masked with the occupancy and boxes of the earlier
+        proposals, so proposals never overlap, and only the category and attribute heads run per proposal.
+        One teacher-forced pass over the proposals as a window, as in _forward_sequence, re-scores them with
+        each proposal conditioned on the ones before it. Proposal j is accepted with probability min(1, p / q)
+        of its re-scored and draft likelihoods; every scene keeps its proposals up to the first rejected one,
+        and the first one, decoded as in generate_resident, always. With n_sample == 1 every proposal is a single
+        draw from the draft distributions q and this is speculative sampling; with n_sample > 1 the proposals
+        are not drawn from q, so it is a consistency check rather than exact.
+        Returns the completed scenes, their lengths and the number of iterations, proposed and accepted objects.
+        """
+        fields = ['category', 'location', 'bbox', 'velocity']
+        terms = ['category', 'location', 'wl', 'theta', 'moving', 's', 'omega']
+        if condition is None:
+            condition = {'category': None}
+        B = lengths.size(0)
+        device = lengths.device
+        scene = {field: samples[field] for field in fields}
+        scene['map'] = samples['map']
+        start_lengths = lengths
+        ended = torch.zeros(B, dtype=torch.bool, device=device)
+        category = condition['category']
+        if category is not None:
+            category = torch.as_tensor(category, device=device).expand(B)
+        n_iterations = 0
+        n_proposed = torch.zeros((), dtype=torch.long, device=device)
+        n_accepted = torch.zeros((), dtype=torch.long, device=device)
+
+        self.eval()
+        try:
+            with torch.no_grad():
+                scene.update(self._scene_constants(samples))
+                for _ in range(max_steps):
+                    if ended.all():
+                        break
+                    n_iterations += 1
+                    added = lengths - start_lengths
+
+                    # draft
+                    output_f, map_f = self._encode_scene(scene, lengths)
+                    collisions = CollisionIndex.from_scenes(scene['location'], scene['bbox'], lengths)
+                    location_logits = {}
+                    draft, draft_lengths, draft_ended = scene, lengths, ended
+                    proposals, proposed, log_q = [], [], []
+                    for j in range(k):
+                        draft_ended = draft_ended | (added + j >= max_steps)
+                        preds, probs, draft, draft_lengths = self._place_objects(
+                            draft, draft_lengths, output_f, map_f, category, n_sample, route=False,
+                            ended=draft_ended, collisions=collisions, location_logits=location_logits)
+                        proposals.append(preds)
+                        proposed.append(~draft_ended)
+                        log_q.append(self._draft_log_prob(probs, preds))
+                        draft_ended = draft_ended | (preds['category'] == 0)
+                    proposed = torch.stack(proposed, dim=1)  # (B, k)
+                    log_q = torch.stack(log_q, dim=1)
+
+                    # re-score the proposals in one pass, on the map features of the draft
+                    window = {field: torch.stack([p[field] for p in proposals], dim=1) for field in fields}
+                    window['location'] = self._discrete_loc(window['location']).clamp(0, 320 * 320 - 1)
+                    window['length'] = proposed.sum(dim=1)
+                    prefix = {field: scene[field] for field in fields}
+                    prefix['location'] = self._discrete_loc(scene['location'])
+                    prefix['map'] = scene['map']
+                    prefix.update({k: scene[k] for k in ('static_f', 'token_f') if k in scene})
+                    loss = self._forward_sequence(prefix, lengths, window, map_f=map_f)
+                    log_p = torch.zeros_like(log_q)
+                    log_p[proposed] = -sum(loss[t] for t in terms)
+
+                    accept = (log_p - log_q) >= torch.log(torch.rand_like(log_p))
+                    accept[:, 0] = True
+                    # up to the first rejected proposal
+                    accept = (accept & proposed).long().cumprod(dim=1).bool()
+                    n_proposed += proposed.sum()
+                    n_accepted += accept.sum()
+                    for j, preds in enumerate(proposals):
+                        preds = dict(preds)
+                        preds['category'] = preds['category'].masked_fill(~accept[:, j], 0)
+                        scene, lengths = self._add_objects(scene, lengths, preds)
+                        ended = ended | (accept[:, j] & (proposals[j]['category'] == 0))
+                    ended = ended | (lengths - start_lengths >= max_steps)
+                    L = lengths.max().item()
+                    for field in fields:
+                        scene[field] = scene[field][:, :L]
+        finally:
+            self.train()
+
+        scene.pop('static_f', None)
+        scene.pop('token_f', None)
+        stats = {'iterations': n_iterations, 'proposed': n_proposed.item(), 'accepted': n_accepted.item()}
+        return scene, lengths, stats
+
+    def generate_samples(self, samples, lengths, n_scenes, seed=None, condition=None, n_sample=1, max_steps=100,
+                         resident=False):
+        """
+        n_scenes independent completions of one scene, given as a batch of one. The scene is broadcast to the
+        n_scenes rows of one batch that generate_scenes, or generate_resident, advances together. With a
+        SplitExtractor the static map layers, and with causal=True the token map features, are encoded once for
+        all of them; the object layers differ per scene after the first step and are encoded per scene. seed
+        makes the scenes reproducible. With the default n_sample=1 every scene is one free draw per object,
+        as in generate_scenes.
+        """
+        assert lengths.size(0) == 1
+        K = n_scenes
+        device = lengths.device
+        batch = {k: v.expand(K, *v.shape[1:]) for k, v in samples.items() if k not in ('static_f', 'token_f')}
+        lengths = lengths.expand(K)
+        generate = self.generate_resident if resident else self.generate_scenes
+        with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else [], enabled=seed is not None):
+            if seed is not None:
+                torch.manual_seed(seed)
+            self.eval()
+            with torch.no_grad():
+                constants = self._scene_constants(samples)  # (1, 128, 320, 320) each
+            self.train()
+            batch.update({k: v.expand(K, *v.shape[1:]) for k, v in constants.items()})
+            return generate(batch, lengths, condition, n_sample=n_sample, max_steps=max_steps)
+
+    def generate_cached(self, samples, lengths, condition=None, n_sample=1, max_steps=100, check_every=8):
+        """
+        Same as generate_resident for a model built with causal=True, with the encoder run on one token per new
+        object instead of on the whole scene. The query token and the prefix are encoded once into a KVCache;
+        every placed object is then encoded against the cache and added to a running sum of the outputs, which
+        gives the mean pooled features of the next step. Object tokens of a causal model read the features of
+        the bare map (see _token_map_f) in training and in every generation path, so a cached token is the same
+        as the one _encode_scene would compute at a later step. The map extractor still runs at every step for
+        the decoders, as the placed objects are rasterized into its input. Like generate_resident, it is free of
+        host syncs between the end checks only without sparse_location. n_sample is as in generate_scenes.
+        """
+        assert self.causal, 'cached generation needs a model trained with causal attention'
+        fields = ['category', 'location', 'bbox', 'velocity']
+        if condition is None:
+            condition = {'category': None}
+        B, L = samples['category'].shape
+        device = lengths.device
+        scenes = {}
+        for field in fields:
+            value = samples[field]
+            scenes[field] = torch.cat([value, value.new_zeros((B, max_steps, *value.shape[2:]))], dim=1)
+        scenes['map'] = samples['map']
+        lengths = lengths.clone()
+        ended = torch.zeros(B, dtype=torch.bool, device=device)
+        category = condition['category']
+        if category is not None:
+            category = torch.as_tensor(category, device=device).expand(B)
+
+        self.eval()
+        try:
+            with torch.no_grad():
+                constants = self._scene_constants(samples)
+                batch = {field: scenes[field][:, :L] for field in fields}
+                batch['map'] = scenes['map']
+                batch.update(constants)
+                map_f = self._extract_map(batch)  # (B, 128, 320, 320)
+
+                # the query token and the prefix fill slots 0 ... L of the cache
+                cache = KVCache(self.transformer_encoder, B, 1 + L + max_steps, device, self.q.dtype)
+                objects = dict(batch, location=self._discrete_loc(batch['location']))
+                input_f = torch.cat([self.q.expand(B, 1, self.d_model),
+                                     self.pe(self._embed_objects(objects, constants['token_f']))],
+                                    dim=1)  # (B, L + 1, d_model)
+                output_f = cached_encoder(self.transformer_encoder, input_f, cache,
+                                          torch.zeros(B, dtype=torch.long, device=device))
+                mask = get_length_mask(lengths + 1, L + 1)
+                output_sum = (output_f * ~mask[..., None]).sum(dim=1)  # (B, d_model)
+
+                collisions = CollisionIndex.from_scenes(samples['location'], samples['bbox'], lengths)
+                for step in range(max_steps):
+                    W = L + step
+                    batch = {field: scenes[field][:, :W] for field in fields}
+                    batch['map'] = scenes['map']
+                    batch.update(constants)
+                    if step > 0:
+                        map_f = self._extract_map(batch)
+                    step_f = output_sum / (lengths + 1)[:, None]
+                    preds, _, batch, new_lengths = self._place_objects(batch, lengths, step_f, map_f, category,
+                                                                       n_sample, route=False, ended=ended,
+                                                                       collisions=collisions)
+                    # the new object of every scene is one token at the slot after its last object
+                    new = {'category': preds['category'][:, None],
+                           'location': self._discrete_loc(preds['location'])[:, None],
+                           'bbox': preds['bbox'][:, None],
+                           'velocity': preds['velocity'][:, None]}
+                    object_f = self._embed_objects(new, constants['token_f'])
+                    object_f = self.pe(object_f, lengths[:, None])  # (B, 1, d_model)
+                    output_f = cached_encoder(self.transformer_encoder, object_f, cache, lengths + 1)[:, 0]
+                    output_sum = output_sum + output_f * (new_lengths > lengths)[:, None]
+                    lengths = new_lengths
+                    for field in fields:
+                        scenes[field][:, :W + 1] = batch[field]
+                    scenes['map'] = batch['map']
+                    ended = ended | (preds['category'] == 0)
+                    if (step + 1) % check_every == 0 and ended.all():
+                        break
+        finally:
+            self.train()
+
+        L = lengths.max().item()
+        for field in fields:
+            scenes[field] = scenes[field][:, :L]
+        return scenes, lengths
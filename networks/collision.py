@@ -0,0 +1,117 @@
+import math
+import torch
+
+
+def obb_overlap(a, b):
+    # a, b: (..., 5) oriented boxes as (x, y, w, l, theta), broadcastable, the length along theta
+    # separating axis test on the two axes of each box, boxes that only touch do not overlap
+    d = b[..., :2] - a[..., :2]  # (..., 2)
+    axes = []
+    for box in (a, b):
+        cos, sin = torch.cos(box[..., 4]), torch.sin(box[..., 4])
+        axes.append(torch.stack([cos, sin], dim=-1))  # along the length
+        axes.append(torch.stack([-sin, cos], dim=-1))  # along the width
+    a_l, a_w, b_l, b_w = axes
+    separated = torch.zeros_like(d[..., 0], dtype=torch.bool)
+    for n in axes:
+        r_a = a[..., 3] / 2 * (a_l * n).sum(-1).abs() + a[..., 2] / 2 * (a_w * n).sum(-1).abs()
+        r_b = b[..., 3] / 2 * (b_l * n).sum(-1).abs() + b[..., 2] / 2 * (b_w * n).sum(-1).abs()
+        separated = separated | ((d * n).sum(-1).abs() >= r_a + r_b)
+    return ~separated
+
+
+# largest half diagonal of a box the cell grid of CollisionIndex reaches for, sampled boxes are clamped to it
+max_box_radius = 8.
+
+
+def clamp_box_size(wl, max_radius=max_box_radius):
+    # wl: (..., 2) box sizes, scaled down where the half diagonal exceeds max_radius, the aspect ratio kept
+    radius = wl.norm(dim=-1, keepdim=True) / 2
+    return wl * (max_radius / radius.clamp(min=1e-6)).clamp(max=1.)
+
+
+class CollisionIndex:
+    """
+    The oriented boxes placed in B scenes, hashed by their centers into a uniform grid of cell x cell meters.
+    A box can only overlap boxes whose centers are within twice max_radius, the largest half diagonal of a box,
+    so a query tests the boxes of the cells within that reach with obb_overlap. Boxes are stored in the cells
+    themselves, at most max_per_cell per cell, and everything stays on the device. Boxes that do not fit, in a
+    full cell or with a half diagonal past max_radius, go to a spill list of max_spill boxes per scene that
+    every query tests exhaustively. Past that they are lost, and overflow: (B, ) flags their scenes.
+    """
+
+    def __init__(self, B, device, cell=8., extent=40., max_radius=max_box_radius, max_per_cell=32, max_spill=64):
+        self.cell = cell
+        self.extent = extent
+        self.n_cells = math.ceil(2 * extent / cell)
+        self.max_radius = max_radius
+        self.reach = math.ceil(2 * max_radius / cell)
+        self.max_per_cell = max_per_cell
+        self.max_spill = max_spill
+        # the last slot of every cell and of the spill list takes the writes of the boxes that are not kept
+        # and is never read
+        self.boxes = torch.zeros(B, self.n_cells ** 2, max_per_cell + 1, 5, device=device)
+        self.count = torch.zeros(B, self.n_cells ** 2, dtype=torch.long, device=device)
+        self.spill = torch.zeros(B, max_spill + 1, 5, device=device)
+        self.spill_count = torch.zeros(B, dtype=torch.long, device=device)
+        self.overflow = torch.zeros(B, dtype=torch.bool, device=device)
+
+    @classmethod
+    def from_scenes(cls, location, bbox, lengths, **kwargs):
+        # location: (B, L, 2), bbox: (B, L, 3) padded scenes with lengths: (B, )
+        B, L = lengths.size(0), location.size(1)
+        index = cls(B, lengths.device, **kwargs)
+        valid = torch.arange(L, device=lengths.device) < lengths[:, None]
+        index.insert(torch.cat([location, bbox], dim=-1), valid)
+        return index
+
+    def _cell(self, xy):
+        # (..., 2) -> (...) row and column of the cell, positions off the grid fall in the border cells
+        col = torch.div(xy[..., 0] + self.extent, self.cell, rounding_mode='floor').long()
+        row = torch.div(xy[..., 1] + self.extent, self.cell, rounding_mode='floor').long()
+        return row.clamp(0, self.n_cells - 1), col.clamp(0, self.n_cells - 1)
+
+    def insert(self, boxes, valid):
+        # boxes: (B, T, 5) as (x, y, w, l, theta), valid: (B, T) which of them to add
+        B, T, _ = boxes.shape
+        row, col = self._cell(boxes[..., :2])
+        cell = row * self.n_cells + col  # (B, T)
+        # slot of every box after the boxes already in its cell and the earlier ones of this insert
+        fits = valid & (boxes[..., 2:4].norm(dim=-1) / 2 <= self.max_radius)
+        same = (cell[:, :, None] == cell[:, None, :]) & fits[:, None, :]  # (B, T, T)
+        earlier = same.tril(-1).sum(dim=-1)  # (B, T)
+        slot = self.count.gather(1, cell) + earlier
+        keep = fits & (slot < self.max_per_cell)
+        batch_idx = torch.arange(B, device=boxes.device)[:, None].expand(B, T)
+        slot = torch.where(keep, slot, self.max_per_cell)
+        self.boxes[batch_idx, cell, slot] = boxes.to(self.boxes.dtype)
+        self.count.scatter_add_(1, cell, keep.long())
+        # the rest goes to the spill list of the scene
+        spilled = valid & ~keep
+        slot = self.spill_count[:, None] + spilled.long().cumsum(dim=1) - 1
+        keep = spilled & (slot < self.max_spill)
+        self.spill[batch_idx, torch.where(keep, slot, self.max_spill)] = boxes.to(self.spill.dtype)
+        self.spill_count += keep.sum(dim=1)
+        self.overflow |= (spilled & ~keep).any(dim=1)
+
+    def query(self, boxes, index=None):
+        # boxes: (..., N, 5) candidates, index: (N, ) scene of each column, None for scene n
+        # returns (..., N), True where a candidate overlaps a placed box of its scene
+        N = boxes.size(-2)
+        if index is None:
+            index = torch.arange(N, device=boxes.device)
+        row, col = self._cell(boxes[..., :2])
+        offset = torch.arange(-self.reach, self.reach + 1, device=boxes.device)
+        rows = row[..., None, None] + offset[:, None]  # (..., N, R, 1)
+        cols = col[..., None, None] + offset[None, :]  # (..., N, 1, R)
+        inside = (rows >= 0) & (rows < self.n_cells) & (cols >= 0) & (cols < self.n_cells)  # (..., N, R, R)
+        cells = (rows.clamp(0, self.n_cells - 1) * self.n_cells + cols.clamp(0, self.n_cells - 1)).flatten(-2)
+        inside = inside.flatten(-2)  # (..., N, R * R)
+        scene = index[:, None].expand_as(cells)
+        neighbours = self.boxes[scene, cells]  # (..., N, R * R, max_per_cell + 1, 5)
+        filled = torch.arange(self.max_per_cell + 1, device=boxes.device) < self.count[scene, cells][..., None]
+        filled = filled & inside[..., None]  # (..., N, R * R, max_per_cell + 1)
+        overlap = obb_overlap(boxes[..., None, None, :], neighbours) & filled
+        spilled = torch.arange(self.max_spill + 1, device=boxes.device) < self.spill_count[index][:, None]
+        overlap_spilled = obb_overlap(boxes[..., None, :], self.spill[index]) & spilled  # (..., N, max_spill + 1)
+        return overlap.flatten(-2).any(dim=-1) | overlap_spilled.any(dim=-1)
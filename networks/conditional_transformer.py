@@ -2,12 +2,17 @@ import torch
 from torch import nn
 from torch.nn.modules.activation import MultiheadAttention
 from .embeddings import SinusoidalEmb, PositionalEncoding2D
-from .utils import MapIndexLayer
+from .utils import MapIndexLayer, checkpointed
+from .packing import PackedSequences, packed_encoder_layer
 
 
 class ConditionalEncoderLayer(nn.Module):
+    checkpoint_group = 'encoder_layer'
+
     def __init__(self, d_model, nhead, dim_map_embed=512, dim_feedforward=2048, dim_t_embed=256, dropout=0.1):
         super().__init__()
+        # recompute the block in backward instead of keeping the activations of its two transformer layers
+        self.checkpoint = False
         self.d_model = d_model
         self.in_layers = nn.ModuleList([
             nn.LayerNorm(d_model),
@@ -39,6 +44,9 @@ class ConditionalEncoderLayer(nn.Module):
         self.indexing = MapIndexLayer()
 
     def forward(self, src, t, fmap, loc, src_mask=None, src_key_padding_mask=None):
+        return checkpointed(self, self._forward, src, t, fmap, loc, src_mask, src_key_padding_mask)
+
+    def _forward(self, src, t, fmap, loc, src_mask=None, src_key_padding_mask=None):
         # incorporate map info
         h = src.clone()
         map_info = self.indexing(fmap, loc)
@@ -55,6 +63,29 @@ class ConditionalEncoderLayer(nn.Module):
         src = self.skip_conn(src) + h
         return src
 
+    def forward_packed(self, src, t, fmap, loc, packing):
+        return checkpointed(self, self._forward_packed, src, t, fmap, loc, packing)
+
+    def _forward_packed(self, src, t, fmap, loc, packing):
+        # src: (T, d_model) real tokens of the (B, L + 1) batch described by packing, token 0 of every sequence
+        # is the empty token that gets no map or time embedding
+        is_object = packing.position > 0  # (T, )
+        h = src
+        map_info = self.indexing(fmap, loc)  # (B, L, dim_map_embed)
+        map_info = torch.cat([torch.zeros_like(map_info[:, :1]), map_info], dim=1)
+        map_embed = self.map_mlp(packing.pack(map_info))  # (T, d_model)
+        h = h + map_embed * is_object[:, None]
+        h = self.in_layers[0](h)
+        h = self.in_layers[1](h)
+        h = packed_encoder_layer(self.in_layers[2], h, packing)
+        t_embed = self.time_mlp(t)[packing.batch_index]  # (T, d_model)
+        h = h + t_embed * is_object[:, None]
+        h = self.out_layers[0](h)
+        h = self.out_layers[1](h)
+        h = packed_encoder_layer(self.out_layers[2], h, packing)
+        src = self.skip_conn(src) + h
+        return src
+
 
 class NoisePredictor(nn.Module):
     def __init__(self, d_model, dim_t_embed):
@@ -81,9 +112,12 @@ class NoisePredictor(nn.Module):
 
 
 class ConditionalEncoder(nn.Module):
-    def __init__(self, d_model, n_layers, nhead=12, dim_map_embed=512, dim_feedforward=2048, dim_t_embed=256, dropout=0.1):
+    def __init__(self, d_model, n_layers, nhead=12, dim_map_embed=512, dim_feedforward=2048, dim_t_embed=256, dropout=0.1,
+                 packed=False):
         super().__init__()
         self.d_model = d_model
+        # with a padding mask, run the layers on the real tokens only
+        self.packed = packed
         self.layers = nn.ModuleList([
             ConditionalEncoderLayer(d_model, nhead, dim_map_embed, dim_feedforward, dim_t_embed, dropout)
             for _ in range(n_layers)
@@ -92,6 +126,8 @@ class ConditionalEncoder(nn.Module):
         self.noise_predictor = NoisePredictor(d_model, dim_t_embed=dim_t_embed)
 
     def forward(self, src, t, fmap, loc, src_mask=None, src_key_padding_mask=None):
+        if self.packed and src_mask is None and src_key_padding_mask is not None:
+            return self._forward_packed(src, t, fmap, loc, src_key_padding_mask)
         output = src
         for mod in self.layers:
             output = mod(output, t, fmap, loc, src_mask=src_mask, src_key_padding_mask=src_key_padding_mask)
@@ -99,6 +135,15 @@ class ConditionalEncoder(nn.Module):
             loc = (loc - noise).clamp(min=-1, max=1)
         return noise
 
+    def _forward_packed(self, src, t, fmap, loc, src_key_padding_mask):
+        packing = PackedSequences(~src_key_padding_mask)
+        output = packing.pack(src)
+        for mod in self.layers:
+            output = mod.forward_packed(output, t, fmap, loc, packing)
+            noise = self.noise_predictor(packing.unpack(output)[:, 1:], t)
+            loc = (loc - noise).clamp(min=-1, max=1)
+        return noise
+
 
 class TransformerBackbone(nn.Module):
     def __init__(self,
@@ -110,7 +155,8 @@ class TransformerBackbone(nn.Module):
                  nhead=12,
                  dim_feedforward=2048,
                  dim_t_embed=256,
-                 dropout=0.1):
+                 dropout=0.1,
+                 packed_attention=False):
         super().__init__()
         self.pos_embedding = SinusoidalEmb(dim_pos_embed, input_dim=2, T_min=1e-3, T_max=1e3)
         self.head = nn.Sequential(
@@ -129,14 +175,15 @@ class TransformerBackbone(nn.Module):
                                        dim_map_embed=dim_map_embed,
                                        dim_feedforward=dim_feedforward,
                                        dim_t_embed=dim_t_embed,
-                                       dropout=dropout)
+                                       dropout=dropout,
+                                       packed=packed_attention)
 
         self.category_embedding = nn.Embedding(3, dim_category_embed)
         self.empty_token = nn.Parameter(torch.randn(d_model))
 
     def forward(self, pos, original, fmap, t, mask=None):
-        # pos: (B, L, 2)
-        B = fmap.shape[0]
+        # pos: (B, L, 2), fmap: (B, 512, 320, 320) or (1, 512, 320, 320) shared by the batch
+        B = t.shape[0]
         x = [self.empty_token.reshape(1, 1, -1).repeat(B, 1, 1)]
         length = []
         for i, field in enumerate(['pedestrian', 'bicyclist', 'vehicle']):
@@ -151,7 +198,7 @@ class TransformerBackbone(nn.Module):
             feature = self.pe(feature, rank)
             x.append(feature)
         x = torch.cat(x, dim=1)  # (B, L + 1, d_model)
-        pad = torch.zeros(B, 1).to(x.device)
+        pad = torch.zeros(B, 1, dtype=torch.bool, device=x.device)
         mask = torch.cat([pad, mask], dim=1)
         loc = torch.cat(list(pos.values()), dim=1)
         x = self.body(x, t, fmap, loc, src_key_padding_mask=mask)
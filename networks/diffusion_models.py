@@ -5,7 +5,7 @@ from torch.distributions import Categorical
 import torchvision.transforms.functional as functional
 from .conditional_transformer import TransformerBackbone
 from .feature_extractors import Extractor
-from .utils import get_length_mask
+from .utils import get_length_mask, set_checkpointing
 from .losses import DiffusionLoss
 import math
 import numpy as np
@@ -26,6 +26,13 @@ class ObjectNumberPredictor(nn.Module):
         logits = self.model(fmap)
         return Categorical(logits=logits)
 
+    def predict(self, fmap, sample_shape=torch.Size(), mode=False):
+        # number of objects, drawn from the predicted distribution or its most likely value
+        prob = self(fmap)
+        if mode:
+            return prob.logits.argmax(dim=-1).expand(*sample_shape, *prob.batch_shape)
+        return prob.sample(sample_shape)
+
 
 class DiffusionBasedModel(nn.Module):
     @staticmethod
@@ -73,7 +80,7 @@ class DiffusionBasedModel(nn.Module):
         prob = prob / prob.sum(dim=(2, 3), keepdim=True)  # (B, L, size, size)
         return prob
 
-    def __init__(self, time_steps, axes_limit=40):
+    def __init__(self, time_steps, axes_limit=40, packed_attention=False, checkpoint=()):
         super().__init__()
         self.time_steps = time_steps
         blur_factors = self.blur_factor_schedule(time_steps)
@@ -85,7 +92,7 @@ class DiffusionBasedModel(nn.Module):
         self.n_pedestrian = ObjectNumberPredictor(128)
         self.n_bicyclist = ObjectNumberPredictor(128)
         self.n_vehicle = ObjectNumberPredictor(128)
-        self.backbone = TransformerBackbone()
+        self.backbone = TransformerBackbone(packed_attention=packed_attention)
 
         self.axes_limit = axes_limit
         self.loss_fn = DiffusionLoss(
@@ -99,6 +106,8 @@ class DiffusionBasedModel(nn.Module):
                 'vehicle': 2
             }
         )
+        # activation checkpointing, any of 'extractor' and 'encoder_layer'
+        set_checkpointing(self, checkpoint)
 
     def perturb(self, pts, t, area):
         # pts: (B, L, 2)
@@ -244,7 +253,7 @@ class DiffusionBasedModel(nn.Module):
         return pred
 
     @torch.no_grad()
-    def generate(self, maps, lengths=None):
+    def generate(self, maps, lengths=None, mode=False):
         B = maps.size(0)
         assert B == 1
         fmap, avg = self.feature_extractor(maps)  # (B, 512, 320, 320)
@@ -255,9 +264,9 @@ class DiffusionBasedModel(nn.Module):
         }
         # predict number of objects
         if lengths is None:
-            pred['pedestrian']['length'] = self.n_pedestrian(avg).sample().item()
-            pred['bicyclist']['length'] = self.n_bicyclist(avg).sample().item()
-            pred['vehicle']['length'] = self.n_vehicle(avg).sample().item()
+            pred['pedestrian']['length'] = self.n_pedestrian.predict(avg, mode=mode).item()
+            pred['bicyclist']['length'] = self.n_bicyclist.predict(avg, mode=mode).item()
+            pred['vehicle']['length'] = self.n_vehicle.predict(avg, mode=mode).item()
         else:
             pred['pedestrian']['length'] = lengths[0]
             pred['bicyclist']['length'] = lengths[1]
@@ -269,3 +278,52 @@ class DiffusionBasedModel(nn.Module):
         pred['vehicle']['location'] = []
         pred = self.sample_score_model(pred, maps, fmap)
         return pred
+
+    @torch.no_grad()
+    def generate_samples(self, maps, n_scenes, seed=None, lengths=None, mode=False):
+        """
+        n_scenes independent scenes for one map of shape (1, 5, 320, 320). The map is encoded once and shared by
+        all scenes, the number of objects is drawn per scene, and the scenes are denoised together as one padded
+        batch with the same updates as sample_score_model. seed makes the scenes reproducible; mode takes the most
+        likely number of objects instead of drawing it.
+        Returns the (K, ) lengths and the final (K, L, 2) padded locations of every category.
+        """
+        assert maps.size(0) == 1
+        K = n_scenes
+        device = maps.device
+        fields = ['pedestrian', 'bicyclist', 'vehicle']
+        predictors = [self.n_pedestrian, self.n_bicyclist, self.n_vehicle]
+        with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else [], enabled=seed is not None):
+            if seed is not None:
+                torch.manual_seed(seed)
+            fmap, avg = self.feature_extractor(maps)  # (1, 512, 320, 320)
+            pred = {}
+            for i, field in enumerate(fields):
+                if lengths is None:
+                    length = predictors[i].predict(avg, torch.Size([K]), mode).reshape(K)
+                else:
+                    length = torch.full((K, ), lengths[i], dtype=torch.long, device=device)
+                pred[field] = {'length': length}
+            masks = [get_length_mask(pred[field]['length']) for field in fields]
+            sizes = [m.size(1) for m in masks]
+            mask = torch.cat(masks, dim=1)  # (K, L)
+            # padding sits outside of the map, so it ranks after every object of its category
+            x = torch.rand(K, mask.size(1), 2, device=device) * 2 - 1
+            x = x.masked_fill(mask[..., None], 2.)
+            original = dict(zip(fields, x.clone().split(sizes, dim=1)))
+            for t in reversed(range(self.time_steps)):
+                t_normed = torch.full((K, ), t / self.time_steps, device=device)
+                pos = dict(zip(fields, x.split(sizes, dim=1)))
+                grad = torch.cat(list(self.backbone(pos, original, fmap, t_normed, mask).values()), dim=1)
+                # the noise term of sample_score_model is always zero, so only the step size changes
+                if t == 0:
+                    step_size = 0.2
+                elif t < 400:
+                    step_size = 0.1
+                else:
+                    step_size = 1.
+                x = (x - step_size * grad).clamp(min=-1, max=1)
+                x = x.masked_fill(mask[..., None], 2.)
+        for field, location in zip(fields, x.split(sizes, dim=1)):
+            pred[field]['location'] = location
+        return pred
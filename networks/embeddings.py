@@ -33,8 +33,12 @@ class TrainablePE(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
         self.pe = nn.Parameter(torch.randn(max_len, d_model))
 
-    def forward(self, x):
-        x = x + self.pe[:x.size(1)]
+    def forward(self, x, positions=None):
+        # positions: (B, L) index of each token, defaults to 0 ... L - 1
+        if positions is None:
+            x = x + self.pe[:x.size(1)]
+        else:
+            x = x + self.pe[positions]
         return self.dropout(x)
 
 
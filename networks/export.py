@@ -0,0 +1,241 @@
+import os
+import copy
+import json
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from .utils import get_length_mask
+
+
+def fold_batch_norm(module):
+    # fold every BatchNorm2d that directly follows a Conv2d in an nn.Sequential into the conv, in place
+    for m in module.modules():
+        if not isinstance(m, nn.Sequential):
+            continue
+        for i in range(len(m) - 1):
+            if isinstance(m[i], nn.Conv2d) and isinstance(m[i + 1], nn.BatchNorm2d):
+                m[i] = fuse_conv_bn_eval(m[i], m[i + 1])
+                m[i + 1] = nn.Identity()
+    return module
+
+
+def strip_dropout(module):
+    # replace dropout layers with identities and turn off attention dropout, in place
+    for m in module.modules():
+        for name, child in m.named_children():
+            if isinstance(child, nn.Dropout):
+                setattr(m, name, nn.Identity())
+        if isinstance(m, nn.MultiheadAttention):
+            m.dropout = 0.
+    return module
+
+
+def optimize_for_inference(model):
+    # eval copy of the model with batch norm folded, no dropout and channels-last convolutions
+    model = copy.deepcopy(model).eval()
+    fold_batch_norm(model)
+    strip_dropout(model)
+    for m in model.modules():
+        if isinstance(m, nn.TransformerEncoder):
+            # nested tensors read the padding back to the host and do not trace
+            m.enable_nested_tensor = m.use_nested_tensor = False
+    return model.to(memory_format=torch.channels_last)
+
+
+def bucket_for(length, buckets):
+    # smallest bucket that holds length
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    raise ValueError(f'length {length} exceeds the largest bucket {buckets[-1]}')
+
+
+def pad_to(x, length, dim=1):
+    # zero pad dimension dim of x to length
+    pad = list(x.shape)
+    pad[dim] = length - x.size(dim)
+    return torch.cat([x, x.new_zeros(pad)], dim=dim)
+
+
+class ARMapEncoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.feature_extractor = model.feature_extractor
+
+    def forward(self, maps):
+        # maps: (B, 26, 320, 320) -> (B, 128, 320, 320)
+        map_f, _ = self.feature_extractor(maps.contiguous(memory_format=torch.channels_last))
+        return map_f
+
+
+class ARStepEncoder(nn.Module):
+    # object embedding, transformer and category head of one generation step, for a fixed padded length
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, map_f, category, location, bbox, velocity, lengths):
+        # map_f: (B, 128, 320, 320), category, location (discrete): (B, L), bbox: (B, L, 3), velocity: (B, L, 2)
+        model = self.model
+        B, L = category.shape
+        objects = {'category': category, 'location': location, 'bbox': bbox, 'velocity': velocity}
+        object_f = model._embed_objects(objects, map_f)  # (B, L, d_model)
+        input_f = torch.cat([model.q.expand(B, 1, model.d_model), model.pe(object_f)], dim=1)
+        mask = get_length_mask(lengths + 1, L + 1)
+        output_f = model.transformer_encoder(input_f, src_key_padding_mask=mask)
+        output_f = output_f.masked_fill(mask[..., None], float('-inf')).max(dim=1)[0]  # (B, d_model)
+        logits_category = model.prob_category(torch.cat([output_f, map_f.mean(dim=(2, 3))], dim=-1))  # (B, 4)
+        return output_f, logits_category
+
+
+class ARLocationHead(nn.Module):
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, output_f, map_f):
+        # (B, d_model), (B, 128, 320, 320) -> (B, 320 * 320) location logits
+        return self.decoder(output_f, 'location', map_f=map_f)
+
+
+class ARBoxHead(nn.Module):
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, location_f):
+        # (B, 128) -> mixture parameters of wl and theta
+        return self.decoder(location_f, 'wl'), self.decoder(location_f, 'theta')
+
+
+class ARVelocityHead(nn.Module):
+    def __init__(self, model, decoder):
+        super().__init__()
+        self.pe_bbox = model.pe_bbox
+        self.decoder = decoder
+
+    def forward(self, location_f, bbox):
+        # (B, 128), (B, 3) -> moving logits and mixture parameters of s and omega
+        f_in = torch.cat([location_f, self.pe_bbox(bbox)], dim=-1)
+        return self.decoder(f_in, 'moving'), self.decoder(f_in, 's'), self.decoder(f_in, 'omega')
+
+
+class DiffusionMapEncoder(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.feature_extractor = model.feature_extractor
+        self.n_pedestrian = model.n_pedestrian.model
+        self.n_bicyclist = model.n_bicyclist.model
+        self.n_vehicle = model.n_vehicle.model
+
+    def forward(self, maps):
+        # maps: (B, 9, 320, 320) -> fmap and the logits of the number of objects per category
+        fmap, avg = self.feature_extractor(maps.contiguous(memory_format=torch.channels_last))
+        return fmap, self.n_pedestrian(avg), self.n_bicyclist(avg), self.n_vehicle(avg)
+
+
+class DiffusionDenoiser(nn.Module):
+    # TransformerBackbone on the objects of all categories concatenated, for a fixed padded length
+    def __init__(self, model):
+        super().__init__()
+        self.backbone = model.backbone
+
+    def forward(self, pos, original, category, fmap, t, padding):
+        # pos, original: (B, L, 2), category: (B, L) in 0 ... 2, fmap: (B, 512, 320, 320), t: (B, )
+        # padding: (B, L) True for padding, the objects are grouped by category like in TransformerBackbone
+        backbone = self.backbone
+        B = pos.size(0)
+        feature = torch.cat([backbone.category_embedding(category), backbone.pos_embedding(pos)], dim=-1)
+        feature = backbone.head(feature)
+        # rank within each category, like get_rank_from_pts on every category on its own
+        rank = torch.zeros_like(original, dtype=torch.long)
+        for c in range(3):
+            own = (category == c) & ~padding
+            key = original.masked_fill(~own[..., None], float('inf'))
+            rank = torch.where(own[..., None], key.argsort(dim=1).argsort(dim=1), rank)
+        feature = backbone.pe(feature, rank)
+        x = torch.cat([backbone.empty_token.reshape(1, 1, -1).expand(B, 1, -1), feature], dim=1)
+        mask = torch.cat([torch.zeros_like(padding[:, :1]), padding], dim=1)
+        return backbone.body(x, t, fmap, pos, src_key_padding_mask=mask)  # (B, L, 2)
+
+
+def _save(module, example_inputs, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_inputs)
+        traced = torch.jit.freeze(traced)
+    torch.jit.save(traced, path)
+
+
+def export_autoregressive(model, output_dir, batch_size=1, buckets=(8, 16, 32, 64, 128)):
+    # TorchScript graphs of one generation step of an AutoregressiveTransformer: the map encoder, the step encoder
+    # for every padded length in buckets and the heads of every decoder. Sampling stays with the caller.
+    if model.hierarchical_location:
+        raise ValueError('only the full resolution location head can be exported')
+    if model.causal:
+        # ARStepEncoder max pools without the causal mask and embeds objects on the current map features
+        raise ValueError('only models built with causal=False can be exported')
+    os.makedirs(output_dir, exist_ok=True)
+    model = optimize_for_inference(model)
+    device = next(model.parameters()).device
+    B = batch_size
+    maps = torch.zeros(B, 26, 320, 320, device=device)
+    _save(ARMapEncoder(model), (maps, ), os.path.join(output_dir, 'ar_map_encoder.pt'))
+    with torch.no_grad():
+        map_f = ARMapEncoder(model)(maps)
+    for L in buckets:
+        example = (map_f,
+                   torch.zeros(B, L, dtype=torch.long, device=device),
+                   torch.zeros(B, L, dtype=torch.long, device=device),
+                   torch.ones(B, L, 3, device=device),
+                   torch.ones(B, L, 2, device=device),
+                   torch.full((B, ), L // 2, dtype=torch.long, device=device))
+        _save(ARStepEncoder(model), example, os.path.join(output_dir, f'ar_step-{L}.pt'))
+    output_f = torch.zeros(B, model.d_model, device=device)
+    location_f = torch.zeros(B, 128, device=device)
+    bbox = torch.ones(B, 3, device=device)
+    for name in ['pedestrian', 'bicyclist', 'vehicle']:
+        decoder = getattr(model, f'decoder_{name}')
+        _save(ARLocationHead(decoder), (output_f, map_f), os.path.join(output_dir, f'ar_{name}_location.pt'))
+        _save(ARBoxHead(decoder), (location_f, ), os.path.join(output_dir, f'ar_{name}_box.pt'))
+        _save(ARVelocityHead(model, decoder), (location_f, bbox), os.path.join(output_dir, f'ar_{name}_velocity.pt'))
+    with open(os.path.join(output_dir, 'ar_manifest.json'), 'w') as f:
+        json.dump({'batch_size': B, 'buckets': list(buckets)}, f)
+
+
+def export_diffusion(model, output_dir, batch_size=1, buckets=(32, 64, 128, 256, 384)):
+    # TorchScript graphs of the Extractor with the object number heads, and of the TransformerBackbone for every
+    # padded total number of objects in buckets
+    os.makedirs(output_dir, exist_ok=True)
+    model = optimize_for_inference(model)
+    device = next(model.parameters()).device
+    B = batch_size
+    maps = torch.zeros(B, 9, 320, 320, device=device)
+    _save(DiffusionMapEncoder(model), (maps, ), os.path.join(output_dir, 'diffusion_map_encoder.pt'))
+    with torch.no_grad():
+        fmap = DiffusionMapEncoder(model)(maps)[0]
+    for L in buckets:
+        pos = torch.rand(B, L, 2, device=device) * 2 - 1
+        category = torch.arange(L, device=device).expand(B, L) * 3 // L
+        padding = torch.zeros(B, L, dtype=torch.bool, device=device)
+        example = (pos, pos.clone(), category, fmap, torch.full((B, ), 0.5, device=device), padding)
+        _save(DiffusionDenoiser(model), example, os.path.join(output_dir, f'diffusion_denoiser-{L}.pt'))
+    with open(os.path.join(output_dir, 'diffusion_manifest.json'), 'w') as f:
+        json.dump({'batch_size': B, 'buckets': list(buckets)}, f)
+
+
+def load_exported(output_dir, prefix, map_location='cpu'):
+    # {name: module} for the fixed shape graphs and {name: {bucket: module}} for the bucketed ones
+    with open(os.path.join(output_dir, f'{prefix}_manifest.json')) as f:
+        manifest = json.load(f)
+    modules = {'batch_size': manifest['batch_size'], 'buckets': manifest['buckets']}
+    for file in sorted(os.listdir(output_dir)):
+        if not (file.startswith(prefix + '_') and file.endswith('.pt')):
+            continue
+        name = file[len(prefix) + 1:-3]
+        module = torch.jit.load(os.path.join(output_dir, file), map_location=map_location)
+        if '-' in name:
+            name, bucket = name.split('-')
+            modules.setdefault(name, {})[int(bucket)] = module
+        else:
+            modules[name] = module
+    return modules
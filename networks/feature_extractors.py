@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+from .utils import checkpointed
 
 
 class ResBlock(nn.Module):
@@ -26,8 +27,12 @@ class ResBlock(nn.Module):
 
 
 class Extractor(nn.Module):
-    def __init__(self, input_channels):
+    checkpoint_group = 'extractor'
+
+    def __init__(self, input_channels, output_channels=512):
         super().__init__()
+        # recompute the stages in backward instead of keeping their activations
+        self.checkpoint = False
         self.body = nn.ModuleList([
             nn.Sequential(
                 nn.Conv2d(in_channels=input_channels, out_channels=128, kernel_size=5, padding=2, padding_mode='reflect'),
@@ -88,18 +93,61 @@ class Extractor(nn.Module):
             nn.Conv2d(in_channels=512, out_channels=512, kernel_size=3, padding=1),
             nn.BatchNorm2d(512),
             nn.ReLU(),
-            nn.Conv2d(in_channels=512, out_channels=512, kernel_size=3, padding=1),
-            nn.BatchNorm2d(512),
+            nn.Conv2d(in_channels=512, out_channels=output_channels, kernel_size=3, padding=1),
+            nn.BatchNorm2d(output_channels),
         )
 
+    def _head(self, *hs):
+        # the upsampled tails and the refine stage hold most of the activations, all at 320 x 320
+        fmaps = [self.tail[i](h) for i, h in enumerate(hs)]
+        avg = fmaps[-1].mean(dim=(2, 3))
+        fmaps = torch.cat(fmaps, dim=1)
+        fmaps = self.refine(fmaps)
+        return fmaps, avg
+
     def forward(self, x):
         # x: (B, input_channels, 320, 320)
-        fmaps = []
+        hs = []
         h = x
         for i in range(4):
-            h = self.body[i](h)
-            fmaps.append(self.tail[i](h))
-        avg = fmaps[-1].mean(dim=(2, 3))
-        fmaps = torch.cat(fmaps, dim=1)
-        fmaps = self.refine(fmaps)
+            h = checkpointed(self, self.body[i], h)
+            hs.append(h)
+        return checkpointed(self, self._head, *hs)
+
+
+class SplitExtractor(nn.Module):
+    # The static map channels go through a full Extractor that can be run once per scene and cached, the object
+    # channels through a light full-resolution branch that is re-run after every placed object.
+    def __init__(self, static_channels=8, dynamic_channels=18, output_channels=128, dynamic_hidden=64):
+        super().__init__()
+        self.static_channels = static_channels
+        self.static = Extractor(static_channels, output_channels=output_channels)
+        self.dynamic = nn.Sequential(
+            nn.Conv2d(in_channels=dynamic_channels, out_channels=dynamic_hidden, kernel_size=5, padding=2),
+            nn.BatchNorm2d(dynamic_hidden),
+            nn.ReLU(),
+            nn.Conv2d(in_channels=dynamic_hidden, out_channels=dynamic_hidden, kernel_size=3, padding=2, dilation=2),
+            nn.BatchNorm2d(dynamic_hidden),
+            nn.ReLU(),
+            nn.Conv2d(in_channels=dynamic_hidden, out_channels=dynamic_hidden, kernel_size=3, padding=4, dilation=4),
+            nn.BatchNorm2d(dynamic_hidden),
+            nn.ReLU()
+        )
+        self.fuse = nn.Sequential(
+            nn.Conv2d(in_channels=output_channels + dynamic_hidden, out_channels=output_channels, kernel_size=1),
+            nn.BatchNorm2d(output_channels)
+        )
+
+    def encode_static(self, x):
+        # x: (B, >= static_channels, 320, 320)
+        static_f, _ = self.static(x[:, :self.static_channels])
+        return static_f  # (B, output_channels, 320, 320)
+
+    def forward(self, x, static_f=None):
+        # x: (B, static_channels + dynamic_channels, 320, 320), static_f: cached output of encode_static
+        if static_f is None:
+            static_f = self.encode_static(x)
+        dynamic_f = self.dynamic(x[:, self.static_channels:])
+        fmaps = self.fuse(torch.cat([static_f, dynamic_f], dim=1))
+        avg = fmaps.mean(dim=(2, 3))
         return fmaps, avg
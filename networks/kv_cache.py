@@ -0,0 +1,57 @@
+import torch
+from torch.nn import functional as F
+
+
+class KVCache:
+    """
+    Keys and values of every layer of an nn.TransformerEncoder for causal attention, so new tokens are encoded
+    against the cached tokens instead of re-encoding the whole sequence. Token s of each sequence is stored in
+    slot s of preallocated (B, n_head, max_len, d_head) buffers; a token attends to the slots up to its own.
+    """
+
+    def __init__(self, encoder, B, max_len, device, dtype=torch.float):
+        attn = encoder.layers[0].self_attn
+        shape = (len(encoder.layers), B, attn.num_heads, max_len, attn.embed_dim // attn.num_heads)
+        self.k = torch.zeros(shape, device=device, dtype=dtype)
+        self.v = torch.zeros(shape, device=device, dtype=dtype)
+        self.max_len = max_len
+
+
+def cached_self_attention(attn, x, k_cache, v_cache, slot):
+    # attn: nn.MultiheadAttention, x: (B, T, d_model) tokens at slots slot ... slot + T - 1, slot: (B, )
+    # k_cache, v_cache: (B, n_head, max_len, d_head) of one layer, the keys and values of x are written in place
+    B, T, _ = x.shape
+    n_head = attn.num_heads
+    q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)  # (B, T, d_model) each
+    q, k, v = [y.reshape(B, T, n_head, -1).transpose(1, 2) for y in (q, k, v)]  # (B, n_head, T, d_head)
+    position = slot[:, None] + torch.arange(T, device=x.device)  # (B, T)
+    batch_idx = torch.arange(B, device=x.device)[:, None]
+    k_cache[batch_idx, :, position] = k.transpose(1, 2)
+    v_cache[batch_idx, :, position] = v.transpose(1, 2)
+    visible = torch.arange(k_cache.size(2), device=x.device) <= position[..., None]  # (B, T, max_len)
+    out = F.scaled_dot_product_attention(q, k_cache, v_cache, attn_mask=visible[:, None])
+    return attn.out_proj(out.transpose(1, 2).reshape(B, T, -1))
+
+
+def cached_encoder_layer(layer, x, k_cache, v_cache, slot):
+    # layer: nn.TransformerEncoderLayer in eval mode, x: (B, T, d_model)
+    def feed_forward(h):
+        return layer.linear2(layer.activation(layer.linear1(h)))
+
+    if layer.norm_first:
+        x = x + cached_self_attention(layer.self_attn, layer.norm1(x), k_cache, v_cache, slot)
+        x = x + feed_forward(layer.norm2(x))
+    else:
+        x = layer.norm1(x + cached_self_attention(layer.self_attn, x, k_cache, v_cache, slot))
+        x = layer.norm2(x + feed_forward(x))
+    return x
+
+
+def cached_encoder(encoder, x, cache, slot):
+    # encoder: nn.TransformerEncoder, x: (B, T, d_model) the next T tokens of every sequence, starting at slot (B, )
+    # Slots past a sequence's last real token may be written with padding, they are overwritten when reached.
+    for i, layer in enumerate(encoder.layers):
+        x = cached_encoder_layer(layer, x, cache.k[i], cache.v[i], slot)
+    if encoder.norm is not None:
+        x = encoder.norm(x)
+    return x
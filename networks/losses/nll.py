@@ -1,6 +1,5 @@
 import torch
 from torch import nn
-import math
 
 
 class WeightedNLL(nn.Module):
@@ -12,19 +11,6 @@ class WeightedNLL(nn.Module):
             self.weights[k] = self.weights[k] / total
         self._eps = 1e-6  # numerical stability for LogNorm
 
-    def _loss_vonmises(self, x, prob):
-        # x: (B, 1)
-        mixture = prob.params['mixture']  # (B, n_mixture)
-        cos = prob.params['cos'].squeeze()  # (B, n_mixture)
-        sin = prob.params['sin'].squeeze()  # (B, n_mixture)
-        kappa = prob.params['kappa'].squeeze()  # (B, n_mixture)
-        B, n_mixture = mixture.shape
-        x = x.expand(B, n_mixture)
-        log_prob = kappa * (torch.cos(x) * cos + torch.sin(x) * sin) - _log_modified_bessel_fn(kappa) - math.log(2 * math.pi)  # (B, n_mixture)
-        logits = torch.log_softmax(mixture, dim=-1)
-        loss = -torch.logsumexp(log_prob + logits, dim=-1)
-        return loss
-
     def forward(self, probs, gt):
         device = gt['category'].device
 
@@ -39,7 +25,7 @@ class WeightedNLL(nn.Module):
         loss_wl = torch.where(gt['category'] == 0,
                               torch.tensor(0., device=device),
                               loss_wl)
-        loss_theta = self._loss_vonmises(gt['bbox'][:, 2:], probs['theta'])
+        loss_theta = -probs['theta'].log_prob(gt['bbox'][:, 2:])
         loss_theta = torch.where(gt['category'] == 0,
                                  torch.tensor(0., device=device),
                                  loss_theta)
@@ -51,7 +37,7 @@ class WeightedNLL(nn.Module):
         loss_s = torch.where(gt['category'] == 0,
                              torch.tensor(0., device=device),
                              loss_s)
-        loss_omega = self._loss_vonmises(gt['velocity'][:, 1:], probs['omega'])
+        loss_omega = -probs['omega'].log_prob(gt['velocity'][:, 1:])
         loss_omega = torch.where(gt['velocity'][:, 0] == 0,
                                  torch.tensor(0., device=device),
                                  loss_omega)
@@ -92,24 +78,3 @@ def lr_func(warmup):
 
     return inner
 
-
-def _eval_poly(y, coef):
-    coef = list(coef)
-    result = coef.pop()
-    while coef:
-        result = coef.pop() + y * result
-    return result
-
-
-def _log_modified_bessel_fn(x):
-    # compute small solution
-    y = (x / 3.75)
-    y = y * y
-    small = _eval_poly(y, [1.0, 3.5156229, 3.0899424, 1.2067492, 0.2659732, 0.360768e-1, 0.45813e-2])
-    small = small.log()
-    # compute large solution
-    y = 3.75 / x
-    large = x - 0.5 * x.log() + _eval_poly(y, [0.39894228, 0.1328592e-1, 0.225319e-2, -0.157565e-2, 0.916281e-2,
-                                              -0.2057706e-1, 0.2635537e-1, -0.1647633e-1, 0.392377e-2]).log()
-    result = torch.where(x < 3.75, small, large)
-    return result
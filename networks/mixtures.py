@@ -0,0 +1,151 @@
+import math
+import torch
+
+
+def log_i0(x):
+    # log of the modified Bessel function of the first kind of order 0, through the exponentially scaled i0e
+    return torch.special.i0e(x).log() + x
+
+
+@torch.no_grad()
+def sample_vonmises(loc, concentration, n_proposals=16):
+    # Best-Fisher rejection sampling with a fixed number of proposals per sample, instead of looping until every
+    # sample is accepted, so sampling never waits on the host. With kappa >= 15 as in this model, about two in
+    # three proposals are accepted; a sample with no accepted proposal falls back to the mean.
+    kappa = concentration.double()
+    tau = 1 + (1 + 4 * kappa ** 2).sqrt()
+    rho = (tau - (2 * tau).sqrt()) / (2 * kappa)
+    proposal_r = (1 + rho ** 2) / (2 * rho)
+    u1, u2, u3 = torch.rand((3, n_proposals, *kappa.shape), dtype=kappa.dtype, device=kappa.device)
+    z = torch.cos(math.pi * u1)
+    f = (1 + proposal_r * z) / (proposal_r + z)
+    c = kappa * (proposal_r - f)
+    accept = (c * (2 - c) - u2 > 0) | ((c / u2).log() + 1 - c >= 0)  # (n_proposals, ...)
+    x = torch.sign(u3 - 0.5) * torch.acos(f)
+    x = x.gather(0, accept.float().argmax(dim=0, keepdim=True)).squeeze(0)  # first accepted proposal
+    x = torch.where(accept.any(dim=0), x, torch.zeros_like(x))
+    return ((x + math.pi + loc) % (2 * math.pi) - math.pi).to(loc.dtype)
+
+
+def _sample_component(logits, sample_shape):
+    # Gumbel-max draw of one component per sample, logits: (B, K) -> (*sample_shape, B)
+    u = torch.rand((*sample_shape, *logits.shape), dtype=logits.dtype, device=logits.device)
+    gumbel = -(-u.clamp_min(torch.finfo(u.dtype).tiny).log()).log()
+    return (logits + gumbel).argmax(dim=-1)
+
+
+def _gather_component(x, component):
+    # x: (B, K, E) component parameters, component: (*S, B) -> (*S, B, E)
+    x = x.expand(*component.shape, *x.shape[-2:])
+    index = component[..., None, None].expand(*component.shape, 1, x.size(-1))
+    return x.gather(-2, index).squeeze(-2)
+
+
+def _best_start(prob, starts):
+    # starts: (K, B, E) the mode of every component -> (B, E) the one where the mixture density is highest
+    best = prob.log_prob(starts).argmax(dim=0)  # (B, )
+    return starts.gather(0, best[None, :, None].expand(1, *starts.shape[1:])).squeeze(0)
+
+
+def _keep_better(prob, x, start):
+    # a refinement step never lowers the density below that of its start
+    better = prob.log_prob(x) >= prob.log_prob(start)
+    return torch.where(better[..., None], x, start)
+
+
+class MixtureLogNormal:
+    """
+    Mixture of K log-normal distributions with diagonal covariance over an event of size E, evaluated directly
+    on the head outputs instead of through Categorical, LogNormal, Independent and MixtureSameFamily.
+    logits: (B, K), mu, sigma: (B, K, E)
+    """
+
+    def __init__(self, logits, mu, sigma):
+        self.logits = logits.log_softmax(dim=-1)
+        self.mu = mu
+        self.sigma = sigma
+        self.batch_shape = logits.shape[:-1]
+        self.event_shape = mu.shape[-1:]
+
+    def _joint_log_prob(self, x):
+        # x: (..., B, E) -> (..., B, K) log p(x, component)
+        log_x = x.log().unsqueeze(-2)  # (..., B, 1, E)
+        z = (log_x - self.mu) / self.sigma
+        log_prob = (-0.5 * z ** 2 - self.sigma.log() - log_x).sum(dim=-1)  # (..., B, K)
+        log_prob = log_prob - 0.5 * self.mu.size(-1) * math.log(2 * math.pi)
+        return log_prob + self.logits
+
+    def log_prob(self, x):
+        # x: (..., B, E) -> (..., B)
+        return torch.logsumexp(self._joint_log_prob(x), dim=-1)
+
+    @torch.no_grad()
+    def mode(self, n_iters=3):
+        # (B, E), starting from the component mode exp(mu - sigma^2) with the highest mixture density, refined
+        # with fixed-point steps on y = log x: the stationary point of log p(x) solves
+        # y = (sum_k r_k mu_k / sigma_k^2 - 1) / (sum_k r_k / sigma_k^2) for the responsibilities r_k at x
+        start = _best_start(self, (self.mu - self.sigma ** 2).exp().movedim(-2, 0))
+        precision = self.sigma ** -2  # (B, K, E)
+        x = start
+        for _ in range(n_iters):
+            r = self._joint_log_prob(x).softmax(dim=-1)[..., None]  # (B, K, 1)
+            y = ((r * self.mu * precision).sum(dim=-2) - 1) / (r * precision).sum(dim=-2)
+            x = y.exp()
+        return _keep_better(self, x, start)
+
+    @torch.no_grad()
+    def sample(self, sample_shape=torch.Size()):
+        # (*sample_shape, B, E)
+        component = _sample_component(self.logits, sample_shape)
+        mu = _gather_component(self.mu, component)
+        sigma = _gather_component(self.sigma, component)
+        return (mu + sigma * torch.randn_like(mu)).exp()
+
+
+class MixtureVonMises:
+    """
+    Mixture of K von Mises distributions over an event of E angles. The component means are given by their
+    cosine and sine, which are used as they are in the log-probability.
+    logits: (B, K), cos, sin, kappa: (B, K, E)
+    """
+
+    def __init__(self, logits, cos, sin, kappa):
+        self.logits = logits.log_softmax(dim=-1)
+        self.cos = cos
+        self.sin = sin
+        self.kappa = kappa
+        self.batch_shape = logits.shape[:-1]
+        self.event_shape = cos.shape[-1:]
+
+    @property
+    def loc(self):
+        return torch.atan2(self.sin, self.cos)  # (B, K, E)
+
+    def _joint_log_prob(self, x):
+        # x: (..., B, E) -> (..., B, K) log p(x, component)
+        x = x.unsqueeze(-2)  # (..., B, 1, E)
+        log_prob = self.kappa * (torch.cos(x) * self.cos + torch.sin(x) * self.sin) - log_i0(self.kappa)
+        log_prob = log_prob.sum(dim=-1) - self.cos.size(-1) * math.log(2 * math.pi)  # (..., B, K)
+        return log_prob + self.logits
+
+    def log_prob(self, x):
+        # x: (..., B, E) -> (..., B)
+        return torch.logsumexp(self._joint_log_prob(x), dim=-1)
+
+    @torch.no_grad()
+    def mode(self, n_iters=3):
+        # (B, E), starting from the component mean with the highest mixture density, refined with EM steps:
+        # the stationary point of log p(x) solves sum_k r_k kappa_k sin(loc_k - x) = 0 for the responsibilities
+        # r_k at x, so x moves to the direction of the r_k kappa_k weighted sum of the component means
+        start = _best_start(self, self.loc.movedim(-2, 0))
+        x = start
+        for _ in range(n_iters):
+            w = self._joint_log_prob(x).softmax(dim=-1)[..., None] * self.kappa  # (B, K, E)
+            x = torch.atan2((w * self.sin).sum(dim=-2), (w * self.cos).sum(dim=-2))
+        return _keep_better(self, x, start)
+
+    @torch.no_grad()
+    def sample(self, sample_shape=torch.Size()):
+        # (*sample_shape, B, E)
+        component = _sample_component(self.logits, sample_shape)
+        return sample_vonmises(_gather_component(self.loc, component), _gather_component(self.kappa, component))
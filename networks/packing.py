@@ -0,0 +1,87 @@
+import torch
+from torch.nn import functional as F
+
+
+class PackedSequences:
+    """
+    The real tokens of a padded (B, S, ...) batch concatenated into (T, ...), so the per-token parts of a
+    transformer (projections, feed forward, layer norms) skip the padding.
+    valid: (B, S), True for real tokens. They do not need to be contiguous.
+    For attention the sequences are grouped into buckets of lengths in (2^(i-1), 2^i], and every bucket is laid
+    out densely with its real tokens only, so attention runs on at most twice the real length of each sequence
+    instead of on S.
+    """
+
+    def __init__(self, valid):
+        self.valid = valid
+        self.batch_index, self.position = valid.nonzero(as_tuple=True)  # (T, )
+        lengths = valid.sum(dim=1)  # (B, )
+        offset = lengths.cumsum(dim=0) - lengths  # first token of every sequence in the pack
+        bucket = torch.ceil(torch.log2(lengths.clamp(min=1).float())).long()
+        # (token, real): (b, width) pack index of every slot of a bucket and whether it holds a real token
+        self.buckets = []
+        for i in bucket.unique().tolist():
+            sequences = (bucket == i).nonzero(as_tuple=True)[0]
+            n = lengths[sequences]
+            width = n.max().item()
+            if width == 0:
+                continue
+            slot = torch.arange(width, device=valid.device)
+            real = slot < n[:, None]
+            token = torch.where(real, offset[sequences, None] + slot, torch.zeros_like(slot))
+            self.buckets.append((token, real))
+
+    def pack(self, x):
+        # x: (B, S, ...) -> (T, ...)
+        return x[self.batch_index, self.position]
+
+    def unpack(self, x):
+        # x: (T, ...) -> (B, S, ...), zeros at the padding
+        out = x.new_zeros((*self.valid.shape, *x.shape[1:]))
+        out[self.batch_index, self.position] = x
+        return out
+
+
+def packed_self_attention(attn, x, packing, attn_mask=None):
+    # attn: nn.MultiheadAttention, x: (T, d_model), attn_mask: (S, S) True where attention is blocked
+    # Queries, keys and values are projected on the packed tokens, attention runs once per length bucket on
+    # its real tokens, with attn_mask looked up at their positions in the padded layout.
+    n_head = attn.num_heads
+    q, k, v = F.linear(x, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)  # (T, d_model) each
+    out = torch.zeros_like(q)
+    for token, real in packing.buckets:
+        b, width = token.shape
+        q_b, k_b, v_b = [y[token].reshape(b, width, n_head, -1).transpose(1, 2) for y in (q, k, v)]
+        allowed = real[:, None, :].expand(b, width, width)  # (b, width, width)
+        if attn_mask is not None:
+            position = packing.position[token]
+            allowed = allowed & ~attn_mask[position[:, :, None], position[:, None, :]]
+        # padding slots attend to themselves, so no row of the softmax is empty
+        allowed = allowed | (~real[:, :, None] & torch.eye(width, dtype=torch.bool, device=x.device))
+        out_b = F.scaled_dot_product_attention(q_b, k_b, v_b, attn_mask=allowed[:, None],
+                                               dropout_p=attn.dropout if attn.training else 0.)
+        out[token[real]] = out_b.transpose(1, 2).reshape(b, width, -1)[real]
+    return attn.out_proj(out)  # (T, d_model)
+
+
+def packed_encoder_layer(layer, x, packing, attn_mask=None):
+    # layer: nn.TransformerEncoderLayer, x: (T, d_model)
+    def feed_forward(h):
+        return layer.dropout2(layer.linear2(layer.dropout(layer.activation(layer.linear1(h)))))
+
+    if layer.norm_first:
+        x = x + layer.dropout1(packed_self_attention(layer.self_attn, layer.norm1(x), packing, attn_mask))
+        x = x + feed_forward(layer.norm2(x))
+    else:
+        x = layer.norm1(x + layer.dropout1(packed_self_attention(layer.self_attn, x, packing, attn_mask)))
+        x = layer.norm2(x + feed_forward(x))
+    return x
+
+
+def packed_encoder(encoder, x, packing, attn_mask=None):
+    # encoder: nn.TransformerEncoder, x: (T, d_model)
+    for layer in encoder.layers:
+        x = packed_encoder_layer(layer, x, packing, attn_mask)
+    if encoder.norm is not None:
+        x = encoder.norm(x)
+    return x
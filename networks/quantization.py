@@ -0,0 +1,63 @@
+import copy
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from .feature_extractors import SplitExtractor
+
+
+def _disable_fastpath(module, args):
+    module._fastpath_enabled = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+
+
+def _restore_fastpath(module, args, output):
+    torch.backends.mha.set_fastpath_enabled(module._fastpath_enabled)
+
+
+def quantize_linear(model):
+    # int8 dynamic quantization of the nn.Linear layers of an eval copy of model, for CPU inference
+    # The input and output projections of nn.MultiheadAttention stay float, torch does not quantize them.
+    model = copy.deepcopy(model).eval()
+    for m in model.modules():
+        if isinstance(m, (nn.TransformerEncoder, nn.TransformerEncoderLayer)):
+            # the fused fast path reads float weights from linear1 and linear2, the quantized layers run the
+            # regular path with the fast path switched off for the duration of their forward
+            m.register_forward_pre_hook(_disable_fastpath)
+            m.register_forward_hook(_restore_fastpath)
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_extractor(extractor, calibration_maps, backend='fbgemm'):
+    # int8 static quantization of an Extractor, with activation ranges observed on calibration_maps,
+    # an iterable of (B, input_channels, 320, 320) maps
+    torch.backends.quantized.engine = backend
+    calibration_maps = iter(calibration_maps)
+    maps = next(calibration_maps)
+    extractor = copy.deepcopy(extractor).eval()
+    extractor.checkpoint = False
+    prepared = prepare_fx(extractor, get_default_qconfig_mapping(backend), example_inputs=(maps, ))
+    with torch.no_grad():
+        prepared(maps)
+        for maps in calibration_maps:
+            prepared(maps)
+    return convert_fx(prepared)
+
+
+def quantize_model(model, calibration_maps=None, backend='fbgemm'):
+    """
+    Int8 CPU inference copy of an AutoregressiveTransformer or a DiffusionBasedModel. The linear layers are
+    quantized dynamically. If calibration_maps, an iterable of model input maps, is given, the convs of the
+    feature extractor are quantized statically as well; with a SplitExtractor only its static Extractor is.
+    """
+    torch.backends.quantized.engine = backend
+    model = quantize_linear(model)
+    if calibration_maps is None:
+        return model
+    extractor = model.feature_extractor
+    if isinstance(extractor, SplitExtractor):
+        static_maps = (maps[:, :extractor.static_channels] for maps in calibration_maps)
+        extractor.static = quantize_extractor(extractor.static, static_maps, backend)
+    else:
+        model.feature_extractor = quantize_extractor(extractor, calibration_maps, backend)
+    return model
@@ -1,5 +1,8 @@
+import contextlib
+import warnings
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 
 def get_mlp(hidden_size, output_size):
@@ -15,9 +18,44 @@ def get_mlp(hidden_size, output_size):
     return nn.Sequential(*mlp_layers)
 
 
-def get_length_mask(lengths):
+@contextlib.contextmanager
+def _frozen_bn_stats(module):
+    # the recomputed forward must not update the batch norm running statistics a second time
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [bn.momentum for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, momentum in zip(bns, momenta):
+            bn.momentum = momentum
+
+
+def checkpointed(module, fn, *args):
+    # fn(*args) under non-reentrant activation checkpointing if module.checkpoint is set and gradients are needed
+    if not (getattr(module, 'checkpoint', False) and module.training and torch.is_grad_enabled()):
+        return fn(*args)
+    return checkpoint(fn, *args, use_reentrant=False,
+                      context_fn=lambda: (contextlib.nullcontext(), _frozen_bn_stats(module)))
+
+
+def set_checkpointing(model, groups):
+    # turn activation checkpointing on for the modules whose checkpoint_group is in groups, off for the rest
+    # groups: 'extractor', 'decoder' (AutoregressiveTransformer), 'encoder_layer' (ConditionalEncoderLayer)
+    groups = set(groups)
+    for m in model.modules():
+        group = getattr(m, 'checkpoint_group', None)
+        if group is not None:
+            m.checkpoint = group in groups
+    return model
+
+
+def get_length_mask(lengths, L=None):
+    # True for padding
     N = lengths.shape[0]
-    L = lengths.max()
+    if L is None:
+        L = lengths.max()
     idx_range = torch.arange(L, device=lengths.device).expand(N, -1)
     lengths = lengths.reshape(-1, 1).expand(-1, L)
     return idx_range >= lengths
@@ -38,6 +76,9 @@ class MapIndexLayer(nn.Module):
         row = ((1 - y) * wl / 2).long()
         col = ((1 + x) * wl / 2).long()
         idx = row * wl + col  # (B, L)
+        if fmap.size(0) == 1 and idx.size(0) > 1:
+            # one map shared by every sequence of the batch
+            return fmap.flatten(2, 3)[0][:, idx].permute(1, 2, 0)  # (B, L, C)
         idx = idx[..., None].repeat(1, 1, C)  # (B, L, C)
         fmap = fmap.flatten(2, 3).permute(0, 2, 1)  # (B, wl * wl, C)
         indexed = fmap.gather(dim=1, index=idx)  # (B, L, C)
@@ -76,3 +117,35 @@ class TrainableIndexLayer(nn.Module):
         weight = self.softmax(weight)
         weight = weight.reshape(B, L, 1, 64, 64)
         return weight
+
+
+class SyncCounter:
+    """
+    Counts the host-device synchronizations of CUDA operations run inside the block, from the warnings of
+    torch.cuda.set_sync_debug_mode. Always 0 on CPU.
+
+        with SyncCounter() as syncs:
+            ...
+        print(syncs.count)
+    """
+
+    def __enter__(self):
+        self.count = 0
+        self._catch = warnings.catch_warnings(record=True)
+        self._records = self._catch.__enter__()
+        warnings.simplefilter('always')
+        if torch.cuda.is_available():
+            self._mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode('warn')
+        return self
+
+    def __exit__(self, *exc):
+        if torch.cuda.is_available():
+            torch.cuda.set_sync_debug_mode(self._mode)
+        self._catch.__exit__(*exc)
+        self.count = sum('synchronizing' in str(record.message) for record in self._records)
+        # pass the other warnings on
+        for record in self._records:
+            if 'synchronizing' not in str(record.message):
+                warnings.warn_explicit(record.message, record.category, record.filename, record.lineno)
+        return False
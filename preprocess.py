@@ -8,7 +8,7 @@ from nuscenes.map_expansion.map_api import NuScenesMap
 from nuscenes.map_expansion import arcline_path_utils
 from nuscenes.nuscenes import NuScenes
 from nuscenes.utils.geometry_utils import BoxVisibility
-from datasets.utils import get_homogeneous_matrix, cartesian_to_polar
+from datasets.utils import get_homogeneous_matrix, cartesian_to_polar, scenario_dtype, scenario_record
 from multiprocessing import Pool
 import warnings
 warnings.filterwarnings("ignore")
@@ -76,6 +76,7 @@ else:
 
 def preprocess_scene(i_scene):
     scene = nusc.scene[i_scene]
+    records = []
     sample_token = scene['first_sample_token']
     while sample_token:
         sample = nusc.get('sample', sample_token)
@@ -239,13 +240,21 @@ def preprocess_scene(i_scene):
         torch.save(torch.tensor(np.array(location), dtype=torch.float32), os.path.join(folder_mapping[i_scene], sample_data['token'], 'location'))
         torch.save(torch.tensor(np.array(bbox), dtype=torch.float32), os.path.join(folder_mapping[i_scene], sample_data['token'], 'bbox'))
         torch.save(torch.tensor(np.array(velocity), dtype=torch.float32), os.path.join(folder_mapping[i_scene], sample_data['token'], 'velocity'))
+        records.append(scenario_record(sample_data['token'], category, velocity, drivable_area, ped_crossing,
+                                       location=map_name,
+                                       ego_pose=(pose['translation'][0], pose['translation'][1], rad)))
 
         sample_token = sample['next']
-    return i_scene
+    return i_scene, records
+
+
+index = {}
 
 
 def callback(res):
-    print(f'Scene {res} finished')
+    i_scene, records = res
+    index.setdefault(folder_mapping[i_scene], []).extend(records)
+    print(f'Scene {i_scene} finished')
 
 
 pool = Pool(processes=n_process)
@@ -259,9 +268,17 @@ else:
     folders = ['test']
 for folder in folders:
     os.chdir(folder)
+    removed = []
     for sample in os.listdir():
+        # index.npy of a previous run sits next to the samples
+        if not os.path.isdir(sample):
+            continue
         if len(os.listdir(sample)) != 5:
             print(f'remove {sample}')
             os.rmdir(sample)
+            removed.append(sample)
+    # columnar per-sample metadata, see NuScenesDataset.select
+    records = [record for record in index.get(folder, []) if record[0] not in removed]
+    np.save('index.npy', np.array(records, dtype=scenario_dtype))
     os.chdir('..')
 print('All done')
@@ -0,0 +1,126 @@
+import io
+import time
+import argparse
+import torch
+from torch.utils.data import DataLoader
+from datasets import NuScenesDataset, AutoregressivePreprocessor, DiffusionModelPreprocessor, collate_fn
+from networks.autoregressive_transformer import AutoregressiveTransformer
+from networks.diffusion_models import DiffusionBasedModel
+from networks.quantization import quantize_model
+from networks.utils import get_length_mask
+
+
+def state_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def evaluate_ar(model, batches, args):
+    # teacher-forced NLL on whole scenes, then scenes generated from the empty map
+    tf_preprocessor = AutoregressivePreprocessor('cpu').train()
+    gen_preprocessor = AutoregressivePreprocessor('cpu').test()
+    nll = []
+    n_objects = 0
+    n_valid = 0
+    elapsed = 0.
+    for batch in batches:
+        model.eval()
+        samples, lengths, gt = tf_preprocessor(dict(batch), window_size='all')
+        with torch.no_grad():
+            nll.append(model(samples, lengths, gt)['all'].mean().item())
+        samples, lengths, _ = gen_preprocessor(dict(batch), n_keep=0)
+        start = time.time()
+        scenes, new_lengths = model.generate_scenes(samples, lengths, n_sample=args.n_sample, max_steps=args.max_steps)
+        elapsed += time.time() - start
+        # an object is valid if its center is on drivable area (vehicles) or walkway / crossing (others)
+        placed = ~get_length_mask(new_lengths, scenes['category'].size(1))  # (B, L)
+        loc = model._discrete_loc(scenes['location']).clamp(0, 320 * 320 - 1)  # (B, L)
+        maps = samples['map'].flatten(2)  # (B, 26, 320 * 320)
+        drivable = maps[:, 0].gather(1, loc) > 0
+        walkable = (maps[:, 1].gather(1, loc) + maps[:, 2].gather(1, loc)) > 0
+        valid = torch.where(scenes['category'] == 3, drivable, walkable)
+        n_objects += placed.sum().item()
+        n_valid += (valid & placed).sum().item()
+    model.train()
+    return {
+        'nll': sum(nll) / len(nll),
+        'objects / scene': n_objects / (len(batches) * args.batch_size),
+        'valid placements': n_valid / max(n_objects, 1),
+        'ms / object': elapsed / max(n_objects, 1) * 1000
+    }
+
+
+def evaluate_diffusion(model, batches, args):
+    # denoising loss on the validation scenes, then one extractor and backbone pass per scene
+    preprocessor = DiffusionModelPreprocessor('cpu').test()
+    losses = []
+    elapsed = 0.
+    model.eval()
+    for batch in batches:
+        batch = preprocessor(dict(batch))
+        with torch.no_grad():
+            losses.append(model(batch)['all'].mean().item())
+            start = time.time()
+            fmap, _ = model.feature_extractor(batch['map'])
+            pos = {field: batch[field]['location'] for field in ['pedestrian', 'bicyclist', 'vehicle']}
+            mask = torch.zeros(fmap.size(0), sum(v.size(1) for v in pos.values()), dtype=torch.bool)
+            model.backbone(pos, pos, fmap, torch.full((fmap.size(0), ), 0.5), mask)
+            elapsed += time.time() - start
+    model.train()
+    return {'loss': sum(losses) / len(losses), 'ms / scene': elapsed / (len(batches) * args.batch_size) * 1000}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', default='/projects/perception/datasets/nuScenesProcessed/val')
+    parser.add_argument('--model', choices=['ar', 'diffusion'], default='ar')
+    parser.add_argument('--ckpt', default=None)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--n-calibration', type=int, default=16, help='calibration batches')
+    parser.add_argument('--n-batches', type=int, default=8, help='evaluation batches')
+    parser.add_argument('--n-sample', type=int, default=5)
+    parser.add_argument('--max-steps', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    dataset = NuScenesDataset(args.dataroot)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, collate_fn=collate_fn)
+    batches = []
+    for i, batch in enumerate(dataloader):
+        if i >= args.n_calibration + args.n_batches:
+            break
+        batches.append(batch)
+    calibration, evaluation = batches[:args.n_calibration], batches[args.n_calibration:]
+
+    if args.model == 'ar':
+        model = AutoregressiveTransformer()
+        preprocessor = AutoregressivePreprocessor('cpu').test()
+        # calibrate on maps with the objects of the scene rasterized, as seen during generation
+        calibration_maps = [preprocessor(dict(batch), n_keep=-1)[0]['map'] for batch in calibration]
+        evaluate = evaluate_ar
+    else:
+        model = DiffusionBasedModel(time_steps=1000)
+        preprocessor = DiffusionModelPreprocessor('cpu').test()
+        calibration_maps = [preprocessor(dict(batch))['map'] for batch in calibration]
+        evaluate = evaluate_diffusion
+    if args.ckpt is not None:
+        model.load_state_dict(torch.load(args.ckpt, map_location='cpu'))
+
+    variants = [
+        ('float32', model),
+        ('int8 linear', quantize_model(model)),
+        ('int8 linear + conv', quantize_model(model, calibration_maps))
+    ]
+    base = None
+    for name, variant in variants:
+        torch.manual_seed(0)
+        metrics = evaluate(variant, evaluation, args)
+        metrics['size (MiB)'] = state_size(variant) / 2 ** 20
+        if base is None:
+            base = metrics
+        report = ', '.join(f'{k} {v:.3f} ({v / base[k]:.2f}x)' if base[k] else f'{k} {v:.3f}'
+                           for k, v in metrics.items())
+        print(f'{name:>20}: {report}')